@@ -0,0 +1,233 @@
+"""
+asyncio counterpart of the unique counter, for services running on an event
+loop, built on an asyncio redis client (e.g. ``redis.asyncio.Redis``).
+
+It uses the same keys and lua scripts as RedisUniqueCount, so both can work
+on the same counts, e.g. tracking from an async ingestion service and
+querying from synchronous jobs.  Python 3 only, so not imported by the
+package.
+"""
+import logging
+
+from . import scripts
+from .unique_count import (BatchStats, CountQuery, DEFAULT_BATCH_SIZE,
+                           DEFAULT_NAMESPACE, DEFAULT_TTL, RedisUniqueCount,
+                           TO_ID_KEY, TrackedEvent)
+
+log = logging.getLogger(__name__)
+
+
+class AsyncRedisUniqueCount(object):
+
+    """Track unique counts using redis bit strings, from asyncio code.
+
+    Any number of coroutines can track and count concurrently on one
+    counter; each call is a single round trip (or, for track_events and
+    get_counts, a few round trips per batch), pipelined where it sends more
+    than one command.
+    """
+
+    def __init__(self, redis_conn, namespace_deliminator=':',
+                 bitop_ttl=DEFAULT_TTL, bucket_func=None,
+                 offset_cache_size=0, rollups=(), rollup_on_write=True,
+                 sparse_density=None, approximate=(), hash_tags=False,
+                 retention=None):
+        """Bind a counter to an asyncio redis connection.  The options are
+        those of RedisUniqueCount; reserved offset blocks and segment caching
+        are not supported.
+
+        :param redis_conn: asyncio Redis connection to operate on
+        """
+        self._redis_conn = redis_conn
+        self._scripts = scripts.for_connection(redis_conn)
+        # key layout and planning, shared with the synchronous counter
+        self._layout = RedisUniqueCount(
+            redis_conn, namespace_deliminator=namespace_deliminator,
+            bitop_ttl=bitop_ttl, bucket_func=bucket_func,
+            offset_cache_size=offset_cache_size, rollups=rollups,
+            rollup_on_write=rollup_on_write, sparse_density=sparse_density,
+            approximate=approximate, hash_tags=hash_tags,
+            retention=retention)
+        self.bucket_func = self._layout.bucket_func
+        self.stats = self._layout.stats
+        self._bitop_ttl = bitop_ttl
+        self._sparse_density = sparse_density
+
+    def cache_stats(self):
+        """See RedisUniqueCount.cache_stats"""
+        return self._layout.cache_stats()
+
+    def add_namespace(self, namespace, key):
+        return self._layout.add_namespace(namespace, key)
+
+    def is_approximate(self, event, namespace=DEFAULT_NAMESPACE):
+        """See RedisUniqueCount.is_approximate"""
+        return self._layout.is_approximate(event, namespace)
+
+    async def map_id_to_offset(self, native_id, namespace=DEFAULT_NAMESPACE):
+        """Return the type-dependent bit offset for the given native_id
+        """
+        await self.__check_generation(namespace)
+        offset = self._layout._cached_offset(native_id, namespace)
+        if offset is not None:
+            return offset
+        keys = self._layout._make_offset_keys(namespace)
+        offset = int(await self._scripts.run('unique_count.map_id',
+                                             keys=keys, args=(native_id,)))
+        self._layout._cache_offset(native_id, namespace, offset)
+        return offset
+
+    async def map_offset_to_id(self, offset, namespace=DEFAULT_NAMESPACE):
+        """Get the id for the given offset
+        """
+        await self.__check_generation(namespace)
+        native_id = self._layout._cached_id(offset, namespace)
+        if native_id is not None:
+            return native_id
+        key = self.add_namespace(namespace, TO_ID_KEY)
+        native_id = await self._redis_conn.hget(key, offset)
+        self._layout._cache_id(offset, namespace, native_id)
+        return native_id
+
+    async def __check_generation(self, namespace):
+        """See RedisUniqueCount._check_generation"""
+        key = self._layout._generation_key(namespace)
+        if key is not None:
+            self._layout._note_generation(namespace,
+                                          await self._redis_conn.get(key))
+
+    async def get_current_offset(self, namespace=DEFAULT_NAMESPACE):
+        """ Returns current offset for given namespace
+
+        :rtype: int
+        """
+        key = self._layout._make_offset_keys(namespace)[2]
+        try:
+            return int(await self._redis_conn.get(key))
+        except TypeError:
+            return 0
+
+    async def track_event(self, event, native_id,
+                          namespace=DEFAULT_NAMESPACE, event_time=None):
+        """Track that the given event happened to the given id, in one round
+        trip.  See RedisUniqueCount.track_event.
+        """
+        await self.__track_batch(
+            [TrackedEvent(event, native_id, event_time, namespace)],
+            lookup=False)
+
+    async def track_events(self, events, batch_size=DEFAULT_BATCH_SIZE):
+        """Track many events at once, in a few pipelined round trips per
+        batch.  See RedisUniqueCount.track_events.
+
+        :rtype: list
+        """
+        stats = []
+        batch = []
+        for element in events:
+            try:
+                batch.append(TrackedEvent(*element))
+            except TypeError:
+                raise ValueError("Invalid tracked event tuple")
+            if len(batch) >= batch_size:
+                stats.append(await self.__track_batch(batch))
+                batch = []
+        if batch:
+            stats.append(await self.__track_batch(batch))
+        return stats
+
+    async def __track_batch(self, batch, lookup=True):
+        """Track one batch of TrackedEvents: one round trip to look up
+        uncached offsets (unless lookup is false, e.g. for a single event),
+        and one to set the bits, mapping any new ids with TRACK_SCRIPT.  A
+        batch expires its new buckets with EXPIRE_NEW_SCRIPT calls; a single
+        event has the scripts setting its bits expire them.  The commands are
+        queued by the synchronous counter's helpers.
+        """
+        layout = self._layout
+        for namespace in set(tracked.namespace for tracked in batch):
+            await self.__check_generation(namespace)
+        offsets, lookups = layout._batch_offsets(batch)
+        new_ids = sum(len(ids) for _, ids in lookups)
+        if lookup and lookups:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            layout._queue_lookups(lookups, pipe)
+            new_ids = layout._found_offsets(lookups, await pipe.execute(),
+                                            offsets)
+        pipe = self._redis_conn.pipeline(transaction=False)
+        mapped = layout._queue_batch(batch, offsets, pipe,
+                                     inline_expiries=not lookup)
+        layout._settle_batch(mapped, await pipe.execute())
+        log.debug("tracked %d events", len(batch))
+        return BatchStats(len(batch), new_ids, len(offsets))
+
+    async def get_count(self, start_date, end_date, event,
+                        namespace=DEFAULT_NAMESPACE):
+        """Get the count of uniques for the given event, of the given id type,
+        for the given date range.  See RedisUniqueCount.get_count.
+
+        :type start_date: datetime.datetime
+        :type end_date: datetime.datetime
+        """
+        counts = await self.get_counts([(event, start_date, end_date,
+                                         namespace)])
+        return counts[0]
+
+    async def get_counts(self, queries):
+        """Get the unique counts for many event/date range queries at once, in
+        a single pipelined round trip (two, if rollups are not maintained on
+        write, to check which are built).
+
+        :param queries: iterable of (event, start_date, end_date[, namespace])
+                        or CountQuery
+        :returns: the count for each query, in order
+        :rtype: list
+        """
+        ranges = []
+        for query in queries:
+            try:
+                query = CountQuery(*query)
+            except TypeError:
+                raise ValueError("Invalid count query tuple")
+            start_date = self.bucket_func(query.start_date)
+            end_date = self.bucket_func(query.end_date)
+            if end_date < start_date:
+                start_date, end_date = end_date, start_date
+            ranges.append((query, start_date, end_date))
+        unbuilt = await self.__find_unbuilt(ranges)
+
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for query, start_date, end_date in ranges:
+            keys = self._layout._plan_keys(query.event, start_date, end_date,
+                                           query.namespace, unbuilt)
+            if self.is_approximate(query.event, query.namespace):
+                pipe.pfcount(*keys)
+            elif len(keys) == 1 and self._sparse_density:
+                await self._scripts.run('unique_count.count', keys=keys,
+                                        client=pipe)
+            elif len(keys) == 1:
+                pipe.bitcount(keys[0])
+            else:
+                compound_key = self._layout._make_compound_key(
+                    query.event, start_date, end_date, query.namespace)
+                await self._scripts.run(
+                    'unique_count.or_count', keys=[compound_key] + keys,
+                    args=[self._bitop_ttl] + [0] * len(keys), client=pipe)
+        return [self._layout._record_or_count(result)
+                if isinstance(result, list) else result
+                for result in await pipe.execute()]
+
+    async def __find_unbuilt(self, ranges):
+        """Return the rollup keys covering the (query, start, end) ranges that
+        have not been built, when rollups are not maintained on write
+        """
+        candidates = self._layout._rollup_candidates(
+            (query.event, start_date, end_date, query.namespace)
+            for query, start_date, end_date in ranges)
+        if not candidates:
+            return set()
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for key in candidates:
+            pipe.exists(key)
+        return set(key for key, built in zip(candidates, await pipe.execute())
+                   if not built)
@@ -0,0 +1,186 @@
+"""
+Pull the bucket bitmaps of a unique counter out of redis into NumPy arrays,
+to run heavy analytics (retention matrices, rolling uniques, ...) on an
+analysis box with vectorized operations, instead of as many BITOPs on the
+production redis.
+
+NumPy is an optional dependency, only needed by this module.
+"""
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .unique_count import DEFAULT_NAMESPACE
+
+log = logging.getLogger(__name__)
+
+_POPCOUNT = None
+if np is not None:
+    _POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)],
+                         dtype=np.uint8)
+
+
+def popcount(bitmap):
+    """Count the bits set in a uint8 bitmap array
+
+    :rtype: int
+    """
+    return int(_POPCOUNT[bitmap].sum(dtype=np.int64))
+
+
+def to_offsets(bitmap):
+    """Return the offsets of the bits set in a uint8 bitmap array, in order,
+    e.g. to map back to ids with RedisUniqueCount.map_offsets_to_ids
+
+    :rtype: list
+    """
+    return np.flatnonzero(np.unpackbits(bitmap)).tolist()
+
+
+class BucketBitmaps(object):
+
+    """The bitmaps of a run of consecutive buckets, held in process as uint8
+    arrays.  Each bitmap is as long as its redis string (redis bitmaps only
+    grow as far as their highest set bit); shorter bitmaps are treated as
+    zero padded.
+    """
+
+    def __init__(self, buckets, bitmaps):
+        """
+        :param buckets: the bucket datetimes, in order
+        :param bitmaps: the uint8 array of each bucket
+        """
+        if np is None:
+            raise ImportError("numpy is required for bitmap analytics")
+        if len(buckets) != len(bitmaps):
+            raise ValueError("need one bitmap per bucket")
+        self.buckets = list(buckets)
+        self.bitmaps = list(bitmaps)
+
+    @classmethod
+    def fetch(cls, unique_count, event, start_date, end_date,
+              namespace=DEFAULT_NAMESPACE):
+        """Read the buckets of an event from start_date to end_date (see
+        RedisUniqueCount.get_bitmaps).  The arrays wrap the bytes returned by
+        redis without copying them, and so are read only.
+
+        :param unique_count: counter the buckets belong to
+        :type unique_count: redis_gadgets.unique_count.RedisUniqueCount
+        :rtype: BucketBitmaps
+        """
+        buckets = []
+        bitmaps = []
+        for bucket, data in unique_count.get_bitmaps(event, start_date,
+                                                     end_date, namespace):
+            buckets.append(bucket)
+            bitmaps.append(np.frombuffer(data, dtype=np.uint8))
+        log.debug("fetched %d bitmaps of %s, %d bytes", len(bitmaps), event,
+                  sum(bitmap.nbytes for bitmap in bitmaps))
+        return cls(buckets, bitmaps)
+
+    def __len__(self):
+        return len(self.bitmaps)
+
+    @property
+    def width(self):
+        """Length in bytes of the longest bitmap"""
+        return max([bitmap.size for bitmap in self.bitmaps] or [0])
+
+    def matrix(self):
+        """Return the bitmaps as one zero padded (buckets x width) array
+
+        :rtype: numpy.ndarray
+        """
+        matrix = np.zeros((len(self.bitmaps), self.width), dtype=np.uint8)
+        for row, bitmap in zip(matrix, self.bitmaps):
+            row[:bitmap.size] = bitmap
+        return matrix
+
+    def union(self, start=0, stop=None):
+        """Return the OR of the bitmaps of buckets start to stop (a slice)
+
+        :rtype: numpy.ndarray
+        """
+        bitmaps = self.bitmaps[start:stop]
+        result = np.zeros(max([bitmap.size for bitmap in bitmaps] or [0]),
+                          dtype=np.uint8)
+        for bitmap in bitmaps:
+            result[:bitmap.size] |= bitmap
+        return result
+
+    def intersection(self, start=0, stop=None):
+        """Return the AND of the bitmaps of buckets start to stop (a slice)
+
+        :rtype: numpy.ndarray
+        """
+        bitmaps = self.bitmaps[start:stop]
+        if not bitmaps:
+            return np.zeros(0, dtype=np.uint8)
+        size = min(bitmap.size for bitmap in bitmaps)
+        result = bitmaps[0][:size].copy()
+        for bitmap in bitmaps[1:]:
+            result &= bitmap[:size]
+        return result
+
+    def counts(self):
+        """Return the number of uniques in each bucket
+
+        :rtype: numpy.ndarray
+        """
+        return np.array([popcount(bitmap) for bitmap in self.bitmaps],
+                        dtype=np.int64)
+
+    def retention_matrix(self):
+        """Return the (buckets x buckets) matrix of the number of uniques in
+        both bucket i and bucket j, for j >= i (and zero below the diagonal),
+        e.g. the users active on day i that came back on day j
+
+        :rtype: numpy.ndarray
+        """
+        size = len(self.bitmaps)
+        result = np.zeros((size, size), dtype=np.int64)
+        for i, first in enumerate(self.bitmaps):
+            for j in range(i, size):
+                second = self.bitmaps[j]
+                length = min(first.size, second.size)
+                result[i, j] = popcount(first[:length] & second[:length])
+        return result
+
+    def rolling_uniques(self, window):
+        """Return the number of uniques in each run of window consecutive
+        buckets, e.g. 7 day active users per day.
+
+        Every bucket is ORed a constant number of times, whatever the window
+        size: the buckets are split into blocks of window buckets, with
+        running ORs from the start and from the end of each block, and each
+        run is the OR of the suffix of one block and the prefix of the next.
+
+        :param window: number of buckets per run
+        :type window: int
+        :returns: the count of each run, by its first bucket
+        :rtype: numpy.ndarray
+        """
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        matrix = self.matrix()
+        size = len(matrix)
+        if size < window:
+            return np.zeros(0, dtype=np.int64)
+        prefix = np.empty_like(matrix)
+        suffix = np.empty_like(matrix)
+        for start in range(0, size, window):
+            block = matrix[start:start + window]
+            prefix[start:start + window] = np.bitwise_or.accumulate(block)
+            suffix[start:start + window] = np.bitwise_or.accumulate(
+                block[::-1])[::-1]
+        result = np.empty(size - window + 1, dtype=np.int64)
+        for first in range(size - window + 1):
+            last = first + window - 1
+            if first % window == 0:
+                result[first] = popcount(prefix[last])
+            else:
+                result[first] = popcount(suffix[first] | prefix[last])
+        return result
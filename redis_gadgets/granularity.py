@@ -2,9 +2,78 @@
 Collection of callables to transform datetimes into lower precision datetimes,
 for a few common use cases.  Also serves as a template for users looking to
 implement their own custom granularity
+
+Granularities also know how to step from one bucket to the next.  A custom
+granularity should set a ``step`` attribute (the timedelta between buckets),
+or, if its buckets are not evenly spaced, a ``next_bucket`` attribute (a
+callable from a bucket to the one after it).  Granularities with neither are
+stepped a DEFAULT_STEP at a time until they reach the next bucket, so any
+granularity of at least a day works without either.
 """
+import datetime
+
+DEFAULT_STEP = datetime.timedelta(days=1)
+MAX_STEPS = 100000  # steps to take looking for the next bucket
+
+
+def steps(step):
+    """Decorator to set how a granularity steps between its buckets
+
+    :param step: time between the start of one bucket and the next, or, for
+                 unevenly spaced buckets, a callable returning the bucket
+                 after a given one
+    :type step: datetime.timedelta or callable
+    """
+    def decorate(bucket_func):
+        if callable(step):
+            bucket_func.next_bucket = step
+        else:
+            bucket_func.step = step
+        return bucket_func
+    return decorate
+
+
+def next_bucket(bucket_func, bucket):
+    """Return the bucket following the given one
+
+    :param bucket_func: granularity the bucket belongs to
+    :param bucket: a datetime already truncated by bucket_func
+    :type bucket: datetime.datetime
+    :rtype: datetime.datetime
+    :raises ValueError: if no later bucket is found within MAX_STEPS steps
+    """
+    stepper = getattr(bucket_func, 'next_bucket', None)
+    if stepper is not None:
+        return stepper(bucket)
+    step = getattr(bucket_func, 'step', DEFAULT_STEP)
+    candidate = bucket
+    for _ in range(MAX_STEPS):
+        candidate += step
+        following = bucket_func(candidate)
+        if following > bucket:
+            return following
+    raise ValueError("%s has no bucket after %s; give it a step or "
+                     "next_bucket" % (getattr(bucket_func, '__name__',
+                                              bucket_func), bucket))
+
+
+def bucket_range(bucket_func, start, end):
+    """Yield every bucket from the one holding start to the one holding end,
+    inclusive
+
+    :param bucket_func: granularity to generate buckets for
+    :type start: datetime.datetime
+    :type end: datetime.datetime
+    :rtype: iterator
+    """
+    bucket = bucket_func(start)
+    end = bucket_func(end)
+    while bucket <= end:
+        yield bucket
+        bucket = next_bucket(bucket_func, bucket)
 
 
+@steps(datetime.timedelta(minutes=5))
 def five_minute(dt):
     """Return a datetime representing dt truncated to a five minute interval
 
@@ -16,6 +85,7 @@ def five_minute(dt):
     return dt.replace(minute=interval, second=0, microsecond=0)
 
 
+@steps(datetime.timedelta(hours=1))
 def hourly(dt):
     """Return a datetime representing dt truncated to an hourly interval
 
@@ -26,6 +96,7 @@ def hourly(dt):
     return dt.replace(minute=0, second=0, microsecond=0)
 
 
+@steps(datetime.timedelta(days=1))
 def daily(dt):
     """Return a datetime representing dt truncated to an hourly interval
 
@@ -34,3 +105,33 @@ def daily(dt):
     :returns: a datetime representing dt truncated to an hourly interval
     """
     return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+@steps(datetime.timedelta(weeks=1))
+def weekly(dt):
+    """Return a datetime representing dt truncated to the start of its week
+    (Monday)
+
+    :param dt: Arbitrary precision date time
+    :type dt: datetime.datetime
+    :returns: a datetime representing dt truncated to a weekly interval
+    """
+    return daily(dt) - datetime.timedelta(days=dt.weekday())
+
+
+def _next_month(bucket):
+    """Return the first day of the month after bucket"""
+    if bucket.month == 12:
+        return bucket.replace(year=bucket.year + 1, month=1)
+    return bucket.replace(month=bucket.month + 1)
+
+
+@steps(_next_month)
+def monthly(dt):
+    """Return a datetime representing dt truncated to the start of its month
+
+    :param dt: Arbitrary precision date time
+    :type dt: datetime.datetime
+    :returns: a datetime representing dt truncated to a monthly interval
+    """
+    return daily(dt).replace(day=1)
@@ -0,0 +1,68 @@
+"""
+Small, thread safe, bounded least-recently-used cache, for keeping hot redis
+lookups in process
+"""
+from collections import namedtuple, OrderedDict
+import threading
+
+CacheStats = namedtuple('CacheStats', 'hits misses evictions size')
+
+
+class LRUCache(object):
+
+    """Bounded mapping that evicts the least recently used entry when full"""
+
+    def __init__(self, max_size):
+        """
+        :param max_size: maximum number of entries to hold
+        :type max_size: int
+        """
+        if max_size < 1:
+            raise ValueError("max_size must be at least 1")
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Return the value for key, marking it as recently used, or default
+        if it is not cached
+        """
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self._misses += 1
+                return default
+            self._data[key] = value
+            self._hits += 1
+            return value
+
+    def put(self, key, value):
+        """Cache value for key, evicting the least recently used entry if the
+        cache is full
+        """
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            if len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self._evictions += 1
+
+    def clear(self):
+        """Drop every entry, keeping the counters"""
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        """Return the hit, miss and eviction counts and the current size
+
+        :rtype: CacheStats
+        """
+        return CacheStats(self._hits, self._misses, self._evictions,
+                          len(self._data))
@@ -0,0 +1,104 @@
+"""
+Central registry for the lua scripts used by the gadgets.  Script sources are
+defined once, at import time, and registered with redis at most once per
+connection, however many counters or queries are built on that connection.
+"""
+import logging
+import weakref
+
+log = logging.getLogger(__name__)
+
+_SOURCES = {}
+_REGISTRIES = weakref.WeakKeyDictionary()
+
+
+def define(name, source):
+    """Add a script to the catalog of known scripts
+
+    :param name: unique name to run the script by, e.g. "module.script"
+    :param source: lua source of the script
+    """
+    if _SOURCES.get(name, source) != source:
+        raise ValueError("a different script is already defined as %s" %
+                         name)
+    _SOURCES[name] = source
+
+
+def for_connection(redis_conn):
+    """Return the ScriptRegistry shared by everything using redis_conn
+
+    :param redis_conn: Redis connection to run scripts on
+    :rtype: ScriptRegistry
+    """
+    registry = _REGISTRIES.get(redis_conn)
+    if registry is None:
+        registry = _REGISTRIES.setdefault(redis_conn,
+                                          ScriptRegistry(redis_conn))
+    return registry
+
+
+class ScriptRegistry(object):
+
+    """Registered scripts for one redis connection.
+
+    Scripts are registered lazily, the first time they are run, and run by
+    sha from then on.  If redis has lost a script (e.g. after a restart,
+    failover or SCRIPT FLUSH), the NOSCRIPT error is caught and the script is
+    re-loaded and re-run; pipelines load any missing scripts when they are
+    executed.
+    """
+
+    def __init__(self, redis_conn):
+        """
+        :param redis_conn: Redis connection to run scripts on
+        """
+        self._redis_conn = redis_conn
+        self._scripts = {}
+
+    def get(self, name):
+        """Return the registered redis Script object for name"""
+        script = self._scripts.get(name)
+        if script is None:
+            try:
+                source = _SOURCES[name]
+            except KeyError:
+                raise ValueError("unknown script %s" % name)
+            log.debug("registering script %s", name)
+            script = self._scripts.setdefault(
+                name, self._redis_conn.register_script(source))
+        return script
+
+    def run(self, name, keys=(), args=(), client=None):
+        """Run the named script
+
+        :param keys: key names to pass to the script as KEYS
+        :param args: arguments to pass to the script as ARGV
+        :param client: optional pipeline (or other connection) to run on
+        :returns: the script result, or the pipeline when client is one
+        """
+        return self.get(name)(keys=list(keys), args=list(args),
+                              client=client)
+
+    def queue(self, pipe, name, keys=(), args=()):
+        """Queue the named script on a pipeline, without sending anything.
+        Unlike run, this works the same on asyncio pipelines, whose scripts
+        would otherwise have to be awaited; like run, the pipeline loads the
+        script if redis is missing it when executed.
+
+        :param pipe: pipeline, sync or asyncio, to queue the script on
+        :param keys: key names to pass to the script as KEYS
+        :param args: arguments to pass to the script as ARGV
+        :returns: the pipeline
+        """
+        script = self.get(name)
+        pipe.scripts.add(script)
+        keys = list(keys)
+        return pipe.evalsha(script.sha, len(keys), *(keys + list(args)))
+
+    def load(self):
+        """Load every defined script into redis up front, e.g. to warm a new
+        server rather than paying for NOSCRIPT recovery on first use
+        """
+        for name in _SOURCES:
+            script = self.get(name)
+            script.sha = self._redis_conn.script_load(script.script)
@@ -2,23 +2,106 @@
 Manage queries against redis ordered sets, possibly involving unions &
 intersections of some complexity
 """
-# import hashlib
+from collections import Counter, namedtuple, OrderedDict
+import hashlib
 import logging
 import os  # for generating thread-safe key names
 import socket  # for generating thread-safe key names
 import threading  # for generating thread-safe key names
+import time
 
+from . import scripts
+from .lru import LRUCache
 from . import WeightedKey
 log = logging.getLogger(__name__)
 
 # If there is a race condition causing us to have to re-run zset_fetch, retry
-# at most this number of times
+# at most this number of times before falling back to a thread local key
 MAX_RETRIES = 2
 MAX_CACHE_SECONDS = 60 * 5  # no ZCACHE can live longer than this many seconds
+# ZCACHE key names longer than this are replaced by a hash of the expression
+MAX_KEY_LENGTH = 200
+EXPRESSION_SUFFIX = ':expr'  # suffix of a cache's recorded expression key
+# cached subexpressions expiring sooner than this are rebuilt, not reused
+MIN_REUSE_SECONDS = 1
+AGGREGATES = ('sum', 'min', 'max')
+# the intersection planner trusts zset cardinalities this old, at most
+CARDINALITY_SECONDS = 5
+CARDINALITY_CACHE_SIZE = 10000
+
+# Build (unless cached) the union or intersection (ARGV[1]) of KEYS[3] and up
+# into the cache at KEYS[1], read a slice of it and then expire or delete the
+# cache, in one atomic step, so the cache cannot expire between building and
+# reading it.  ARGV is operator, aggregate, ttl, max ttl, cachebust flag,
+# expression to record at KEYS[2] ('' for none), by score flag, reverse flag,
+# withscores flag, start, end (for score ranges: offset and limit, '' for
+# none), min score, max score, and then a weight per key.
+RANGE_SCRIPT = """
+    local ttl, max_ttl = tonumber(ARGV[3]), tonumber(ARGV[4])
+    local created = false
+    if ARGV[5] == '1' or redis.call('exists', KEYS[1]) == 0 then
+        local count = #KEYS - 2
+        local store = {KEYS[1], count}
+        for i = 3, #KEYS do
+            store[#store + 1] = KEYS[i]
+        end
+        store[#store + 1] = 'weights'
+        for i = 1, count do
+            store[#store + 1] = ARGV[13 + i]
+        end
+        store[#store + 1] = 'aggregate'
+        store[#store + 1] = ARGV[2]
+        if ARGV[1] == 'intersect' then
+            redis.call('zinterstore', unpack(store))
+        else
+            redis.call('zunionstore', unpack(store))
+        end
+        if ARGV[6] ~= '' then
+            redis.call('set', KEYS[2], ARGV[6], 'ex', max_ttl)
+        end
+        created = true
+    end
+    local command, range
+    if ARGV[7] == '1' then
+        if ARGV[8] == '1' then
+            command, range = 'zrevrangebyscore', {KEYS[1], ARGV[13], ARGV[12]}
+        else
+            command, range = 'zrangebyscore', {KEYS[1], ARGV[12], ARGV[13]}
+        end
+        if ARGV[9] == '1' then
+            range[#range + 1] = 'withscores'
+        end
+        if ARGV[10] ~= '' then
+            range[#range + 1] = 'limit'
+            range[#range + 1] = ARGV[10]
+            range[#range + 1] = ARGV[11]
+        end
+    else
+        if ARGV[8] == '1' then
+            command = 'zrevrange'
+        else
+            command = 'zrange'
+        end
+        range = {KEYS[1], ARGV[10], ARGV[11]}
+        if ARGV[9] == '1' then
+            range[#range + 1] = 'withscores'
+        end
+    end
+    local result = redis.call(command, unpack(range))
+    if created then
+        if ttl > 0 then
+            redis.call('expire', KEYS[1], math.min(ttl, max_ttl))
+        else
+            redis.call('del', KEYS[1])
+        end
+    end
+    return result
+    """
+
+scripts.define('set_theory.range', RANGE_SCRIPT)
 
 # TODO: Get rid of count argument on zset_fetch - clients can call zset_count
 #       directly as needed.
-# TODO: Loop for retry on zset fetch, don't recurse.
 
 
 def _unique_id():
@@ -42,43 +125,275 @@ def build_keys(bind_elements):
     return keys
 
 
-def build_key_hash(keys, operator, thread_local):
-    """From the dict of query keys/values, generate a hash for cache mapping"""
+def build_expression(keys, operator):
+    """Return the readable expression of a multi-key query, independent of
+    the order of the keys"""
+    hash_chunks = []
+    for k in sorted(keys, key=lambda x: x.key):
+        hash_chunks.append('%s*%s' % (k.key, k.weight))
+    if operator == "union":
+        return "(%s)" % " || ".join(hash_chunks)
+    return "(%s)" % " && ".join(hash_chunks)
+
+
+def hash_expression(expression):
+    """Return the compact ZCACHE key name for an expression: the sha1 of the
+    full expression, so distinct expressions never share a cache"""
+    if not isinstance(expression, bytes):
+        expression = expression.encode('utf-8')
+    return "ZCACHE:%s" % hashlib.sha1(expression).hexdigest()
+
+
+def _weighted_keys(bind_elements):
+    """Return the WeightedKey of each bind element"""
+    try:
+        return [WeightedKey(*el) for el in bind_elements]
+    except TypeError:
+        raise ValueError("Invalid weighted key tuple")
+
+
+def build_key_hash(keys, operator, thread_local, hashed=None):
+    """From the dict of query keys/values, generate a hash for cache mapping
+
+    :param hashed: True to always hash the expression, False to never hash
+                   it, or None to hash it only when the readable key would be
+                   longer than MAX_KEY_LENGTH
+    """
     key_count = len(keys)
     if key_count == 1:
-        key_hash = keys[0].key
+        return keys[0].key
     elif key_count > 1:
-        hash_chunks = []
-        for k in sorted(keys, key=lambda x: x.key):
-            hash_chunks.append('%s*%s' % (k.key, k.weight))
-        if operator == "union":
-            key_hash = " || ".join(hash_chunks)
-        else:
-            key_hash = " && ".join(hash_chunks)
-        key_hash = "ZCACHE:(%s)" % key_hash
+        key_hash = "ZCACHE:%s" % build_expression(keys, operator)
         if thread_local:
             key_hash = "%s::%s" % (key_hash, _unique_id())
     else:
         raise ValueError('we cant build a key hash with no keys')
     log.debug("hash before compression %s", key_hash)
-    # key_hash = "ZCACHE:%s" % hashlib.md5(key_hash).hexdigest()
+    return compress_key(key_hash, hashed)
+
+
+def compress_key(key_hash, hashed=None):
+    """Return the key name to use for a readable ZCACHE key name, hashed as
+    described by build_key_hash"""
+    if hashed is None:
+        hashed = len(key_hash) > MAX_KEY_LENGTH
+    if hashed:
+        return hash_expression(key_hash)
     return key_hash
 
 
+# A store command building one (sub)expression from its source keys
+_Step = namedtuple('_Step', 'command sources weights aggregate expression')
+
+
+def _term(operand):
+    """Return the (key name or expression, weight) of an expression operand
+    """
+    if isinstance(operand, Weighted):
+        return operand.operand, operand.weight
+    if isinstance(operand, WeightedKey):
+        return operand.key, operand.weight
+    return operand, 1.0
+
+
+def _canonical(node):
+    """Return the canonical text of a key name or expression"""
+    if isinstance(node, SetExpression):
+        return node.canonical()
+    return node
+
+
+def _terms_text(terms):
+    """Return the canonical texts of (node, weight) terms, in canonical order
+    """
+    return ['%s*%s' % term for term in
+            sorted((_canonical(node), weight) for node, weight in terms)]
+
+
+class SetExpression(object):
+
+    """A node of a tree of set operations on zsets, to query with
+    SetTheory.expression_cache and SetTheory.expression_range.  Operands are
+    key names, WeightedKeys or other expressions.
+    """
+
+    def canonical(self):
+        """Return the canonical text of the expression: equivalent
+        expressions, e.g. with their operands in another order, have the same
+        text, and so share their cache
+        """
+        raise NotImplementedError
+
+    def __repr__(self):
+        return '<%s %s>' % (type(self).__name__, self.canonical())
+
+
+class Weighted(SetExpression):
+
+    """An operand with its scores multiplied by weight"""
+
+    def __init__(self, operand, weight):
+        operand, inner = _term(operand)
+        self.operand = operand
+        self.weight = inner * weight
+
+    def canonical(self):
+        return '(%s)' % _terms_text([(self.operand, self.weight)])[0]
+
+
+class _Combination(SetExpression):
+
+    """A union or intersection of weighted operands, with scores combined by
+    the aggregate function (sum, min or max)"""
+
+    command = None
+    joiner = None
+
+    def __init__(self, *operands, **options):
+        aggregate = options.pop('aggregate', 'max').lower()
+        if options:
+            raise TypeError('unexpected options: %s' % ', '.join(options))
+        if aggregate not in AGGREGATES:
+            raise ValueError('aggregate must be one of %s' %
+                             ', '.join(AGGREGATES))
+        if not operands:
+            raise ValueError('%s needs at least one operand' %
+                             type(self).__name__)
+        self.aggregate = aggregate
+        self.terms = []
+        for operand in operands:
+            node, weight = _term(operand)
+            if (type(node) is type(self) and node.aggregate == aggregate and
+                    weight >= 0):
+                # non negative weights distribute over sum, min and max, so
+                # e.g. (A | B) | C is stored in one step as A | B | C
+                self.terms.extend((child, child_weight * weight)
+                                  for child, child_weight in node.terms)
+            else:
+                self.terms.append((node, weight))
+
+    def canonical(self):
+        text = '(%s)' % self.joiner.join(_terms_text(self.terms))
+        if self.aggregate != 'max':
+            text = '%s:%s' % (text, self.aggregate)
+        return text
+
+
+class Union(_Combination):
+
+    """Union of the operands (ZUNIONSTORE)"""
+
+    command = 'ZUNIONSTORE'
+    joiner = ' || '
+
+
+class Intersect(_Combination):
+
+    """Intersection of the operands (ZINTERSTORE)"""
+
+    command = 'ZINTERSTORE'
+    joiner = ' && '
+
+
+class Difference(SetExpression):
+
+    """The members of the first operand that are in none of the others, with
+    their scores from the first (ZDIFFSTORE, which needs redis 6.2)"""
+
+    def __init__(self, first, *others):
+        if not others:
+            raise ValueError('Difference needs at least two operands')
+        self.first = _term(first)
+        # only the membership of the other operands matters
+        self.others = [_term(other)[0] for other in others]
+
+    def canonical(self):
+        return '(%s - %s)' % (
+            _terms_text([self.first])[0],
+            ' - '.join(sorted(_canonical(other) for other in self.others)))
+
+
 class SetTheory(object):
 
     """Store shared state, especially redis connection information, for use
     with a set of related zset queries."""
 
-    def __init__(self, redis_conn):
+    def __init__(self, redis_conn, hash_keys=None, record_expressions=False,
+                 scripted=False, plan_intersections=False):
         """
 
         :param redis_conn: Redis connection.
         instance; a non-strict Redis object will result in the wrong order
         being used for zset operations
+        :param hash_keys: True to always name caches by the hash of their
+        expression, False to always use the readable expression, or None to
+        hash expressions longer than MAX_KEY_LENGTH
+        :param record_expressions: also store the readable expression of each
+        cache built (see expression_for), to debug hashed cache keys
+        :param scripted: run multi-key zset_range queries as a single lua
+        script, in one round trip instead of four, with no expiry race
+        :param plan_intersections: order the keys of intersections by their
+        cardinality (see cardinalities): an intersection with an empty key is
+        empty without touching the others, and intersections of more than two
+        keys are built smallest first, caching each partial result for reuse
 
         """
         self._redis_conn = redis_conn
+        # intersections skipped for an empty key (empty_intersections) and
+        # partial intersections reused (partial_hits) by the planner;
+        # zset_range retries (range_retries) and fallbacks to a private key
+        # (range_fallbacks), and how many of those fallbacks found the
+        # shared cache had expired mid-query (range_races); expression
+        # subexpressions built (expression_builds) and reused from cache
+        # (expression_hits), and expression_range rebuilds (expression_retries)
+        self.stats = Counter()
+        self._hash_keys = hash_keys
+        self._record_expressions = record_expressions
+        self._scripted = scripted
+        self._scripts = scripts.for_connection(redis_conn)
+        self._plan_intersections = plan_intersections
+        self._cardinalities = LRUCache(CARDINALITY_CACHE_SIZE)
+
+    def cardinalities(self, keys):
+        """Return a dict of the ZCARD of each key, in one pipelined round trip
+        for those not looked up in the last CARDINALITY_SECONDS
+        """
+        now = time.time()
+        result = {}
+        missing = []
+        for key in keys:
+            cached = self._cardinalities.get(key)
+            if cached is not None and cached[1] > now:
+                result[key] = cached[0]
+            elif key not in missing:
+                missing.append(key)
+        if missing:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for key in missing:
+                pipe.zcard(key)
+            for key, count in zip(missing, pipe.execute()):
+                self._cardinalities.put(key,
+                                        (count, now + CARDINALITY_SECONDS))
+                result[key] = count
+        return result
+
+    def __empty_intersection(self, keys, operator):
+        """Whether a planned intersection has an empty key, and so is empty
+        """
+        if (not self._plan_intersections or operator != "intersect" or
+                len(keys) < 2):
+            return False
+        if 0 in self.cardinalities(k.key for k in keys).values():
+            log.debug("empty key in intersection, skipping it")
+            self.stats['empty_intersections'] += 1
+            return True
+        return False
+
+    def expression_for(self, key_hash):
+        """Return the readable expression recorded for a cache key, or None if
+        it was not recorded or has expired
+        """
+        return self._redis_conn.get(key_hash + EXPRESSION_SUFFIX)
 
     def zset_cache(self, bind_elements, operator="union", aggregate="max",
                    cachebust=False, thread_local=False):
@@ -93,25 +408,40 @@ class SetTheory(object):
         (one key only) Note that it may be your responsibility to expire the
         cache if it was newly created
         """
-        # a dict of fully interpolated redis keys and their weights
-        try:
-            keys = [WeightedKey(*el) for el in bind_elements]
-        except TypeError:
-            raise ValueError("Invalid weighted key tuple")
+        key_hash, cache_created, _ = self.__build(bind_elements, operator,
+                                                  aggregate, cachebust,
+                                                  thread_local)
+        return key_hash, cache_created
+
+    def __build(self, bind_elements, operator, aggregate, cachebust,
+                thread_local):
+        """zset_cache, also returning the size of the cache if this call built
+        it (None otherwise)
+        """
+        # a list of fully interpolated redis keys and their weights
+        keys = _weighted_keys(bind_elements)
         log.debug("key combination %s", keys)
-        key_hash = build_key_hash(keys, operator, thread_local)
+        key_hash = build_key_hash(keys, operator, thread_local,
+                                  hashed=self._hash_keys)
         log.debug("key hash %s", key_hash)
         cache_created = False
+        size = None
+        if self.__empty_intersection(keys, operator):
+            # a missing key reads as an empty zset
+            return key_hash, cache_created, size
         if len(keys) > 1:
             cache_exists = self._redis_conn.exists(key_hash)
             if cache_exists and not cachebust:
                 log.debug("totally in cache, hitting it")
             else:
-                # import pdb; pdb.set_trace()
                 log.debug("not in cache")
                 cache_created = True
                 pipe = self._redis_conn.pipeline()
-                if operator == "intersect":
+                store = 0  # index of the command storing key_hash
+                if operator == "intersect" and self._plan_intersections:
+                    store = self.__staged_intersect(keys, key_hash, aggregate,
+                                                    pipe)
+                elif operator == "intersect":
                     log.debug("Running zinterstore to key %s", key_hash)
                     pipe.zinterstore(key_hash, {k.key: k.weight for k in keys},
                                      aggregate=aggregate)
@@ -119,9 +449,58 @@ class SetTheory(object):
                     log.debug("Running zunionstore to key %s", key_hash)
                     pipe.zunionstore(key_hash, {k.key: k.weight for k in keys},
                                      aggregate=aggregate)
+                else:
+                    store = None
                 pipe.expire(key_hash, MAX_CACHE_SECONDS)
-                pipe.execute()
-        return key_hash, cache_created
+                if self._record_expressions:
+                    pipe.set(key_hash + EXPRESSION_SUFFIX,
+                             build_expression(keys, operator),
+                             ex=MAX_CACHE_SECONDS)
+                results = pipe.execute()
+                if store is not None:
+                    size = results[store]
+        return key_hash, cache_created, size
+
+    def __staged_intersect(self, keys, key_hash, aggregate, pipe):
+        """Queue the intersection of keys into key_hash on pipe, smallest keys
+        first: each partial intersection of the smallest keys is cached under
+        its own expression, and the largest cached one is reused.  Returns
+        the index on pipe of the command storing key_hash
+        """
+        cardinalities = self.cardinalities(k.key for k in keys)
+        ordered = sorted(keys, key=lambda k: (cardinalities[k.key], k.key))
+        # partials[i] holds the intersection of the i + 2 smallest keys
+        partials = [compress_key("ZCACHE:%s" % Intersect(
+            *ordered[:size], aggregate=aggregate).canonical(), self._hash_keys)
+            for size in range(2, len(ordered))]
+        sources = [ordered[0]]
+        first = 1
+        if partials:
+            check = self._redis_conn.pipeline(transaction=False)
+            for key in partials:
+                check.pttl(key)
+            for index, pttl in reversed(list(enumerate(check.execute()))):
+                if pttl == -1 or pttl >= MIN_REUSE_SECONDS * 1000:
+                    log.debug("reusing partial intersection %s",
+                              partials[index])
+                    self.stats['partial_hits'] += 1
+                    sources = [WeightedKey(partials[index])]
+                    first = index + 2
+                    break
+        for index in range(first, len(ordered)):
+            sources.append(ordered[index])
+            if index < len(partials) + 1:
+                dest = partials[index - 1]
+            else:
+                dest = key_hash
+            log.debug("Running zinterstore to key %s", dest)
+            pipe.zinterstore(dest, {k.key: k.weight for k in sources},
+                             aggregate=aggregate)
+            if dest != key_hash:
+                pipe.expire(dest, MAX_CACHE_SECONDS)
+            sources = [WeightedKey(dest)]
+        # every partial stage queues a store and an expire
+        return 2 * (len(ordered) - first - 1)
 
     def zset_count(self, bind_elements, min_score=None, max_score=None,
                    operator="union", ttl=0, aggregate="max",
@@ -161,11 +540,54 @@ class SetTheory(object):
         """Perform operation described in bind_elements then cache and return
         the result, subject to all suplied paramaters.
         """
-        result = []
-        key_hash, cache_created = self.zset_cache(bind_elements,
-                                                  operator=operator,
-                                                  aggregate=aggregate,
-                                                  thread_local=thread_local)
+        if self.__empty_intersection(_weighted_keys(bind_elements), operator):
+            return []
+        if self._scripted and len(bind_elements) > 1:
+            return self.__scripted_range(bind_elements, start, end,
+                                         min_score, max_score, reverse,
+                                         withscores, operator, ttl,
+                                         aggregate, thread_local)
+        attempt = 0
+        while True:
+            key_hash, cache_created, size = self.__build(
+                bind_elements, operator, aggregate, False, thread_local)
+            if cache_created and size == 0:
+                # built just now, and really empty
+                self.__release(key_hash, cache_created, ttl)
+                return []
+            result, exists = self.__read_range(key_hash, start, end,
+                                               min_score, max_score, reverse,
+                                               withscores)
+            self.__release(key_hash, cache_created, ttl)
+            if result or exists or len(bind_elements) < 2 or thread_local:
+                # thread local caches are never expired by other queries
+                return result
+            if attempt >= retries:
+                break
+            # the cache existed, or was built non-empty, but expired before
+            # the read
+            log.info('Caught race condition. Retrying ZSET Fetch...')
+            self.stats['range_retries'] += 1
+            attempt += 1
+        # an empty result may still be a race, so compute it once more into
+        # a key private to this thread, which nothing else can expire
+        self.stats['range_fallbacks'] += 1
+        key_hash, _, _ = self.__build(bind_elements, operator, aggregate, True,
+                                      True)
+        result, _ = self.__read_range(key_hash, start, end, min_score,
+                                      max_score, reverse, withscores)
+        self._redis_conn.delete(key_hash)
+        if result:
+            self.stats['range_races'] += 1
+        return result
+
+    def __read_range(self, key_hash, start, end, min_score, max_score,
+                     reverse, withscores):
+        """Read the requested slice of key_hash, and whether key_hash exists,
+        atomically; a missing key means the result cannot be trusted to be
+        empty
+        """
+        pipe = self._redis_conn.pipeline()
         if min_score or max_score:
             limit = None
             offset = None
@@ -174,51 +596,32 @@ class SetTheory(object):
                 offset = start
                 # add 1 to make limit work inclusively like start and end
                 limit = end - start + 1
-            log.debug("fetching scores %s to %s from %s of (%s) "
+            log.debug("fetching scores %s to %s from (%s) "
                       "limit: %s offset: %s reverse: %s",
-                      min_score, max_score, operator, key_hash, limit, offset,
-                      reverse)
+                      min_score, max_score, key_hash, limit, offset, reverse)
             if reverse:
                 # NB: revrange expects max first, range expects min first
-                result = \
-                    self._redis_conn.zrevrangebyscore(key_hash, max_score,
-                                                      min_score,
-                                                      start=offset,
-                                                      num=limit,
-                                                      withscores=withscores)
+                pipe.zrevrangebyscore(key_hash, max_score, min_score,
+                                      start=offset, num=limit,
+                                      withscores=withscores)
             else:
-                result = self._redis_conn.zrangebyscore(key_hash, min_score,
-                                                        max_score,
-                                                        start=offset,
-                                                        num=limit,
-                                                        withscores=withscores)
+                pipe.zrangebyscore(key_hash, min_score, max_score,
+                                   start=offset, num=limit,
+                                   withscores=withscores)
         else:
-            log.debug("fetching %s to %s from %s of (%s) reverse: %s", start,
-                      end, operator, key_hash, reverse)
+            log.debug("fetching %s to %s from (%s) reverse: %s", start, end,
+                      key_hash, reverse)
             if reverse:
-                result = self._redis_conn.zrevrange(key_hash, start, end,
-                                                    withscores=withscores)
-            else:
-                result = self._redis_conn.zrange(key_hash, start, end,
-                                                 withscores=withscores)
-            log.debug("found %d entries", len(result))
-        if len(bind_elements) > 1 and not result:
-            # at this point we know that the key has expired since we last
-            # checked
-            if retries <= 0:
-                log.warn('Exceeded maximum number of retries for zset_fetch.')
+                pipe.zrevrange(key_hash, start, end, withscores=withscores)
             else:
-                log.info('Caught race condition. Retrying ZSET Fetch...')
-                retries -= 1
-                log.debug('zset_range vars: %s', vars())
-                return self.zset_range(bind_elements, start=start, end=end,
-                                       min_score=min_score,
-                                       max_score=max_score,
-                                       reverse=reverse, withscores=withscores,
-                                       operator=operator, ttl=ttl,
-                                       aggregate=aggregate,
-                                       retries=retries - 1,
-                                       thread_local=thread_local)
+                pipe.zrange(key_hash, start, end, withscores=withscores)
+        pipe.exists(key_hash)
+        result, exists = pipe.execute()
+        log.debug("found %d entries", len(result))
+        return result, exists
+
+    def __release(self, key_hash, cache_created, ttl):
+        """Delete or expire a cache created for a query, as its ttl says"""
         if cache_created:
             if not ttl:
                 log.debug("no ttl, removing temp store")
@@ -226,6 +629,155 @@ class SetTheory(object):
             else:
                 log.debug("setting ttl on %s to %d seconds", key_hash, ttl)
                 self._redis_conn.expire(key_hash, min(ttl, MAX_CACHE_SECONDS))
+
+    def __scripted_range(self, bind_elements, start, end, min_score,
+                         max_score, reverse, withscores, operator, ttl,
+                         aggregate, thread_local):
+        """zset_range in a single round trip, with RANGE_SCRIPT"""
+        keys = _weighted_keys(bind_elements)
+        key_hash = build_key_hash(keys, operator, thread_local,
+                                  hashed=self._hash_keys)
+        expression = ''
+        if self._record_expressions:
+            expression = build_expression(keys, operator)
+        by_score = bool(min_score or max_score)
+        if by_score:
+            first, last = '', ''
+            if start != 0 or end != -1:
+                # 0, -1 is a special case meaning "the whole set"
+                first, last = start, end - start + 1
+            if min_score is None:
+                min_score = '-inf'
+            if max_score is None:
+                max_score = '+inf'
+        else:
+            first, last = start, end
+            min_score, max_score = '', ''
+        log.debug("running scripted range %s to %s of (%s) scores %s to %s "
+                  "reverse: %s", start, end, key_hash, min_score, max_score,
+                  reverse)
+        result = self._scripts.run(
+            'set_theory.range',
+            keys=[key_hash, key_hash + EXPRESSION_SUFFIX] +
+            [k.key for k in keys],
+            args=[operator, aggregate, ttl or 0, MAX_CACHE_SECONDS, 0,
+                  expression, int(by_score), int(bool(reverse)),
+                  int(bool(withscores)), first, last, min_score, max_score] +
+            [k.weight for k in keys])
+        if withscores:
+            result = [(member, float(score)) for member, score in
+                      zip(result[::2], result[1::2])]
+        log.debug("found %d entries", len(result))
+        return result
+
+    def expression_cache(self, expression, cachebust=False):
+        """Store the result of a SetExpression in redis, under the hash of its
+        canonical text, reusing any of its subexpressions already cached (by
+        this or any other query).  One pipelined round trip checks which are
+        cached, and one transaction builds the missing ones, each with one
+        ZUNIONSTORE, ZINTERSTORE or ZDIFFSTORE.  Returns a tuple of the key
+        holding the result and whether it was built, like zset_cache; every
+        cache built lives for MAX_CACHE_SECONDS.
+
+        :param expression: a SetExpression, or a plain key name
+        :param cachebust: rebuild every subexpression, even if cached
+        """
+        steps = OrderedDict()
+        key_hash = self.__plan(expression, steps)
+        if key_hash not in steps:
+            return key_hash, False
+        fresh = set()
+        if not cachebust:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for key in steps:
+                pipe.pttl(key)
+            fresh = set(key for key, pttl in zip(steps, pipe.execute())
+                        if pttl == -1 or pttl >= MIN_REUSE_SECONDS * 1000)
+        if key_hash in fresh:
+            log.debug("expression cached at %s", key_hash)
+            self.stats['expression_hits'] += 1
+            return key_hash, False
+        # steps come after the steps they depend on, so walk back from the
+        # result to find which are needed and not cached
+        build = set([key_hash])
+        for key in reversed(steps):
+            if key in build:
+                build.update(source for source in steps[key].sources
+                             if source in steps and source not in fresh)
+        reused = set(source for key in build for source in steps[key].sources
+                     if source in fresh)
+        log.debug("building %d subexpressions of %s, reusing %d",
+                  len(build), key_hash, len(reused))
+        pipe = self._redis_conn.pipeline()
+        for key, step in steps.items():
+            if key not in build:
+                continue
+            args = [key, len(step.sources)] + step.sources
+            if step.weights:
+                args += ['WEIGHTS'] + step.weights
+                args += ['AGGREGATE', step.aggregate.upper()]
+            pipe.execute_command(step.command, *args)
+            pipe.expire(key, MAX_CACHE_SECONDS)
+            if self._record_expressions:
+                pipe.set(key + EXPRESSION_SUFFIX, step.expression,
+                         ex=MAX_CACHE_SECONDS)
+        pipe.execute()
+        self.stats['expression_builds'] += len(build)
+        self.stats['expression_hits'] += len(reused)
+        return key_hash, True
+
+    def __plan(self, node, steps):
+        """Add the steps building node, after those of its operands, to the
+        steps dict, returning the key that will hold its result
+        """
+        if not isinstance(node, SetExpression):
+            return node
+        expression = node.canonical()
+        key_hash = compress_key("ZCACHE:%s" % expression, self._hash_keys)
+        if key_hash in steps:
+            # shared subexpressions are built once
+            return key_hash
+        if isinstance(node, Difference):
+            first, weight = node.first
+            if weight != 1.0:
+                first = Weighted(first, weight)
+            sources = [self.__plan(first, steps)]
+            sources += [self.__plan(other, steps) for other in node.others]
+            step = _Step('ZDIFFSTORE', sources, [], None, expression)
+        elif isinstance(node, Weighted):
+            step = _Step('ZUNIONSTORE', [self.__plan(node.operand, steps)],
+                         [node.weight], 'max', expression)
+        else:
+            terms = node.terms
+            step = _Step(node.command,
+                         [self.__plan(child, steps) for child, _ in terms],
+                         [weight for _, weight in terms], node.aggregate,
+                         expression)
+        steps[key_hash] = step
+        return key_hash
+
+    def expression_range(self, expression, start=0, end=-1, min_score=None,
+                         max_score=None, reverse=True, withscores=False,
+                         ttl=0):
+        """Return a slice of the result of a SetExpression (see
+        expression_cache), like zset_range.  Cached subexpressions are kept
+        for reuse; the cache of the whole expression is kept for ttl seconds,
+        if it was built by this call.
+        """
+        key_hash, cache_created = self.expression_cache(expression)
+        result, exists = self.__read_range(key_hash, start, end, min_score,
+                                           max_score, reverse, withscores)
+        self.__release(key_hash, cache_created, ttl)
+        if not (result or exists or cache_created) and \
+                isinstance(expression, SetExpression):
+            # the cached result expired before it was read
+            log.info('Caught race condition. Rebuilding expression...')
+            self.stats['expression_retries'] += 1
+            key_hash, cache_created = self.expression_cache(expression,
+                                                            cachebust=True)
+            result, _ = self.__read_range(key_hash, start, end, min_score,
+                                          max_score, reverse, withscores)
+            self.__release(key_hash, cache_created, ttl)
         return result
 
     def zset_fetch(self, bind_elements, start=None, end=None, min_score=None,
@@ -247,9 +799,9 @@ class SetTheory(object):
 
 
         As an extra precaution against race conditions for cached results,
-        zset_fetch can re-call itself up to MAX_RETRIES times to ensure that
-        there are valid values in key_hash. If this threshold is exceeded, we
-        simply return an empty response. -- jp Mon Nov 26 13:12:47 EST 2012
+        zset_fetch re-reads the shared cache up to MAX_RETRIES times when it
+        has expired mid-query, and then computes the result once more into a
+        key private to the thread, so an empty response is really empty.
         """
 
         if start is None and end is None:
@@ -3,29 +3,685 @@ Fast redis backed tool to count unique native_ids per event, using redis bit
 sets
 """
 
+from array import array
+import binascii
+import calendar
+from collections import Counter, deque, namedtuple
 import datetime
-from functools import partial
+import hashlib
+from itertools import compress
 import logging
+import threading
+import time
+
+from redis.exceptions import WatchError
 
 from . import granularity
+from . import scripts
+from .lru import LRUCache
 
 log = logging.getLogger(__name__)
 
 
 BASE_NAMESPACE = 'redis_gadgets'
+BITOP_OPERATORS = ('AND', 'OR', 'XOR', 'AND NOT')
+BITMAP_CHUNK_SIZE = 1024 * 1024  # bytes of bitmap to read per GETRANGE
+COMPACT_ATTEMPTS = 3  # compactions to try before giving up on a busy space
 CURRENT_OFFSET_KEY = "current_offset"
+DEFAULT_BATCH_SIZE = 10000  # events per pipelined batch in track_events
 DEFAULT_NAMESPACE = 'global'
+DEFAULT_OFFSET_BLOCK_SIZE = 10000  # offsets to reserve at a time, if blocked
+DEFAULT_SPARSE_DENSITY = 1.0 / 256  # offset sets beat bitmaps below this
 DEFAULT_TTL = 60 * 10  # 10 minutes
+GENERATION_CHECK_SECONDS = 1  # how often cached offsets are checked
+GENERATION_KEY = "offset_generation"  # bumped by compact
+ID_BATCH_SIZE = 1000  # offsets to resolve per HMGET
+ID_BATCHES_PER_TRIP = 10  # HMGETs to pipeline per round trip
+BUCKET_FORMAT = '%Y-%m-%dT%H:%M:%S'  # isoformat of a bucket, in its key
 TO_OFFSET_KEY = "id_to_offset"
 TO_ID_KEY = "offset_to_id"
 
+# allocate (or look up) the offset for id ARGV[1], given KEYS[1..3] as the
+# TO_OFFSET_KEY, TO_ID_KEY and CURRENT_OFFSET_KEY of a namespace
+_MAP_ID_LUA = """
+    local offset
+    offset = redis.call('hget', KEYS[1], ARGV[1])
+    if not offset then
+        offset = redis.call('incr', KEYS[3]) - 1 -- see map_id_to_offset
+        redis.call('hset', KEYS[1], ARGV[1], offset)
+        redis.call('hset', KEYS[2], offset, ARGV[1])
+    end
+    """
+
+# claim the offset ARGV[2], already reserved by the caller, for id ARGV[1],
+# unless the id has an offset already, with the same KEYS as _MAP_ID_LUA.
+# claimed is 1 if the reserved offset was used.  A reserved offset at or past
+# the counter, or already mapped, was reserved before a compact reset the
+# counter: a new offset is allocated instead, and claimed is -1.
+_CLAIM_ID_LUA = """
+    local claimed = 0
+    local offset = redis.call('hget', KEYS[1], ARGV[1])
+    if not offset then
+        offset = ARGV[2]
+        claimed = 1
+        if tonumber(offset) >= tonumber(redis.call('get', KEYS[3]) or 0) or
+                redis.call('hexists', KEYS[2], offset) == 1 then
+            offset = redis.call('incr', KEYS[3]) - 1
+            claimed = -1
+        end
+        redis.call('hset', KEYS[1], ARGV[1], offset)
+        redis.call('hset', KEYS[2], offset, ARGV[1])
+    end
+    """
+
+# helpers for buckets that may be stored sparse, as sets of offsets, or dense,
+# as bitmaps
+_BUCKET_LUA = """
+    local function slice(list, first, last)
+        local result = {}
+        for i = first, last do
+            result[#result + 1] = list[i]
+        end
+        return result
+    end
+
+    local function count(key)
+        if redis.call('type', key)['ok'] == 'set' then
+            return redis.call('scard', key)
+        end
+        return redis.call('bitcount', key)
+    end
+
+    -- OR any mix of bitmaps and offset sets into a bitmap at target
+    local function bit_or(target, keys)
+        local dense, sparse = {}, {}
+        for _, key in ipairs(keys) do
+            local kind = redis.call('type', key)['ok']
+            if kind == 'set' then
+                sparse[#sparse + 1] = key
+            elseif kind ~= 'none' then
+                dense[#dense + 1] = key
+            end
+        end
+        redis.call('del', target)
+        -- BITOP in chunks, to stay inside lua's unpack limit
+        for i = 1, #dense, 1000 do
+            redis.call('bitop', 'OR', target, target,
+                       unpack(dense, i, math.min(i + 999, #dense)))
+        end
+        for _, key in ipairs(sparse) do
+            for _, offset in ipairs(redis.call('smembers', key)) do
+                redis.call('setbit', target, offset, 1)
+            end
+        end
+    end
+
+    -- set offset in the bucket at key, storing the bucket as a set until it
+    -- holds more than density of the space offsets, then as a bitmap
+    local function mark(key, offset, space, density)
+        if redis.call('type', key)['ok'] == 'string' then
+            redis.call('setbit', key, offset, 1)
+            return
+        end
+        redis.call('sadd', key, offset)
+        if redis.call('scard', key) > space * density then
+            local ttl = redis.call('pttl', key)
+            local offsets = redis.call('smembers', key)
+            redis.call('del', key)
+            for _, member in ipairs(offsets) do
+                redis.call('setbit', key, member, 1)
+            end
+            if ttl > 0 then
+                redis.call('pexpire', key, ttl)
+            end
+        end
+    end
+    """
+
+# give buckets created by a write their retention expiry, so tracking into an
+# existing bucket never pays for it.  The scripts writing to buckets take an
+# optional unix time to EXPIREAT each bucket at, after their other ARGV, in
+# the same order as the bucket KEYS; 0 (or none) means no expiry.
+_EXPIRE_NEW_LUA = """
+    -- call write(), then EXPIREAT the bucket at key at expire_at if write
+    -- created it
+    local function write_new(key, expire_at, write)
+        local new = expire_at and tonumber(expire_at) > 0 and
+            redis.call('exists', key) == 0
+        write()
+        if new then
+            redis.call('expireat', key, expire_at)
+        end
+    end
+    """
+
+MAP_ID_SCRIPT = _MAP_ID_LUA + """
+    return offset
+    """
+
+# MAP_ID_SCRIPT plus setting the bit for the id in the buckets at KEYS[4] and
+# up, so an offset is never allocated without its bits being set
+TRACK_SCRIPT = _MAP_ID_LUA + _EXPIRE_NEW_LUA + """
+    for i = 4, #KEYS do
+        write_new(KEYS[i], ARGV[i - 2], function()
+            redis.call('setbit', KEYS[i], offset, 1)
+        end)
+    end
+    return offset
+    """
+
+# TRACK_SCRIPT for sparse buckets, with ARGV[2] as the density to promote
+# buckets to bitmaps at
+TRACK_SPARSE_SCRIPT = _MAP_ID_LUA + _BUCKET_LUA + _EXPIRE_NEW_LUA + """
+    local space = tonumber(redis.call('get', KEYS[3]))
+    for i = 4, #KEYS do
+        write_new(KEYS[i], ARGV[i - 1], function()
+            mark(KEYS[i], offset, space, tonumber(ARGV[2]))
+        end)
+    end
+    return offset
+    """
+
+# versions of the above for reserved offsets, returning {offset, claimed}
+CLAIM_ID_SCRIPT = _CLAIM_ID_LUA + """
+    return {offset, claimed}
+    """
+
+TRACK_CLAIM_SCRIPT = _CLAIM_ID_LUA + _EXPIRE_NEW_LUA + """
+    for i = 4, #KEYS do
+        write_new(KEYS[i], ARGV[i - 1], function()
+            redis.call('setbit', KEYS[i], offset, 1)
+        end)
+    end
+    return {offset, claimed}
+    """
+
+# with ARGV[3] as the density
+TRACK_SPARSE_CLAIM_SCRIPT = _CLAIM_ID_LUA + _BUCKET_LUA + _EXPIRE_NEW_LUA + """
+    local space = tonumber(redis.call('get', KEYS[3]))
+    for i = 4, #KEYS do
+        write_new(KEYS[i], ARGV[i], function()
+            mark(KEYS[i], offset, space, tonumber(ARGV[3]))
+        end)
+    end
+    return {offset, claimed}
+    """
+
+# set the known offset ARGV[1] in the sparse buckets at KEYS[2] and up, given
+# the CURRENT_OFFSET_KEY at KEYS[1] and the density ARGV[2]
+MARK_SPARSE_SCRIPT = _BUCKET_LUA + _EXPIRE_NEW_LUA + """
+    local space = tonumber(redis.call('get', KEYS[1]))
+    for i = 2, #KEYS do
+        write_new(KEYS[i], ARGV[i + 1], function()
+            mark(KEYS[i], ARGV[1], space, tonumber(ARGV[2]))
+        end)
+    end
+    """
+
+# set the known offset ARGV[1] in the bitmap buckets at KEYS, for buckets
+# with a retention expiry
+SET_BITS_SCRIPT = _EXPIRE_NEW_LUA + """
+    for i = 1, #KEYS do
+        write_new(KEYS[i], ARGV[i + 1], function()
+            redis.call('setbit', KEYS[i], ARGV[1], 1)
+        end)
+    end
+    """
+
+# count the bucket at KEYS[1], however it is stored
+COUNT_SCRIPT = _BUCKET_LUA + """
+    return count(KEYS[1])
+    """
+
+# OR the buckets at KEYS[2] and up into a bitmap at KEYS[1]
+BIT_OR_SCRIPT = _BUCKET_LUA + """
+    bit_or(KEYS[1], slice(KEYS, 2, #KEYS))
+    """
+
+# Count the OR of a date range, cached at KEYS[1] for ARGV[1] seconds, in one
+# atomic step: concurrent identical queries wait on the first and then read
+# its cached result.  The rest of KEYS are groups, each a key to OR into the
+# result followed by ARGV[i + 1] source keys to (re)build it from if it is
+# missing, e.g. a cached segment; groups with no sources are read as they are.
+OR_COUNT_SCRIPT = _BUCKET_LUA + """
+    local ttl = tonumber(ARGV[1])
+    if redis.call('exists', KEYS[1]) == 1 then
+        return {redis.call('bitcount', KEYS[1]), 1, 0, 0}
+    end
+    local sources = {}
+    local hits, misses = 0, 0
+    local index = 2
+    for i = 2, #ARGV do
+        local key = KEYS[index]
+        local size = tonumber(ARGV[i])
+        if size > 0 then
+            if redis.call('exists', key) == 1 then
+                hits = hits + 1
+            else
+                bit_or(key, slice(KEYS, index + 1, index + size))
+                redis.call('expire', key, ttl)
+                misses = misses + 1
+            end
+        end
+        sources[#sources + 1] = key
+        index = index + size + 1
+    end
+    bit_or(KEYS[1], sources)
+    local result = redis.call('bitcount', KEYS[1])
+    if ttl > 0 then
+        redis.call('expire', KEYS[1], ttl)
+    else
+        redis.call('del', KEYS[1])
+    end
+    return {result, 0, hits, misses}
+    """
+
+# Combine operands with the bitwise operator ARGV[2] into KEYS[1], cached for
+# ARGV[1] seconds, using KEYS[2] as a prefix for temporary keys.  Operands are
+# given as groups, like OR_COUNT_SCRIPT, each a key optionally followed by
+# ARGV[i + 1] source keys to OR into it if it is missing.
+BITOP_SCRIPT = _BUCKET_LUA + """
+    local ttl = tonumber(ARGV[1])
+    if redis.call('exists', KEYS[1]) == 1 then
+        return {redis.call('bitcount', KEYS[1]), 1}
+    end
+    local operands, temps = {}, {}
+    local index = 3
+    for i = 3, #ARGV do
+        local key = KEYS[index]
+        local size = tonumber(ARGV[i])
+        if size > 0 then
+            if redis.call('exists', key) == 0 then
+                bit_or(key, slice(KEYS, index + 1, index + size))
+                if ttl > 0 then
+                    redis.call('expire', key, ttl)
+                else
+                    temps[#temps + 1] = key
+                end
+            end
+        elseif redis.call('type', key)['ok'] == 'set' then
+            local temp = KEYS[2] .. ':' .. i
+            bit_or(temp, {key})
+            temps[#temps + 1] = temp
+            key = temp
+        end
+        operands[#operands + 1] = key
+        index = index + size + 1
+    end
+    if ARGV[2] == 'AND NOT' then
+        -- BITOP NOT would flip the zero padding of shorter bitmaps, so use
+        -- A AND NOT B == A XOR (A AND B)
+        local temp = KEYS[2]
+        temps[#temps + 1] = temp
+        if #operands > 2 then
+            redis.call('bitop', 'OR', temp, unpack(operands, 2))
+            redis.call('bitop', 'AND', temp, operands[1], temp)
+        else
+            redis.call('bitop', 'AND', temp, operands[1], operands[2])
+        end
+        redis.call('bitop', 'XOR', KEYS[1], operands[1], temp)
+    else
+        redis.call('bitop', ARGV[2], KEYS[1], unpack(operands))
+    end
+    if #temps > 0 then
+        redis.call('del', unpack(temps))
+    end
+    local result = redis.call('bitcount', KEYS[1])
+    if ttl > 0 then
+        redis.call('expire', KEYS[1], ttl)
+    else
+        redis.call('del', KEYS[1])
+    end
+    return {result, 0}
+    """
+
+# EXPIREAT each of KEYS at the time in the ARGV at the same index, unless it
+# has an expiry already (or does not exist), returning how many were set
+EXPIRE_NEW_SCRIPT = """
+    local count = 0
+    for i = 1, #KEYS do
+        if redis.call('ttl', KEYS[i]) == -1 then
+            redis.call('expireat', KEYS[i], ARGV[i])
+            count = count + 1
+        end
+    end
+    return count
+    """
+
+# the bit offsets (most significant bit first, as redis numbers them) set in
+# each possible byte value
+_SET_BITS = tuple(tuple(bit for bit in range(8) if byte & (0x80 >> bit))
+                  for byte in range(256))
+_ZERO_BLOCK = bytes(bytearray(64))
+_POPCOUNT = tuple(len(bits) for bits in _SET_BITS)
+# translate tables from each byte to its popcount, and from the characters of
+# a _bit_string to 0 or 1
+_POPCOUNT_TABLE = bytes(bytearray(_POPCOUNT))
+_SELECT_TABLE = bytes(bytearray(int(byte == ord('1')) for byte in range(256)))
+_RANK_BLOCK = 64  # bytes per cumulative count in a _RankIndex
+
+scripts.define('unique_count.map_id', MAP_ID_SCRIPT)
+scripts.define('unique_count.track', TRACK_SCRIPT)
+scripts.define('unique_count.track_sparse', TRACK_SPARSE_SCRIPT)
+scripts.define('unique_count.claim_id', CLAIM_ID_SCRIPT)
+scripts.define('unique_count.track_claim', TRACK_CLAIM_SCRIPT)
+scripts.define('unique_count.track_sparse_claim', TRACK_SPARSE_CLAIM_SCRIPT)
+scripts.define('unique_count.mark_sparse', MARK_SPARSE_SCRIPT)
+scripts.define('unique_count.set_bits', SET_BITS_SCRIPT)
+scripts.define('unique_count.count', COUNT_SCRIPT)
+scripts.define('unique_count.bit_or', BIT_OR_SCRIPT)
+scripts.define('unique_count.or_count', OR_COUNT_SCRIPT)
+scripts.define('unique_count.bitop', BITOP_SCRIPT)
+scripts.define('unique_count.expire_new', EXPIRE_NEW_SCRIPT)
+
+TrackedEvent = namedtuple('TrackedEvent',
+                          'event native_id event_time namespace')
+TrackedEvent.__new__.__defaults__ = (None, DEFAULT_NAMESPACE)
+
+BatchStats = namedtuple('BatchStats', 'events new_ids existing_ids')
+
+CountQuery = namedtuple('CountQuery', 'event start_date end_date namespace')
+CountQuery.__new__.__defaults__ = (DEFAULT_NAMESPACE,)
+
+CompactionStats = namedtuple('CompactionStats', 'ids retired_ids keys')
+
+
+def iter_set_bits(data, base_offset=0):
+    """Yield the offsets of the bits set in a redis bitmap, in order.  Runs of
+    zero bytes are skipped a block at a time, and set bits are found a byte at
+    a time from a lookup table.
+
+    :param data: the bitmap (or a chunk of it), as returned by GET/GETRANGE
+    :param base_offset: bit offset of the first bit in data
+    :rtype: iterator
+    """
+    data = bytearray(data)
+    block_size = len(_ZERO_BLOCK)
+    for block_start in range(0, len(data), block_size):
+        block = data[block_start:block_start + block_size]
+        if block == _ZERO_BLOCK:
+            continue
+        for index, byte in enumerate(block, start=block_start):
+            if byte:
+                offset = base_offset + index * 8
+                for bit in _SET_BITS[byte]:
+                    yield offset + bit
+
+
+def _as_str(value):
+    """Return a key name or reply from redis as text"""
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return value
+
+
+def _to_bitmap(offsets):
+    """Return a bitmap, as redis would store it, with the given offsets set"""
+    bitmap = bytearray()
+    for offset in offsets:
+        index = offset // 8
+        if index >= len(bitmap):
+            bitmap.extend(bytearray(index + 1 - len(bitmap)))
+        bitmap[index] |= 0x80 >> (offset % 8)
+    return bytes(bitmap)
+
+
+def load_ids(fileobj):
+    """Read a file written by RedisUniqueCount.export_ids into a list of ids
+    by offset, with None for offsets with no id, e.g. to pass to
+    get_ids_for_event as its id_lookup
+
+    :param fileobj: binary file to read
+    :rtype: list
+    """
+    return [line.rstrip(b'\n') or None for line in fileobj]
+
+
+def _expire_at(bucket_func, bucket, retention):
+    """Return the unix time a bucket expires at: retention after it ends
+    """
+    end = granularity.next_bucket(bucket_func, bucket)
+    return (calendar.timegm(end.utctimetuple()) +
+            int(retention.total_seconds()))
+
+
+def _expiry_args(bucket_keys, expiries):
+    """Return the script ARGV expiring each of bucket_keys per expiries (a
+    {key: unix time} dict, from _make_expiries), or none if none expire
+    """
+    if not expiries:
+        return []
+    return [expiries.get(key, 0) for key in bucket_keys]
+
+
+def _bucket_index(bucket, step):
+    """Number the buckets of a fixed step granularity, consecutively, from the
+    unix epoch
+    """
+    seconds = calendar.timegm(bucket.utctimetuple())
+    step_seconds = step.days * 86400 + step.seconds
+    return seconds // step_seconds
+
+
+class BitmapScanner(object):
+
+    """Walk a (possibly huge) bitmap key in fixed size GETRANGE windows,
+    yielding the offsets of its set bits in order, so that no more than a
+    window or two of the bitmap is ever held in memory.
+
+    All-zero regions are skipped without being read: every round trip reads
+    one window and asks BITPOS where the next set bit after it is, and the
+    next window starts at the byte holding that bit.  With prefetch, the next
+    window is read in a background thread while the current one is decoded.
+    """
+
+    def __init__(self, redis_conn, key, window_size=BITMAP_CHUNK_SIZE,
+                 prefetch=False):
+        """
+        :param redis_conn: Redis connection to read from
+        :param key: bitmap key to scan
+        :param window_size: number of bytes to read per GETRANGE
+        :type window_size: int
+        :param prefetch: read the next window while decoding the current one
+        :type prefetch: bool
+        """
+        if window_size < 1:
+            raise ValueError("window_size must be at least 1")
+        self._redis_conn = redis_conn
+        self._key = key
+        self._window_size = window_size
+        self._prefetch = prefetch
+
+    def __iter__(self):
+        first_bit = self._redis_conn.bitpos(self._key, 1)
+        if first_bit < 0:
+            return
+        start = first_bit // 8
+        window = self.__read_window(start)
+        while window is not None:
+            data, next_bit = window
+            pending = None
+            if next_bit >= 0 and self._prefetch:
+                pending = _Prefetch(self.__read_window, next_bit // 8)
+            for offset in iter_set_bits(data, start * 8):
+                yield offset
+            if next_bit < 0:
+                break
+            start = next_bit // 8
+            if pending is None:
+                window = self.__read_window(start)
+            else:
+                window = pending.result()
+
+    def __read_window(self, start):
+        """Return the window of bytes at start, and the offset of the first
+        set bit after it (or -1 if there is none)
+        """
+        end = start + self._window_size
+        pipe = self._redis_conn.pipeline(transaction=False)
+        pipe.getrange(self._key, start, end - 1)
+        pipe.bitpos(self._key, 1, end)
+        data, next_bit = pipe.execute()
+        log.debug("read %d bytes of %s at %d, next bit at %s", len(data),
+                  self._key, start, next_bit)
+        return data, next_bit
+
+
+class _RankIndex(object):
+
+    """Ranks of the set bits of a bitmap held in process: the rank of a set
+    bit is the number of set bits before it.  Cumulative counts are kept per
+    _RANK_BLOCK bytes, from a table translation of the bitmap into per byte
+    popcounts, so neither building the index nor a lookup walks single bits.
+    """
+
+    def __init__(self, bitmap):
+        """
+        :param bitmap: bitmap to rank the bits of
+        :type bitmap: bytearray
+        """
+        self._bitmap = bitmap
+        self._counts = bitmap.translate(_POPCOUNT_TABLE)
+        self._block_ranks = array('L')
+        total = 0
+        for start in range(0, len(bitmap), _RANK_BLOCK):
+            self._block_ranks.append(total)
+            total += sum(self._counts[start:start + _RANK_BLOCK])
+        self.size = total
+
+    def rank(self, offset):
+        """Return the number of set bits before offset"""
+        index = offset // 8
+        rank = self._block_ranks[index // _RANK_BLOCK]
+        rank += sum(self._counts[index - index % _RANK_BLOCK:index])
+        return rank + _POPCOUNT[self._bitmap[index] >> (8 - offset % 8)]
+
+
+def _bit_string(data):
+    """Return the bits of data as a string of '0's and '1's, most significant
+    (lowest offset) first
+    """
+    if not data:
+        return ''
+    return bin(int(binascii.hexlify(bytes(data)), 16))[2:].zfill(
+        len(data) * 8)
+
+
+def _from_bit_string(bits):
+    """Return the bytes of a string of '0's and '1's as long as a whole
+    number of bytes
+    """
+    if not bits:
+        return b''
+    return binascii.unhexlify('%0*x' % (len(bits) // 4, int(bits, 2)))
+
+
+def _or_into(bitmap, start, data):
+    """OR the bytes of data into the bytearray bitmap at byte start, dropping
+    any that would go past its end
+    """
+    data = bytes(data[:max(len(bitmap) - start, 0)])
+    if not data:
+        return
+    end = start + len(data)
+    value = (int(binascii.hexlify(bytes(bitmap[start:end])), 16) |
+             int(binascii.hexlify(data), 16))
+    bitmap[start:end] = binascii.unhexlify('%0*x' % (len(data) * 2, value))
+
+
+def _extract_bits(data, mask):
+    """Return, as a bit string, the bits of data at the bits set in mask, in
+    order: the bits of a bitmap renumbered to the ranks of the mask's bits
+    """
+    selectors = bytearray(_bit_string(mask).encode('ascii')).translate(
+        _SELECT_TABLE)
+    return ''.join(compress(_bit_string(data), selectors))
+
+
+class _OffsetBlocks(object):
+
+    """Offsets reserved from CURRENT_OFFSET_KEYs a block at a time, with one
+    INCRBY, and handed out in process.  Reserved offsets are only used once
+    they are claimed for an id, so the ones not used when the process exits
+    are left as holes in the offset space.  Blocks reserved before a compact
+    are stale: claiming their offsets falls back to allocating new ones, and
+    the block is cleared.
+    """
+
+    def __init__(self, redis_conn, block_size):
+        """
+        :param redis_conn: Redis connection to reserve blocks on
+        :param block_size: number of offsets to reserve at a time
+        :type block_size: int
+        """
+        if block_size < 1:
+            raise ValueError("block_size must be at least 1")
+        self._redis_conn = redis_conn
+        self._block_size = block_size
+        self._free = {}
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Return a reserved offset from the counter at key, reserving a new
+        block if none are left
+        """
+        with self._lock:
+            free = self._free.get(key)
+            if not free:
+                end = self._redis_conn.incrby(key, self._block_size)
+                log.debug("reserved offsets %d to %d of %s",
+                          end - self._block_size, end - 1, key)
+                free = deque(range(end - self._block_size, end))
+                self._free[key] = free
+            return free.popleft()
+
+    def give_back(self, key, offset):
+        """Return an offset that was taken but not claimed, to be reused"""
+        with self._lock:
+            self._free.setdefault(key, deque()).appendleft(offset)
+
+    def clear(self, key):
+        """Forget the offsets reserved from the counter at key"""
+        with self._lock:
+            self._free.pop(key, None)
+
+
+class _Prefetch(threading.Thread):
+
+    """Call a function in the background, keeping the result for later"""
+
+    def __init__(self, func, *args):
+        super(_Prefetch, self).__init__()
+        self.daemon = True
+        self._func = func
+        self._args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args)
+        except Exception as error:
+            self._error = error
+
+    def result(self):
+        """Wait for the call to finish, and return its result"""
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
 
 class RedisUniqueCount(object):
 
     """Track unique counts using redis bit strings"""
 
     def __init__(self, redis_conn, namespace_deliminator=':',
-                 bitop_ttl=DEFAULT_TTL, bucket_func=None):
+                 bitop_ttl=DEFAULT_TTL, bucket_func=None,
+                 offset_cache_size=0, rollups=(), rollup_on_write=True,
+                 segment_cache=False, sparse_density=None, approximate=(),
+                 offset_block_size=0, hash_tags=False, retention=None):
         """Bind a counter to a redis connection
 
         :param redis_conn: Redis connection to operate on
@@ -34,16 +690,187 @@ class RedisUniqueCount(object):
         :param bucket_func: Function to generate the datetime "bucket" for a
                             given event, from a arbitrary precision date time.
                             See (and use) examples from the granularity module.
+        :param offset_cache_size: if set, keep up to this many id to offset
+                                  (and offset to id) mappings in process, in
+                                  LRU caches.  Offsets only change when a
+                                  namespace is compacted, which bumps its
+                                  GENERATION_KEY; cached mappings (and
+                                  reserved offset blocks) are checked against
+                                  it every GENERATION_CHECK_SECONDS, and
+                                  dropped once it changes.
+        :type offset_cache_size: int
+        :param rollups: coarser granularities, finest first, to keep
+                        pre-aggregated bitmaps for (e.g. daily, weekly and
+                        monthly rollups of hourly buckets).  get_count reads
+                        whole rollup buckets in place of all the buckets they
+                        cover.
+        :param rollup_on_write: set rollup bits as events are tracked.  If
+                                false, rollups are built after the fact by
+                                build_rollups, and get_count falls back to
+                                finer buckets for rollups not built yet.
+        :type rollup_on_write: bool
+        :param segment_cache: split get_count ranges into power of two sized
+                              runs of buckets, aligned on bucket boundaries,
+                              and cache the OR of each run, so that
+                              overlapping ranges (e.g. a sliding window) share
+                              most of their work.  Only used for granularities
+                              with a fixed step, and a non-zero bitop_ttl.
+        :type segment_cache: bool
+        :param sparse_density: if set, store buckets as sets of offsets until
+                               more than this fraction of the namespace's
+                               offsets are in them, and then as bitmaps, so
+                               that rare events do not cost a full size bitmap
+                               per bucket (DEFAULT_SPARSE_DENSITY is a good
+                               start).  Counts and rollups work across both
+                               representations.
+        :type sparse_density: float
+        :param approximate: namespaces, or (namespace, event) pairs, to count
+                            approximately, in HyperLogLogs instead of bitmaps.
+                            Their ids are never mapped to offsets, each bucket
+                            takes at most 12KB, and counts have a standard
+                            error of 0.81%, but the ids cannot be recovered
+                            and they cannot be used in bitops.
+        :param offset_block_size: if set, reserve offsets for new ids this many
+                                  at a time (DEFAULT_OFFSET_BLOCK_SIZE is a
+                                  good start), instead of incrementing the
+                                  namespace's offset counter for every new id,
+                                  so that concurrent writers do not contend on
+                                  it.  Offsets left unused when the counter is
+                                  discarded are never used; compact reclaims
+                                  them.
+        :type offset_block_size: int
+        :param hash_tags: wrap namespaces in hash tags, e.g.
+                          redis_gadgets:{global}:event, so that all the keys of
+                          a namespace are in one redis cluster slot and the
+                          scripts touching several of them work on a cluster.
+        :type hash_tags: bool
+        :param retention: how long to keep the buckets of each granularity
+                          (the bucket_func or a rollup) after they end, e.g.
+                          ``{granularity.hourly: timedelta(days=30)}``.
+                          Buckets are given an expiry when they are created,
+                          and apply_retention expires existing ones.
+                          Granularities not in the policy are kept forever.
+        :type retention: dict
+
+        Hits and misses of the BITOP caches are counted in the ``stats``
+        Counter, as range_hits/range_misses for whole ranges, and
+        segment_hits/segment_misses for segments.
 
         """
         self._redis_conn = redis_conn
+        self._scripts = scripts.for_connection(redis_conn)
         self._namespace_deliminator = namespace_deliminator
         self._bitop_ttl = bitop_ttl
         if not bucket_func:
             bucket_func = granularity.daily
         self.bucket_func = bucket_func
+        if bucket_func in rollups:
+            raise ValueError("rollups must be coarser than bucket_func")
+        self._rollups = tuple(rollups)
+        self._rollup_on_write = rollup_on_write
+        self._segment_cache = segment_cache
+        self._sparse_density = sparse_density
+        self._approximate = frozenset(approximate)
+        self._hash_tags = hash_tags
+        self._retention = dict(retention or {})
+        self._offset_blocks = None
+        if offset_block_size:
+            self._offset_blocks = _OffsetBlocks(redis_conn, offset_block_size)
+        self.stats = Counter()
+        self._offset_cache = None
+        self._id_cache = None
+        if offset_cache_size:
+            self._offset_cache = LRUCache(offset_cache_size)
+            self._id_cache = LRUCache(offset_cache_size)
+        self._generations = {}  # namespace: (generation, time checked)
+
+    def cache_stats(self):
+        """Return the hit, miss and eviction counts of the offset caches, or
+        None if caching is disabled
+
+        :returns: CacheStats for the 'id_to_offset' and 'offset_to_id' caches
+        :rtype: dict
+        """
+        if self._offset_cache is None:
+            return None
+        return {TO_OFFSET_KEY: self._offset_cache.stats(),
+                TO_ID_KEY: self._id_cache.stats()}
+
+    def _generation_key(self, namespace):
+        """Return the GENERATION_KEY of a namespace if the offsets cached and
+        reserved for it are due to be checked against it, or None
+        """
+        if self._offset_cache is None and self._offset_blocks is None:
+            return None
+        checked = self._generations.get(namespace)
+        if checked and time.time() - checked[1] < GENERATION_CHECK_SECONDS:
+            return None
+        return self.add_namespace(namespace, GENERATION_KEY)
+
+    def _note_generation(self, namespace, generation):
+        """Record the generation read from a namespace's GENERATION_KEY,
+        dropping the offsets cached and reserved for it if it was compacted
+        since they were
+        """
+        generation = int(generation or 0)
+        checked = self._generations.get(namespace)
+        if checked and checked[0] != generation:
+            log.info("%s was compacted, dropping its cached offsets",
+                     namespace)
+            self.__drop_offsets(namespace)
+        self._generations[namespace] = (generation, time.time())
+
+    def _check_generation(self, namespace):
+        """Drop the offsets cached and reserved for a namespace if it was
+        compacted since they were, checking at most every
+        GENERATION_CHECK_SECONDS
+        """
+        key = self._generation_key(namespace)
+        if key is not None:
+            self._note_generation(namespace, self._redis_conn.get(key))
+
+    def __drop_offsets(self, namespace):
+        """Forget the offsets cached and reserved for a namespace"""
+        if self._offset_cache is not None:
+            self._offset_cache.clear()
+            self._id_cache.clear()
+        if self._offset_blocks is not None:
+            self._offset_blocks.clear(
+                self.add_namespace(namespace, CURRENT_OFFSET_KEY))
+
+    def _cached_offset(self, native_id, namespace):
+        """Return the cached offset for native_id, or None"""
+        if self._offset_cache is None:
+            return None
+        return self._offset_cache.get((namespace, native_id))
+
+    def _cache_offset(self, native_id, namespace, offset):
+        """Remember the offset allocated to native_id"""
+        if self._offset_cache is not None:
+            self._offset_cache.put((namespace, native_id), int(offset))
+
+    def _cached_id(self, offset, namespace):
+        """Return the cached id for offset, or None"""
+        if self._id_cache is None:
+            return None
+        return self._id_cache.get((namespace, offset))
+
+    def _cache_id(self, offset, namespace, native_id):
+        """Remember the id found at offset, if any"""
+        if native_id is not None and self._id_cache is not None:
+            self._id_cache.put((namespace, offset), native_id)
+
+    def is_approximate(self, event, namespace=DEFAULT_NAMESPACE):
+        """Return whether the event is counted in HyperLogLogs
+
+        :rtype: bool
+        """
+        return (namespace in self._approximate or
+                (namespace, event) in self._approximate)
 
     def add_namespace(self, namespace, key):
+        if self._hash_tags:
+            namespace = '{%s}' % namespace
         key_components = [BASE_NAMESPACE, namespace, key]
         return self._namespace_deliminator.join(key_components)
 
@@ -53,55 +880,492 @@ class RedisUniqueCount(object):
         ..note::
             we subtract 1 from Redis to prevent off by 1 errors.
         """
-        script = self._redis_conn.register_script("""
-                local offset
-                offset = redis.call('hget', KEYS[1], ARGV[1])
-                if not offset then
-                    offset = redis.call('incr', KEYS[3]) - 1 -- see docstring
-                    redis.call('hset', KEYS[1], ARGV[1], offset)
-                    redis.call('hset', KEYS[2], offset, ARGV[1])
-                end
-                return offset
-                """)
-        markup = partial(self.add_namespace, namespace)
-        keys = map(markup, (TO_OFFSET_KEY, TO_ID_KEY, CURRENT_OFFSET_KEY))
-        offset = int(script(keys=keys, args=(native_id,)))
+        self._check_generation(namespace)
+        offset = self._cached_offset(native_id, namespace)
+        if offset is not None:
+            return offset
+        keys = self._make_offset_keys(namespace)
+        if self._offset_blocks is None:
+            offset = int(self._scripts.run('unique_count.map_id', keys=keys,
+                                           args=(native_id,)))
+        else:
+            proposed = self._offset_blocks.take(keys[2])
+            result = self._scripts.run('unique_count.claim_id', keys=keys,
+                                       args=(native_id, proposed))
+            offset = self._claimed_offset(result, keys[2], proposed)
         log.debug("redis returned offset %s for id %s", offset, native_id)
+        self._cache_offset(native_id, namespace, offset)
         return offset
 
+    def _claimed_offset(self, result, counter_key, proposed):
+        """Return the offset from a claim script result, giving the proposed
+        offset back if the id turned out to have one already, or dropping the
+        rest of its block if it was reserved before a compact
+        """
+        offset, claimed = result
+        if int(claimed) == 0:
+            self._offset_blocks.give_back(counter_key, proposed)
+        elif int(claimed) < 0:
+            log.info("offset %s of %s was reserved before a compact",
+                     proposed, counter_key)
+            self._offset_blocks.clear(counter_key)
+        return int(offset)
+
+    def _make_offset_keys(self, namespace):
+        """generate the keys used by MAP_ID_SCRIPT for a given namespace
+        """
+        return [self.add_namespace(namespace, key)
+                for key in (TO_OFFSET_KEY, TO_ID_KEY, CURRENT_OFFSET_KEY)]
+
     def map_offset_to_id(self, offset, namespace=DEFAULT_NAMESPACE):
         """Get the id for the given offset.  We need namepsace here since
         different object types all have diferent bit sequences, to keep them
         compact.
         """
+        self._check_generation(namespace)
+        native_id = self._cached_id(offset, namespace)
+        if native_id is not None:
+            return native_id
         key = self.add_namespace(namespace, TO_ID_KEY)
         native_id = self._redis_conn.hget(key, offset)
+        self._cache_id(offset, namespace, native_id)
         return native_id
 
-    def __make_day_key(self, event, event_date, namespace=DEFAULT_NAMESPACE):
+    def map_offsets_to_ids(self, offsets, namespace=DEFAULT_NAMESPACE):
+        """Get the ids for many offsets, with one HMGET per ID_BATCH_SIZE
+        offsets, pipelined ID_BATCHES_PER_TRIP at a time.  Offsets with no id
+        map to None.
+
+        :rtype: list
+        """
+        self._check_generation(namespace)
+        offsets = list(offsets)
+        native_ids = [None] * len(offsets)
+        missing = []
+        for index, offset in enumerate(offsets):
+            native_ids[index] = self._cached_id(offset, namespace)
+            if native_ids[index] is None:
+                missing.append(index)
+        key = self.add_namespace(namespace, TO_ID_KEY)
+        trip_size = ID_BATCH_SIZE * ID_BATCHES_PER_TRIP
+        for trip_start in range(0, len(missing), trip_size):
+            trip = missing[trip_start:trip_start + trip_size]
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for batch_start in range(0, len(trip), ID_BATCH_SIZE):
+                batch = trip[batch_start:batch_start + ID_BATCH_SIZE]
+                pipe.hmget(key, [offsets[i] for i in batch])
+            found = [native_id for batch in pipe.execute()
+                     for native_id in batch]
+            for index, native_id in zip(trip, found):
+                native_ids[index] = native_id
+                self._cache_id(offsets[index], namespace, native_id)
+        return native_ids
+
+    def _make_day_key(self, event, event_date, namespace=DEFAULT_NAMESPACE):
         """generate the key name for a given day
         """
         key = self._namespace_deliminator.join((event, event_date.isoformat()))
         return self.add_namespace(namespace, key)
 
+    def _make_rollup_key(self, event, rollup, bucket,
+                         namespace=DEFAULT_NAMESPACE):
+        """generate the key name for a given rollup bucket
+        """
+        key = self._namespace_deliminator.join((event, rollup.__name__,
+                                                bucket.isoformat()))
+        return self.add_namespace(namespace, key)
+
+    def _make_bucket_keys(self, event, event_time, namespace):
+        """generate the keys of every bitmap an event at event_time sets a bit
+        in: its bucket and, if maintained on write, its rollup buckets
+        """
+        keys = [self._make_day_key(event, self.bucket_func(event_time),
+                                   namespace)]
+        if self._rollup_on_write:
+            keys.extend(self._make_rollup_key(event, rollup,
+                                              rollup(event_time), namespace)
+                        for rollup in self._rollups)
+        return keys
+
+    def _plan_keys(self, event, start_date, end_date, namespace,
+                   unbuilt=()):
+        """Return the fewest bucket and rollup keys that together cover the
+        buckets from start_date to end_date: a shortest path from start_date
+        to the end of the range, where each step is one bucket, or one whole
+        rollup bucket in the range.
+
+        :param unbuilt: rollup keys to avoid
+        """
+        stop = granularity.next_bucket(self.bucket_func, end_date)
+        # bucket -> (number of keys, previous bucket, key) on the best path
+        # from start_date to bucket
+        best = {start_date: (0, None, None)}
+        bucket = start_date
+        while bucket < stop:
+            count = best[bucket][0] + 1
+            steps = [(granularity.next_bucket(self.bucket_func, bucket),
+                      self._make_day_key(event, bucket, namespace))]
+            for rollup in self._rollups:
+                if rollup(bucket) == bucket:
+                    key = self._make_rollup_key(event, rollup, bucket,
+                                                namespace)
+                    following = granularity.next_bucket(rollup, bucket)
+                    if following <= stop and key not in unbuilt:
+                        steps.append((following, key))
+            for following, key in steps:
+                if following not in best or best[following][0] > count:
+                    best[following] = (count, bucket, key)
+            bucket = steps[0][0]
+        keys = []
+        while bucket != start_date:
+            _, bucket, key = best[bucket]
+            keys.append(key)
+        keys.reverse()
+        return keys
+
+    def _rollup_candidates(self, ranges):
+        """Return the rollup keys covering the (event, start_date, end_date,
+        namespace) ranges, which must be checked for before planning them
+        when rollups are not maintained on write (and none otherwise)
+
+        :rtype: list
+        """
+        if self._rollup_on_write or not self._rollups:
+            return []
+        candidates = set()
+        for event, start_date, end_date, namespace in ranges:
+            for rollup in self._rollups:
+                candidates.update(
+                    self._make_rollup_key(event, rollup, bucket, namespace)
+                    for bucket in granularity.bucket_range(
+                        rollup, start_date, end_date))
+        return sorted(candidates)
+
+    def __find_unbuilt(self, ranges):
+        """Return the rollup keys covering the (event, start_date, end_date,
+        namespace) ranges that have not been built, checking them all in one
+        pipelined round trip
+        """
+        candidates = self._rollup_candidates(ranges)
+        if not candidates:
+            return set()
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for key in candidates:
+            pipe.exists(key)
+        unbuilt = set(key for key, built in zip(candidates, pipe.execute())
+                      if not built)
+        log.debug("rollups %s not built yet", unbuilt)
+        return unbuilt
+
+    def __range_keys(self, event, start_date, end_date, namespace):
+        """Return the keys to OR for the buckets from start_date to end_date,
+        checking which rollups have been built when they are not maintained
+        on write
+        """
+        unbuilt = self.__find_unbuilt([(event, start_date, end_date,
+                                        namespace)])
+        return self._plan_keys(event, start_date, end_date, namespace,
+                               unbuilt)
+
     def track_event(self, event, native_id, namespace=DEFAULT_NAMESPACE,
                     event_time=None):
         """Track that the given event happened to the given id.  By default,
         use day granularity and the current time, but allow backdating data
         (e.g. for batch processing or testing)
+
+        The id is mapped and its bit set in a single script call, or with a
+        plain SETBIT if the offset for the id is cached.  Approximately
+        counted events are added to their HyperLogLogs with PFADD.  Buckets
+        with a retention policy are given an expiry by the same call, when it
+        creates them.
         """
         if event_time is None:
             event_time = datetime.datetime.utcnow()
-        event_time = self.bucket_func(event_time)
-        key = self.__make_day_key(event, event_time, namespace)
-        offset = self.map_id_to_offset(native_id, namespace)
+        bucket_keys = self._make_bucket_keys(event, event_time, namespace)
+        expiries = self._make_expiries(bucket_keys, event_time)
+        if self.is_approximate(event, namespace):
+            if len(bucket_keys) == 1 and not expiries:
+                self._redis_conn.pfadd(bucket_keys[0], native_id)
+            else:
+                pipe = self._redis_conn.pipeline(transaction=False)
+                for key in bucket_keys:
+                    pipe.pfadd(key, native_id)
+                self._expire_new(expiries, pipe)
+                pipe.execute()
+            return
+        self._check_generation(namespace)
+        offset = self._cached_offset(native_id, namespace)
+        if offset is not None:
+            if (len(bucket_keys) == 1 and not self._sparse_density and
+                    not expiries):
+                self._redis_conn.setbit(bucket_keys[0], offset, 1)
+            elif self._sparse_density or expiries:
+                self._set_bits(bucket_keys, offset, namespace,
+                               self._redis_conn, expiries)
+            else:
+                pipe = self._redis_conn.pipeline(transaction=False)
+                self._set_bits(bucket_keys, offset, namespace, pipe)
+                pipe.execute()
+            return
+        proposed, result = self._track(bucket_keys, native_id, namespace,
+                                       expiries=expiries)
+        offset = self._tracked_offset(result, namespace, proposed)
+        self._cache_offset(native_id, namespace, offset)
+        log.debug("tracked %s for id %s at offset %s", event, native_id,
+                  offset)
+
+    def _make_expiries(self, bucket_keys, event_time):
+        """Return the unix times the bucket keys of an event at event_time
+        expire at, by key, for the keys with a retention policy
+        """
+        if not self._retention:
+            return {}
+        granularities = (self.bucket_func,)
+        if self._rollup_on_write:
+            granularities += self._rollups
+        expiries = {}
+        for key, bucket_func in zip(bucket_keys, granularities):
+            retention = self._retention.get(bucket_func)
+            if retention is not None:
+                expiries[key] = _expire_at(bucket_func,
+                                           bucket_func(event_time), retention)
+        return expiries
+
+    def __run_script(self, name, keys, args, client):
+        """Run the named script, or queue it if client is a pipeline, which
+        may be an asyncio one: the queuing helpers below are shared with
+        AsyncRedisUniqueCount
+        """
+        if client is None or client is self._redis_conn:
+            return self._scripts.run(name, keys=keys, args=args)
+        return self._scripts.queue(client, name, keys=keys, args=args)
+
+    def _expire_new(self, expiries, pipe):
+        """Queue EXPIRE_NEW_SCRIPT calls on pipe for a {key: unix time} dict,
+        ID_BATCH_SIZE keys at a time
+        """
+        keys = sorted(expiries)
+        for start in range(0, len(keys), ID_BATCH_SIZE):
+            chunk = keys[start:start + ID_BATCH_SIZE]
+            self.__run_script('unique_count.expire_new', chunk,
+                              [expiries[key] for key in chunk], pipe)
+
+    def _track(self, bucket_keys, native_id, namespace, client=None,
+               proposed=None, expiries=None):
+        """Map native_id and set its bit in bucket_keys with one TRACK_SCRIPT
+        call (or its sparse or reserved offset version), returning the offset
+        reserved for the id, if any, and the script result for
+        _tracked_offset.  A reserved offset is taken unless one is proposed.
+        Buckets created are expired per the expiries from _make_expiries.
+        """
+        keys = self._make_offset_keys(namespace) + bucket_keys
+        expire_at = _expiry_args(bucket_keys, expiries)
+        if self._offset_blocks is None:
+            if self._sparse_density:
+                return None, self.__run_script(
+                    'unique_count.track_sparse', keys,
+                    [native_id, self._sparse_density] + expire_at, client)
+            return None, self.__run_script('unique_count.track', keys,
+                                           [native_id] + expire_at, client)
+        if proposed is None:
+            proposed = self._offset_blocks.take(keys[2])
+        if self._sparse_density:
+            return proposed, self.__run_script(
+                'unique_count.track_sparse_claim', keys,
+                [native_id, proposed, self._sparse_density] + expire_at,
+                client)
+        return proposed, self.__run_script('unique_count.track_claim', keys,
+                                           [native_id, proposed] + expire_at,
+                                           client)
+
+    def _tracked_offset(self, result, namespace, proposed):
+        """Return the offset from the result of a script run by _track
+        """
+        if proposed is None:
+            return int(result)
+        return self._claimed_offset(
+            result, self.add_namespace(namespace, CURRENT_OFFSET_KEY),
+            proposed)
+
+    def _set_bits(self, bucket_keys, offset, namespace, pipe, expiries=None):
+        """Queue setting the known offset in bucket_keys on pipe (or run it,
+        if pipe is a connection and the bits are set by one script call),
+        returning the number of commands queued.  Buckets created are expired
+        per the expiries from _make_expiries.
+        """
+        expire_at = _expiry_args(bucket_keys, expiries)
+        if self._sparse_density:
+            keys = [self.add_namespace(namespace, CURRENT_OFFSET_KEY)]
+            self.__run_script('unique_count.mark_sparse', keys + bucket_keys,
+                              [offset, self._sparse_density] + expire_at,
+                              pipe)
+            return 1
+        if expire_at:
+            self.__run_script('unique_count.set_bits', bucket_keys,
+                              [offset] + expire_at, pipe)
+            return 1
+        for key in bucket_keys:
+            pipe.setbit(key, offset, 1)
+        return len(bucket_keys)
+
+    def track_events(self, events, batch_size=DEFAULT_BATCH_SIZE):
+        """Track many events at once, in a few pipelined round trips per batch
+        instead of two or more round trips per event.  Each event is an
+        iterable of (event, native_id[, event_time[, namespace]]), with the
+        same defaults as track_event, or a TrackedEvent.
+
+        :param events: iterable of events to track
+        :param batch_size: number of events to send to redis per batch
+        :type batch_size: int
+        :returns: a BatchStats per batch, counting the events tracked and the
+                  distinct ids that were newly mapped or already had offsets
+        :rtype: list
+        """
+        stats = []
+        batch = []
+        for element in events:
+            try:
+                batch.append(TrackedEvent(*element))
+            except TypeError:
+                raise ValueError("Invalid tracked event tuple")
+            if len(batch) >= batch_size:
+                stats.append(self.__track_batch(batch))
+                batch = []
+        if batch:
+            stats.append(self.__track_batch(batch))
+        return stats
+
+    def __track_batch(self, batch):
+        """Track one batch of TrackedEvents: one round trip to look up
+        existing offsets, and one to set the bits, mapping any new ids on the
+        way with TRACK_SCRIPT.  Approximately counted events skip the lookup.
+        """
+        for namespace in set(tracked.namespace for tracked in batch):
+            self._check_generation(namespace)
+        offsets, lookups = self._batch_offsets(batch)
+        new_ids = 0
+        if lookups:
+            pipe = self._redis_conn.pipeline(transaction=False)
+            self._queue_lookups(lookups, pipe)
+            new_ids = self._found_offsets(lookups, pipe.execute(), offsets)
+        pipe = self._redis_conn.pipeline(transaction=False)
+        mapped = self._queue_batch(batch, offsets, pipe)
+        self._settle_batch(mapped, pipe.execute())
+        log.debug("tracked %d events, mapping %d new ids", len(batch),
+                  new_ids)
+        return BatchStats(len(batch), new_ids, len(offsets))
+
+    def _batch_offsets(self, batch):
+        """Return the cached offsets of the ids in a batch of TrackedEvents,
+        by (namespace, native_id), and the (namespace, native_ids) to look up
+
+        :rtype: tuple
+        """
+        native_ids = {}
+        for tracked in batch:
+            if self.is_approximate(tracked.event, tracked.namespace):
+                continue
+            native_ids.setdefault(tracked.namespace, set()).add(
+                tracked.native_id)
+        offsets = {}
+        lookups = []
+        for namespace, ids in native_ids.items():
+            uncached = []
+            for native_id in ids:
+                offset = self._cached_offset(native_id, namespace)
+                if offset is None:
+                    uncached.append(native_id)
+                else:
+                    offsets[(namespace, native_id)] = offset
+            if uncached:
+                lookups.append((namespace, uncached))
+        return offsets, lookups
+
+    def _queue_lookups(self, lookups, pipe):
+        """Queue an HMGET on pipe for each (namespace, native_ids) lookup"""
+        for namespace, ids in lookups:
+            pipe.hmget(self.add_namespace(namespace, TO_OFFSET_KEY), ids)
 
-        self._redis_conn.setbit(key, offset, 1)
+    def _found_offsets(self, lookups, results, offsets):
+        """Add the offsets found by the HMGETs _queue_lookups queued to
+        offsets (and the cache), returning the number of ids with none yet
+        """
+        new_ids = 0
+        for (namespace, ids), found in zip(lookups, results):
+            for native_id, offset in zip(ids, found):
+                if offset is None:
+                    new_ids += 1
+                else:
+                    offsets[(namespace, native_id)] = int(offset)
+                    self._cache_offset(native_id, namespace, offset)
+        return new_ids
+
+    def _queue_batch(self, batch, offsets, pipe, inline_expiries=False):
+        """Queue the commands tracking a batch of TrackedEvents on pipe, given
+        the known offsets of their ids, mapping the rest with TRACK_SCRIPT.
+        New buckets are expired by EXPIRE_NEW_SCRIPT calls queued after the
+        rest, or, if inline_expiries, by the scripts setting their bits.
+
+        :returns: the (TrackedEvent, proposed offset) whose id each command
+                  maps, or None, for _settle_batch
+        :rtype: list
+        """
+        now = datetime.datetime.utcnow()
+        mapped = []
+        proposals = {}  # the offset reserved for each new id, if any
+        expiries = {}
+        for tracked in batch:
+            event_time = tracked.event_time or now
+            bucket_keys = self._make_bucket_keys(
+                tracked.event, event_time, tracked.namespace)
+            event_expiries = self._make_expiries(bucket_keys, event_time)
+            if self.is_approximate(tracked.event, tracked.namespace):
+                expiries.update(event_expiries)
+                for key in bucket_keys:
+                    pipe.pfadd(key, tracked.native_id)
+                mapped.extend([None] * len(bucket_keys))
+                continue
+            if not inline_expiries:
+                expiries.update(event_expiries)
+                event_expiries = None
+            id_key = (tracked.namespace, tracked.native_id)
+            offset = offsets.get(id_key)
+            if offset is None:
+                # repeats of a new id propose the same reserved offset, which
+                # the first claims and the rest then find mapped
+                repeat = id_key in proposals
+                proposed, _ = self._track(bucket_keys, tracked.native_id,
+                                          tracked.namespace, client=pipe,
+                                          proposed=proposals.get(id_key),
+                                          expiries=event_expiries)
+                proposals[id_key] = proposed
+                mapped.append(None if repeat else (tracked, proposed))
+            else:
+                commands = self._set_bits(bucket_keys, offset,
+                                          tracked.namespace, pipe,
+                                          event_expiries)
+                mapped.extend([None] * commands)
+        self._expire_new(expiries, pipe)  # after the commands in mapped
+        return mapped
+
+    def _settle_batch(self, mapped, results):
+        """Cache the offsets of the ids mapped by a batch, from the results
+        of the commands _queue_batch queued
+        """
+        for track, result in zip(mapped, results):
+            if track is not None:
+                tracked, proposed = track
+                offset = self._tracked_offset(result, tracked.namespace,
+                                              proposed)
+                self._cache_offset(tracked.native_id, tracked.namespace,
+                                   offset)
 
     def get_count(self, start_date, end_date, event,
                   namespace=DEFAULT_NAMESPACE):
         """Get the count of uniques for the given event, of the given id type,
-        for the given date range
+        for the given date range, ORing every bucket of the counter's
+        granularity in the range, or the rollups covering them.  Approximately
+        counted events are counted with a single PFCOUNT of the keys instead.
 
         :type start_date: datetime.datetime
         :type end_date: datetime.datetime
@@ -109,37 +1373,314 @@ class RedisUniqueCount(object):
         start_date = self.bucket_func(start_date)
         end_date = self.bucket_func(end_date)
 
-        if start_date == end_date:
-            # special case - we can just read from an existing day key here
-            log.debug("single date key case")
-            day_key = self.__make_day_key(event, start_date, namespace)
-            return self._redis_conn.bitcount(day_key)
-
         if end_date < start_date:
             # be nice and accept out of order args
             start_date, end_date = end_date, start_date
 
-        date_counter = start_date
-        keys = []
-        while date_counter <= end_date:
-            keys.append(self.__make_day_key(event, date_counter, namespace))
-            date_counter = date_counter + datetime.timedelta(days=1)
+        keys = self.__range_keys(event, start_date, end_date, namespace)
+        if self.is_approximate(event, namespace):
+            return self._redis_conn.pfcount(*keys)
+        if len(keys) == 1:
+            # special case - we can just read from an existing key here
+            log.debug("single key case")
+            return self.__count_key(keys[0])
+
+        compound_key = self._make_compound_key(event, start_date, end_date,
+                                               namespace)
+        groups = self.__make_or_groups(event, start_date, end_date, keys,
+                                       namespace)
+        log.debug("ORing %d keys into compound key %s", len(groups),
+                  compound_key)
+        result = self.__or_count(compound_key, groups)
+        return self._record_or_count(result)
+
+    def get_counts(self, queries):
+        """Get the unique counts for many event/date range queries at once, in
+        a single pipelined round trip (two, if rollups are not maintained on
+        write, to check which are built for all the queries at once).
+
+        :param queries: iterable of (event, start_date, end_date[, namespace])
+                        or CountQuery
+        :returns: the count for each query, in order
+        :rtype: list
+        """
+        ranges = []
+        for query in queries:
+            try:
+                query = CountQuery(*query)
+            except TypeError:
+                raise ValueError("Invalid count query tuple")
+            start_date = self.bucket_func(query.start_date)
+            end_date = self.bucket_func(query.end_date)
+            if end_date < start_date:
+                start_date, end_date = end_date, start_date
+            ranges.append(CountQuery(query.event, start_date, end_date,
+                                     query.namespace))
+        unbuilt = self.__find_unbuilt(ranges)
+
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for query in ranges:
+            start_date, end_date = query.start_date, query.end_date
+            keys = self._plan_keys(query.event, start_date, end_date,
+                                   query.namespace, unbuilt)
+            if self.is_approximate(query.event, query.namespace):
+                pipe.pfcount(*keys)
+                continue
+            if len(keys) == 1:
+                self.__count_key(keys[0], client=pipe)
+                continue
+            compound_key = self._make_compound_key(
+                query.event, start_date, end_date, query.namespace)
+            groups = self.__make_or_groups(query.event, start_date, end_date,
+                                           keys, query.namespace)
+            self.__or_count(compound_key, groups, client=pipe)
+        return [self._record_or_count(result)
+                if isinstance(result, list) else result
+                for result in pipe.execute()]
+
+    def __count_key(self, key, client=None):
+        """Count the uniques in a single bucket, which may be sparse
+        """
+        if client is None:
+            client = self._redis_conn
+        if self._sparse_density:
+            return self._scripts.run('unique_count.count', keys=(key,),
+                                     client=client)
+        return client.bitcount(key)
+
+    def __or_count(self, compound_key, groups, client=None):
+        """Run OR_COUNT_SCRIPT for the (key, source keys) groups
+        """
+        keys = [compound_key]
+        args = [self._bitop_ttl]
+        for key, sources in groups:
+            keys.append(key)
+            keys.extend(sources)
+            args.append(len(sources))
+        return self._scripts.run('unique_count.or_count', keys=keys,
+                                 args=args, client=client)
+
+    def _record_or_count(self, result):
+        """Count the cache hits and misses of an OR_COUNT_SCRIPT result, and
+        return the unique count from it
+        """
+        count, hit, segment_hits, segment_misses = result
+        self.stats['range_hits' if hit else 'range_misses'] += 1
+        self.stats['segment_hits'] += segment_hits
+        self.stats['segment_misses'] += segment_misses
+        return count
+
+    def bitop_key(self, operator, operands, namespace=DEFAULT_NAMESPACE):
+        """Combine the uniques of several event date ranges with a bitwise
+        operator, server side, and return the key holding the result.  The
+        result is cached for bitop_ttl seconds, and the key can be passed as
+        an operand to further calls, to compose more complex queries.
+
+        e.g. users who viewed on day X and purchased within the next week::
+
+            uc.get_bitop_count('AND', [('view', day_x, day_x),
+                                       ('purchase', day_x, day_x + week)],
+                               namespace='users')
+
+        :param operator: one of BITOP_OPERATORS.  'AND NOT' keeps the uniques
+                         of the first operand that are in none of the rest.
+        :param operands: (event, start_date, end_date) ranges, or keys from
+                         previous bitop_key calls
+        :rtype: str
+        """
+        if not self._bitop_ttl:
+            raise ValueError("bitop_key will return a temporary key and will "
+                             "not work with a 0 ttl")
+        return self.__bitop(operator, operands, namespace)[0]
+
+    def get_bitop_count(self, operator, operands,
+                        namespace=DEFAULT_NAMESPACE):
+        """Count the uniques in the combination of several event date ranges.
+        See bitop_key.
+
+        :rtype: int
+        """
+        return self.__bitop(operator, operands, namespace)[1]
+
+    def __bitop(self, operator, operands, namespace):
+        """Build (or find in cache) the combination of the operands, returning
+        its key and count.  Ranges are ORed into their compound keys by the
+        same script call as the combination, so none can expire midway.
+        """
+        operator = operator.upper()
+        if operator not in BITOP_OPERATORS:
+            raise ValueError("unknown operator: %s" % operator)
+        if not operands or (operator == 'AND NOT' and len(operands) < 2):
+            raise ValueError("not enough operands for %s" % operator)
+        groups = []
+        for operand in operands:
+            if not isinstance(operand, (tuple, list)):
+                groups.append((operand, ()))
+                continue
+            try:
+                event, start_date, end_date = operand
+            except ValueError:
+                raise ValueError("Invalid event range tuple")
+            if self.is_approximate(event, namespace):
+                raise ValueError("%s is counted approximately and cannot be "
+                                 "used in bitops" % event)
+            start_date = self.bucket_func(start_date)
+            end_date = self.bucket_func(end_date)
+            if end_date < start_date:
+                start_date, end_date = end_date, start_date
+            keys = self.__range_keys(event, start_date, end_date, namespace)
+            if len(keys) == 1:
+                groups.append((keys[0], ()))
+            else:
+                groups.append((self._make_compound_key(
+                    event, start_date, end_date, namespace), keys))
+
+        sources = [key for key, _ in groups]
+        if operator == 'AND NOT':
+            expression = [sources[0]] + sorted(sources[1:])
+        else:
+            expression = sorted(sources)
+        expression = '%s(%s)' % (operator, ', '.join(expression))
+        key = self.add_namespace(namespace, self._namespace_deliminator.join(
+            ('bitop', hashlib.sha1(expression.encode('utf-8')).hexdigest())))
+        log.debug("bitop %s in key %s", expression, key)
 
+        keys = [key, self._namespace_deliminator.join((key, 'temp'))]
+        args = [self._bitop_ttl, operator]
+        for group_key, group_sources in groups:
+            keys.append(group_key)
+            keys.extend(group_sources)
+            args.append(len(group_sources))
+        count, hit = self._scripts.run('unique_count.bitop', keys=keys,
+                                       args=args)
+        self.stats['bitop_hits' if hit else 'bitop_misses'] += 1
+        return key, count
+
+    def _make_compound_key(self, event, start_date, end_date, namespace):
+        """generate the key name for the cached OR of a date range
+        """
         key_components = [self.add_namespace(namespace, event), 'or',
                           start_date.isoformat(), end_date.isoformat()]
-        compound_key = self._namespace_deliminator.join(key_components)
+        return self._namespace_deliminator.join(key_components)
+
+    def __make_segment_key(self, event, bucket, size, namespace):
+        """generate the key name for the cached OR of size buckets from bucket
+        """
+        key = self._namespace_deliminator.join((event, 'seg',
+                                                bucket.isoformat(), str(size)))
+        return self.add_namespace(namespace, key)
+
+    def __make_or_groups(self, event, start_date, end_date, keys,
+                         namespace):
+        """Return the (key, source keys) groups for OR_COUNT_SCRIPT to OR for
+        the buckets from start_date to end_date, i.e. the planned keys as they
+        are, or, with segment caching, the range split into aligned, power of
+        two sized segments, each cached from its own planned keys.
+        """
+        step = getattr(self.bucket_func, 'step', None)
+        if (not self._segment_cache or not self._bitop_ttl or step is None or
+                hasattr(self.bucket_func, 'next_bucket')):
+            return [(key, ()) for key in keys]
+        first = _bucket_index(start_date, step)
+        last = _bucket_index(end_date, step)
+        groups = []
+        index = first
+        while index <= last:
+            size = 1
+            while index % (size * 2) == 0 and index + size * 2 - 1 <= last:
+                size *= 2
+            bucket = start_date + step * (index - first)
+            if size == 1:
+                groups.append((self._make_day_key(event, bucket, namespace),
+                               ()))
+            else:
+                segment_end = bucket + step * (size - 1)
+                groups.append((
+                    self.__make_segment_key(event, bucket, size, namespace),
+                    self.__range_keys(event, bucket, segment_end, namespace)))
+            index += size
+        return groups
 
-        log.debug("ORing keys %s into compound key %s", keys, compound_key)
-        if not self._redis_conn.exists(compound_key):
-            log.debug("Compound key not found, doing bit op")
-            self._redis_conn.bitop('OR', compound_key, *keys)
+    def build_rollups(self, event, start_date, end_date,
+                      namespace=DEFAULT_NAMESPACE):
+        """(Re)build the rollup bitmaps of every rollup bucket overlapping the
+        given date range from the buckets they cover, in one pipeline.  For
+        counters that do not maintain rollups on write, run this once a
+        rollup period is over.  Approximately counted rollups are rebuilt with
+        PFMERGE.  Rebuilt rollups get a new expiry from the retention policy.
 
-            # Store result before we set TTL then return result after
-            # TTL is set. For special case of TTL=0.
-            result = self._redis_conn.bitcount(compound_key)
-            self._redis_conn.expire(compound_key, self._bitop_ttl)
-            return result
-        return self._redis_conn.bitcount(compound_key)
+        :type start_date: datetime.datetime
+        :type end_date: datetime.datetime
+        """
+        if end_date < start_date:
+            start_date, end_date = end_date, start_date
+        approximate = self.is_approximate(event, namespace)
+        pipe = self._redis_conn.pipeline(transaction=False)
+        expiries = {}
+        for rollup in self._rollups:
+            retention = self._retention.get(rollup)
+            for bucket in granularity.bucket_range(rollup, start_date,
+                                                   end_date):
+                following = granularity.next_bucket(rollup, bucket)
+                keys = []
+                sub_bucket = self.bucket_func(bucket)
+                while sub_bucket < following:
+                    keys.append(self._make_day_key(event, sub_bucket,
+                                                   namespace))
+                    sub_bucket = granularity.next_bucket(self.bucket_func,
+                                                         sub_bucket)
+                key = self._make_rollup_key(event, rollup, bucket, namespace)
+                log.debug("building rollup %s from %d buckets", key,
+                          len(keys))
+                if approximate:
+                    pipe.delete(key)
+                    pipe.pfmerge(key, *keys)
+                else:
+                    self._scripts.run('unique_count.bit_or',
+                                      keys=[key] + keys, client=pipe)
+                if retention is not None:
+                    expiries[key] = _expire_at(rollup, bucket, retention)
+        self._expire_new(expiries, pipe)
+        pipe.execute()
+
+    def get_bitmaps(self, event, start_date, end_date,
+                    namespace=DEFAULT_NAMESPACE, batch_size=16):
+        """Read the bitmap of every bucket of an event from start_date to
+        end_date, e.g. to analyse them outside redis, with one GET per bucket,
+        pipelined batch_size at a time.  Sparse buckets are converted to
+        bitmaps.
+
+        :type start_date: datetime.datetime
+        :type end_date: datetime.datetime
+        :returns: (bucket, bitmap) pairs, in order.  Missing buckets have
+                  empty bitmaps.
+        :rtype: iterator
+        """
+        if self.is_approximate(event, namespace):
+            raise ValueError("%s is counted approximately and has no bitmaps"
+                             % event)
+        if end_date < start_date:
+            start_date, end_date = end_date, start_date
+        buckets = list(granularity.bucket_range(self.bucket_func, start_date,
+                                                end_date))
+        for start in range(0, len(buckets), batch_size):
+            batch = buckets[start:start + batch_size]
+            keys = [self._make_day_key(event, bucket, namespace)
+                    for bucket in batch]
+            pipe = self._redis_conn.pipeline(transaction=False)
+            for key in keys:
+                pipe.type(key)
+            sparse = [_as_str(kind) == 'set' for kind in pipe.execute()]
+            for key, is_sparse in zip(keys, sparse):
+                if is_sparse:
+                    pipe.smembers(key)
+                else:
+                    pipe.get(key)
+            for bucket, is_sparse, data in zip(batch, sparse,
+                                               pipe.execute()):
+                if is_sparse:
+                    data = _to_bitmap(int(offset) for offset in data)
+                yield bucket, data or b''
 
     def get_current_offset(self, namespace=DEFAULT_NAMESPACE):
         """ Returns current offset for given namespace
@@ -152,17 +1693,360 @@ class RedisUniqueCount(object):
         except TypeError:
             return 0
 
+    def compact(self, namespace=DEFAULT_NAMESPACE):
+        """Retire the ids of a namespace that are in none of its buckets (e.g.
+        once old buckets have expired or been deleted), renumber the rest
+        densely, in offset order, and rewrite every bucket and rollup to the
+        new offsets, shrinking the bitmaps to the size of the live id space.
+
+        Buckets are read a BITMAP_CHUNK_SIZE window at a time, and the new
+        buckets and mappings are written beside the old ones in chunks, so
+        redis is never blocked for long.  Bitmaps are renumbered a window at a
+        time with table lookups and bit string selection rather than bit by
+        bit: expect roughly a third of a second of CPU per megabyte of bucket
+        bitmap (about 15 seconds per bucket of a 400 million offset space),
+        plus one HMGET round trip per ID_BATCH_SIZE live ids to copy their
+        mappings.
+
+        The new keys replace the old ones in one final transaction, which also
+        drops any cached range, segment and bitop results.  The old keys are
+        UNLINKed first, so redis frees them in the background.  The offset
+        mappings and buckets of the namespace are WATCHed throughout, and the
+        buckets are scanned for again just before the transaction: if
+        anything is tracked in the namespace meanwhile, or a bucket is
+        created, the work is discarded and the compaction started again, up
+        to COMPACT_ATTEMPTS times before the WatchError is raised.  Any
+        tracking aborts a pass, so pause ingest into the namespace while it
+        is compacted; only a bucket created between the last scan and the
+        transaction would go unnoticed.  The namespace's GENERATION_KEY is
+        bumped, so that other counters drop the offsets they cached or
+        reserved before (see offset_cache_size).
+
+        :returns: the numbers of live and retired ids, and of keys rewritten
+        :rtype: CompactionStats
+        """
+        if namespace in self._approximate:
+            raise ValueError("%s is counted approximately and has no offsets"
+                             % namespace)
+        for attempt in range(1, COMPACT_ATTEMPTS + 1):
+            try:
+                return self.__compact(namespace)
+            except WatchError:
+                log.info("%s was tracked in while compacting (attempt %d)",
+                         namespace, attempt)
+                if attempt == COMPACT_ATTEMPTS:
+                    raise
+
+    def __compact(self, namespace):
+        """Make one attempt at compact, raising WatchError if the namespace
+        was tracked in meanwhile
+        """
+        offset_keys = self._make_offset_keys(namespace)
+        pipe = self._redis_conn.pipeline(transaction=True)
+        try:
+            pipe.watch(offset_keys[0], offset_keys[2])
+            buckets, derived, stale = self.__find_bucket_keys(namespace)
+            if buckets:
+                pipe.watch(*buckets)
+            if stale:
+                self._redis_conn.delete(*stale)
+            space = self.get_current_offset(namespace)
+            live = bytearray((space + 7) // 8)
+            for key in buckets:
+                if _as_str(self._redis_conn.type(key)) == 'set':
+                    for offset in self.__iter_bucket(key):
+                        live[offset // 8] |= 0x80 >> (offset % 8)
+                    continue
+                for start, data in self.__iter_chunks(key):
+                    _or_into(live, start, data)
+            ranks = _RankIndex(live)
+            log.debug("compacting %s: %d of %d ids are live", namespace,
+                      ranks.size, space)
+
+            swaps = []  # (command, args) to run in the final transaction
+            for index, key in enumerate(buckets):
+                temp_key = self.__make_compaction_key(namespace, str(index))
+                ttl = self._redis_conn.pttl(key)
+                swaps.append(('unlink', (key,)))
+                if self.__rewrite_bucket(key, temp_key, live, ranks):
+                    swaps.append(('rename', (temp_key, key)))
+                    if ttl and ttl > 0:
+                        swaps.append(('pexpire', (key, ttl)))
+
+            temp_keys = [self.__make_compaction_key(namespace, key)
+                         for key in (TO_OFFSET_KEY, TO_ID_KEY)]
+            batch = []
+            new_offset = 0
+            for offset in iter_set_bits(live):
+                batch.append(offset)
+                if len(batch) >= ID_BATCH_SIZE:
+                    new_offset = self.__copy_ids(batch, new_offset,
+                                                 offset_keys, temp_keys)
+                    batch = []
+            if batch:
+                self.__copy_ids(batch, new_offset, offset_keys, temp_keys)
+
+            # buckets created meanwhile are not WATCHed, so look again
+            created, derived, _ = self.__find_bucket_keys(namespace)
+            created = set(created) - set(buckets)
+            if created:
+                raise WatchError("%d buckets of %s were created while "
+                                 "compacting" % (len(created), namespace))
+            pipe.multi()
+            for command, args in swaps:
+                getattr(pipe, command)(*args)
+            for temp_key, key in zip(temp_keys, offset_keys):
+                pipe.unlink(key)
+                if ranks.size:
+                    pipe.rename(temp_key, key)
+            pipe.set(offset_keys[2], ranks.size)
+            pipe.incr(self.add_namespace(namespace, GENERATION_KEY))
+            if derived:
+                pipe.delete(*derived)
+            pipe.execute()
+        finally:
+            pipe.reset()
+
+        self.__drop_offsets(namespace)
+        self._generations.pop(namespace, None)
+        return CompactionStats(ranks.size, space - ranks.size, len(buckets))
+
+    def __make_compaction_key(self, namespace, name):
+        """generate the name of a temporary key for compact to write to
+        """
+        return self.add_namespace(namespace, self._namespace_deliminator.join(
+            ('compact', name)))
+
+    def __find_bucket_keys(self, namespace, approximate=False):
+        """SCAN for the bucket and rollup keys of a namespace (including those
+        of approximately counted events, if approximate), the keys of the
+        cached results derived from them, and any temporary keys left by an
+        interrupted compact
+        """
+        prefix = self.add_namespace(namespace, '')
+        reserved = (TO_OFFSET_KEY, TO_ID_KEY, CURRENT_OFFSET_KEY,
+                    GENERATION_KEY)
+        buckets, derived, stale = [], [], []
+        for key in self._redis_conn.scan_iter(match=prefix + '*',
+                                              count=ID_BATCH_SIZE):
+            key = _as_str(key)
+            name = key[len(prefix):]
+            parts = name.split(self._namespace_deliminator)
+            if name in reserved:
+                continue
+            elif parts[0] == 'compact':
+                stale.append(key)
+            elif parts[0] == 'bitop' or parts[1:2] in (['or'], ['seg']):
+                derived.append(key)
+            elif approximate or not self.is_approximate(parts[0], namespace):
+                buckets.append(key)
+        return buckets, derived, stale
+
+    def __iter_bucket(self, key):
+        """Yield the offsets in a bucket, however it is stored
+        """
+        if _as_str(self._redis_conn.type(key)) == 'set':
+            return (int(offset) for offset in self._redis_conn.smembers(key))
+        return BitmapScanner(self._redis_conn, key,
+                             window_size=BITMAP_CHUNK_SIZE)
+
+    def __iter_chunks(self, key):
+        """Yield the (byte offset, data) of each BITMAP_CHUNK_SIZE window of a
+        bitmap key
+        """
+        start = 0
+        while True:
+            data = self._redis_conn.getrange(key, start,
+                                             start + BITMAP_CHUNK_SIZE - 1)
+            if not data:
+                return
+            yield start, bytearray(data)
+            if len(data) < BITMAP_CHUNK_SIZE:
+                return
+            start += BITMAP_CHUNK_SIZE
+
+    def __rewrite_bucket(self, key, temp_key, live, ranks):
+        """Write the bucket at key to temp_key, with each offset replaced by
+        its rank among the live offsets, in the same representation,
+        returning whether it had any offsets
+        """
+        if _as_str(self._redis_conn.type(key)) == 'set':
+            offsets = [ranks.rank(int(offset))
+                       for offset in self._redis_conn.smembers(key)]
+            for start in range(0, len(offsets), ID_BATCH_SIZE):
+                self._redis_conn.sadd(temp_key,
+                                      *offsets[start:start + ID_BATCH_SIZE])
+            return bool(offsets)
+        # the live bits of each window are consecutive in the new bitmap, so
+        # the windows are renumbered one after the other
+        bitmap = bytearray()
+        bits = ''
+        for start, data in self.__iter_chunks(key):
+            bits += _extract_bits(data, live[start:start + len(data)])
+            whole = len(bits) - len(bits) % 8
+            bitmap += _from_bit_string(bits[:whole])
+            bits = bits[whole:]
+        if bits:
+            bitmap += _from_bit_string(bits.ljust(8, '0'))
+        bitmap = bitmap.rstrip(b'\0')
+        for start in range(0, len(bitmap), BITMAP_CHUNK_SIZE):
+            chunk = bitmap[start:start + BITMAP_CHUNK_SIZE]
+            self._redis_conn.setrange(temp_key, start, bytes(chunk))
+        return bool(bitmap)
+
+    def __copy_ids(self, offsets, new_offset, offset_keys, temp_keys):
+        """Copy the mappings of a batch of live offsets to the temporary
+        mapping keys, numbering them from new_offset, and return the next new
+        offset
+        """
+        native_ids = self._redis_conn.hmget(offset_keys[1], offsets)
+        pipe = self._redis_conn.pipeline(transaction=False)
+        for native_id in native_ids:
+            if native_id is not None:
+                pipe.hset(temp_keys[0], native_id, new_offset)
+                pipe.hset(temp_keys[1], new_offset, native_id)
+            new_offset += 1
+        pipe.execute()
+        return new_offset
+
+    def apply_retention(self, namespace=DEFAULT_NAMESPACE):
+        """Expire the existing bucket and rollup keys of a namespace that have
+        no expiry, per the retention policy, e.g. keys written before the
+        policy was set.  Keys already past their retention are deleted.  Keys
+        are found with SCAN, and expired ID_BATCH_SIZE at a time.
+
+        :returns: the number of keys given an expiry
+        :rtype: int
+        """
+        if not self._retention:
+            return 0
+        buckets, _, _ = self.__find_bucket_keys(namespace, approximate=True)
+        prefix = self.add_namespace(namespace, '')
+        expiries = {}
+        for key in buckets:
+            _, _, name = key[len(prefix):].partition(
+                self._namespace_deliminator)
+            bucket_func = self.bucket_func
+            for rollup in self._rollups:
+                rollup_prefix = rollup.__name__ + self._namespace_deliminator
+                if name.startswith(rollup_prefix):
+                    bucket_func = rollup
+                    name = name[len(rollup_prefix):]
+            retention = self._retention.get(bucket_func)
+            if retention is None:
+                continue
+            try:
+                bucket = datetime.datetime.strptime(name, BUCKET_FORMAT)
+            except ValueError:
+                log.debug("not a bucket key: %s", key)
+                continue
+            expiries[key] = _expire_at(bucket_func, bucket, retention)
+        pipe = self._redis_conn.pipeline(transaction=False)
+        self._expire_new(expiries, pipe)
+        return sum(pipe.execute())
+
     def get_ids_for_event(self, event, namespace=DEFAULT_NAMESPACE,
-                          event_time=None):
-        """ Returns iterable of native_ids that have triggered the event
+                          event_time=None, prefetch=False, id_lookup=None):
+        """ Returns iterable of native_ids that have triggered the event, in
+        offset order.  The bitmap is scanned with a BitmapScanner, and ids are
+        resolved ID_BATCH_SIZE * ID_BATCHES_PER_TRIP at a time, in one
+        pipelined round trip.
 
+        :param prefetch: read the next bitmap window while decoding the
+                         current one
+        :param id_lookup: ids by offset, e.g. from load_ids, to resolve ids
+                          from instead of redis.  Offsets past its end, or
+                          with no id in it, are still resolved from redis.
         :rtype: iterator
         """
+        if self.is_approximate(event, namespace):
+            raise ValueError("ids of %s are not recorded, it is counted "
+                             "approximately" % event)
         if event_time is None:
             event_time = datetime.datetime.utcnow()
         event_time = self.bucket_func(event_time)
-        key = self.__make_day_key(event, event_time, namespace)
+        key = self._make_day_key(event, event_time, namespace)
+
+        if self._sparse_density and self._redis_conn.type(key) in (b'set',
+                                                                   'set'):
+            scanner = sorted(int(offset)
+                             for offset in self._redis_conn.smembers(key))
+        else:
+            scanner = BitmapScanner(self._redis_conn, key,
+                                    window_size=BITMAP_CHUNK_SIZE,
+                                    prefetch=prefetch)
+        offsets = []
+        for offset in scanner:
+            offsets.append(offset)
+            if len(offsets) >= ID_BATCH_SIZE * ID_BATCHES_PER_TRIP:
+                for native_id in self.__resolve_ids(offsets, namespace,
+                                                    id_lookup):
+                    yield native_id
+                offsets = []
+        for native_id in self.__resolve_ids(offsets, namespace, id_lookup):
+            yield native_id
+
+    def __resolve_ids(self, offsets, namespace, id_lookup):
+        """Map offsets to ids, from id_lookup where it has them
+        """
+        if id_lookup is None:
+            return self.map_offsets_to_ids(offsets, namespace)
+        native_ids = [id_lookup[offset] if offset < len(id_lookup) else None
+                      for offset in offsets]
+        missing = [offset for offset, native_id in zip(offsets, native_ids)
+                   if native_id is None]
+        found = iter(self.map_offsets_to_ids(missing, namespace))
+        return [next(found) if native_id is None else native_id
+                for native_id in native_ids]
+
+    def iter_offset_ids(self, namespace=DEFAULT_NAMESPACE, cursor=0,
+                        batch_size=ID_BATCH_SIZE):
+        """Stream the whole offset to id mapping of a namespace, in offset
+        order, with one HMGET per batch_size offsets, up to the current offset
+        when the stream starts.  Offsets with no id (e.g. reserved but never
+        used) map to None.
 
-        for offset in range(self.get_current_offset(namespace)):
-            if self._redis_conn.getbit(key, offset):
-                yield self.map_offset_to_id(offset, namespace)
+        :param cursor: offset to start from, e.g. the one after the last
+                       offset seen, to resume an interrupted stream
+        :type cursor: int
+        :returns: (offset, native_id) pairs
+        :rtype: iterator
+        """
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        key = self.add_namespace(namespace, TO_ID_KEY)
+        end = self.get_current_offset(namespace)
+        for start in range(cursor, end, batch_size):
+            offsets = list(range(start, min(start + batch_size, end)))
+            for offset, native_id in zip(offsets,
+                                         self._redis_conn.hmget(key, offsets)):
+                yield offset, native_id
+
+    def export_ids(self, fileobj, namespace=DEFAULT_NAMESPACE, cursor=0,
+                   batch_size=ID_BATCH_SIZE):
+        """Write the offset to id mapping of a namespace to a binary file, one
+        id per line, so line n holds the id of offset n (or is empty if it has
+        none), for load_ids to read back.  To resume an export, or bring it up
+        to date, append to the same file from the returned cursor.  Ids
+        claimed from reserved offset blocks after their offsets were exported
+        are not in the file; get_ids_for_event resolves them from redis.
+
+        :param fileobj: binary file to write to
+        :param cursor: offset to start from; the file must already hold the
+                       lines of every offset before it
+        :returns: the cursor to resume from, i.e. the number of lines now in
+                  the file
+        :rtype: int
+        """
+        for offset, native_id in self.iter_offset_ids(namespace, cursor,
+                                                      batch_size):
+            if native_id is None:
+                native_id = b''
+            elif not isinstance(native_id, bytes):
+                native_id = native_id.encode('utf-8')
+            if b'\n' in native_id:
+                raise ValueError("id at offset %d contains a newline" %
+                                 offset)
+            fileobj.write(native_id + b'\n')
+            cursor = offset + 1
+        return cursor
@@ -22,5 +22,6 @@ setup(
     description='Light-weight tools to implement high-level features in Redis',
     long_description=open('README.md').read(),
     zip_safe=False,
-    install_requires=open('requirements.txt').readlines()
+    install_requires=open('requirements.txt').readlines(),
+    extras_require={'analytics': ['numpy']}
 )
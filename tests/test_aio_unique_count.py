@@ -0,0 +1,149 @@
+"""Tests for the asyncio unique counter
+"""
+import datetime
+import redis
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_
+
+from redis_gadgets import granularity
+from redis_gadgets import unique_count
+
+try:
+    import asyncio
+    import redis.asyncio
+    from redis_gadgets import aio_unique_count
+except (ImportError, SyntaxError):
+    aio_unique_count = None
+
+
+ITERATIONS = 10
+
+
+class TestAsyncUniqueCount(object):
+    """Test tracking and counting from asyncio
+    """
+    @classmethod
+    def setup_class(cls):
+        if aio_unique_count is None:
+            raise SkipTest("asyncio redis client is not available")
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.today = datetime.datetime.utcnow()
+        cls.yesterday = cls.today - datetime.timedelta(days=1)
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+        self.sync_uc = unique_count.RedisUniqueCount(
+            self.con, rollups=(granularity.weekly,))
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def _make_counter(self, **kwargs):
+        return aio_unique_count.AsyncRedisUniqueCount(
+            redis.asyncio.Redis(db=15), rollups=(granularity.weekly,),
+            **kwargs)
+
+    def _wait(self, *coroutines):
+        """Run the coroutines concurrently, returning their results
+        """
+        return self.loop.run_until_complete(asyncio.gather(*coroutines))
+
+    def test_track_and_count(self):
+        """Concurrent track_event calls are counted like synchronous ones
+        """
+        uc = self._make_counter()
+        self._wait(*[uc.track_event('visit', 'id%s' % (n % ITERATIONS),
+                                    event_time=self.today)
+                     for n in range(ITERATIONS * 2)])
+        self._wait(uc.track_event('visit', 'id0', event_time=self.yesterday))
+        eq_(self._wait(uc.get_count(self.today, self.today, 'visit'),
+                       uc.get_count(self.yesterday, self.today, 'visit')),
+            [ITERATIONS, ITERATIONS])
+        eq_(self.sync_uc.get_count(self.yesterday, self.today, 'visit'),
+            ITERATIONS)
+
+    def test_shared_offsets(self):
+        """Offsets are shared with the synchronous counter
+        """
+        offset = self.sync_uc.map_id_to_offset('id1')
+        uc = self._make_counter()
+        eq_(self._wait(uc.map_id_to_offset('id1')), [offset])
+        eq_(self._wait(uc.map_id_to_offset('id2'),
+                       uc.map_offset_to_id(offset)),
+            [offset + 1, self.sync_uc.map_offset_to_id(offset)])
+        eq_(self._wait(uc.get_current_offset()), [2])
+
+    def test_cached_ids(self):
+        """Ids are served from the offset caches once looked up
+        """
+        offset = self.sync_uc.map_id_to_offset('id1')
+        uc = self._make_counter(offset_cache_size=ITERATIONS)
+        eq_(self._wait(uc.map_offset_to_id(offset)),
+            [self.sync_uc.map_offset_to_id(offset)])
+        eq_(self._wait(uc.map_offset_to_id(offset)),
+            [self.sync_uc.map_offset_to_id(offset)])
+        stats = uc.cache_stats()[unique_count.TO_ID_KEY]
+        eq_((stats.hits, stats.misses), (1, 1))
+
+    def test_retention(self):
+        """New buckets are expired, whether tracked singly or in batches
+        """
+        uc = self._make_counter(
+            retention={granularity.daily: datetime.timedelta(days=2)})
+        self._wait(uc.track_event('single', 'id1', event_time=self.today))
+        self._wait(uc.track_events([('batched', 'id1', self.today)]))
+        for event in ('single', 'batched'):
+            key = uc.add_namespace(unique_count.DEFAULT_NAMESPACE, '%s:%s' % (
+                event, granularity.daily(self.today).isoformat()))
+            assert self.con.ttl(key) > 0, key
+
+    def test_batches(self):
+        """Batched tracking and counting, with cached offsets
+        """
+        self.sync_uc.map_id_to_offset('id0')
+        uc = self._make_counter(offset_cache_size=ITERATIONS)
+        stats, = self._wait(uc.track_events(
+            [('visit', 'id%s' % (n % 4), self.today) for n in range(6)],
+            batch_size=3))
+        eq_(stats, [unique_count.BatchStats(3, 2, 1),
+                    unique_count.BatchStats(3, 1, 2)])
+        eq_(self._wait(uc.track_events([('visit', 'id1', self.today)])),
+            [[unique_count.BatchStats(1, 0, 1)]])
+        eq_(self._wait(uc.get_counts([('visit', self.today, self.today),
+                                      ('visit', self.yesterday, self.today),
+                                      ('other', self.today, self.today)])),
+            [[4, 4, 0]])
+
+    def test_sparse_and_approximate(self):
+        """Sparse and approximate events are tracked with the same keys
+        """
+        uc = self._make_counter(sparse_density=1,
+                                approximate=(('global', 'views'),))
+        self._wait(uc.track_events([('rare', 'id1', self.today),
+                                    ('views', 'id1', self.today),
+                                    ('views', 'id2', self.today)]))
+        eq_(self._wait(uc.get_counts([('rare', self.today, self.today),
+                                      ('views', self.today, self.today)])),
+            [[1, 2]])
+        sync_uc = unique_count.RedisUniqueCount(
+            self.con, sparse_density=1, approximate=(('global', 'views'),))
+        eq_(sync_uc.get_count(self.today, self.today, 'views'), 2)
+        eq_(list(sync_uc.get_ids_for_event('rare', event_time=self.today)),
+            [sync_uc.map_offset_to_id(0)])
+
+    def test_unbuilt_rollups(self):
+        """Rollups not maintained on write are only read once built
+        """
+        uc = self._make_counter(rollup_on_write=False)
+        monday = granularity.weekly(self.today)
+        sunday = monday + datetime.timedelta(days=6)
+        self._wait(uc.track_event('visit', 'id1', event_time=monday))
+        eq_(self._wait(uc.get_count(monday, sunday, 'visit')), [1])
+        self._wait(uc.track_event('visit', 'id2', event_time=sunday))
+        eq_(self._wait(uc.get_count(monday, sunday, 'visit')), [1])
+        self.sync_uc.build_rollups('visit', monday, sunday)
+        eq_(self._wait(uc.get_count(monday, sunday, 'visit')), [2])
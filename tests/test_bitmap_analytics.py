@@ -0,0 +1,90 @@
+"""Tests for the NumPy bitmap analytics
+"""
+import datetime
+import redis
+from nose.plugins.skip import SkipTest
+from nose.tools import eq_, raises
+
+from redis_gadgets import bitmap_analytics
+from redis_gadgets import unique_count
+
+
+class TestBucketBitmaps(object):
+    """Test analytics over fetched bucket bitmaps
+    """
+    @classmethod
+    def setup_class(cls):
+        if bitmap_analytics.np is None:
+            raise SkipTest("numpy is not installed")
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.start = datetime.datetime(2015, 6, 1)
+        cls.days = [cls.start + datetime.timedelta(days=n) for n in range(5)]
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+        self.uc = unique_count.RedisUniqueCount(self.con)
+        # id n is active on days n to 4, and id 20 on day 0 only
+        for n, day in enumerate(self.days):
+            for user in range(n + 1):
+                self.uc.track_event('visit', 'id%s' % user, event_time=day)
+        self.uc.track_event('visit', 'id20', event_time=self.days[0])
+        self.bitmaps = bitmap_analytics.BucketBitmaps.fetch(
+            self.uc, 'visit', self.days[0], self.days[-1])
+
+    def test_fetch(self):
+        """Every bucket in the range is fetched, in order
+        """
+        eq_(self.bitmaps.buckets, self.days)
+        eq_(len(self.bitmaps), 5)
+
+    def test_counts(self):
+        """Bucket counts match get_count
+        """
+        eq_(list(self.bitmaps.counts()),
+            [self.uc.get_count(day, day, 'visit') for day in self.days])
+
+    def test_union_intersection(self):
+        """OR and AND of a run of buckets
+        """
+        eq_(bitmap_analytics.popcount(self.bitmaps.union()),
+            self.uc.get_count(self.days[0], self.days[-1], 'visit'))
+        eq_(bitmap_analytics.popcount(self.bitmaps.intersection(1, 3)), 2)
+        offsets = bitmap_analytics.to_offsets(self.bitmaps.intersection())
+        eq_(self.uc.map_offsets_to_ids(offsets), ['id0'])
+
+    def test_retention_matrix(self):
+        """Retention counts the uniques in both buckets
+        """
+        matrix = self.bitmaps.retention_matrix()
+        eq_(matrix.shape, (5, 5))
+        eq_(list(matrix[0]), [2, 1, 1, 1, 1])
+        eq_(list(matrix[2]), [0, 0, 3, 3, 3])
+        eq_(list(matrix[:, 4]), [1, 2, 3, 4, 5])
+
+    def test_rolling_uniques(self):
+        """Rolling counts match get_count over each window
+        """
+        for window in (1, 2, 3, 5):
+            eq_(list(self.bitmaps.rolling_uniques(window)),
+                [self.uc.get_count(self.days[n], self.days[n + window - 1],
+                                   'visit')
+                 for n in range(len(self.days) - window + 1)])
+        eq_(len(self.bitmaps.rolling_uniques(6)), 0)
+
+    def test_sparse_buckets(self):
+        """Sparse buckets are fetched as bitmaps
+        """
+        uc = unique_count.RedisUniqueCount(self.con, sparse_density=1)
+        uc.track_event('rare', 'id3', event_time=self.days[0])
+        bitmaps = bitmap_analytics.BucketBitmaps.fetch(
+            uc, 'rare', self.days[0], self.days[1])
+        eq_(list(bitmaps.counts()), [1, 0])
+        eq_(list(bitmap_analytics.to_offsets(bitmaps.union())),
+            [uc.map_id_to_offset('id3')])
+
+    @raises(ValueError)
+    def test_bad_window(self):
+        """Windows must hold at least one bucket
+        """
+        self.bitmaps.rolling_uniques(0)
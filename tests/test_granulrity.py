@@ -2,9 +2,9 @@
 Tests for granularity functions
 """
 
-from datetime import datetime
+from datetime import datetime, timedelta
 import pytz
-from nose.tools import eq_
+from nose.tools import eq_, raises
 from redis_gadgets import granularity as gr
 
 
@@ -89,3 +89,85 @@ class TestDaily(object):
         expected = datetime(2015, 4, 20, tzinfo=pytz.timezone("US/Eastern"))
         actual = gr.daily(initial)
         eq_(actual, expected)
+
+
+class TestBucketStepping(object):
+    def test_next_bucket(self):
+        """Each granularity steps to its own next bucket
+        """
+        initial = datetime(2015, 4, 20, 23, 55)
+        eq_(gr.next_bucket(gr.five_minute, initial), datetime(2015, 4, 21))
+        eq_(gr.next_bucket(gr.hourly, gr.hourly(initial)),
+            datetime(2015, 4, 21))
+        eq_(gr.next_bucket(gr.daily, gr.daily(initial)),
+            datetime(2015, 4, 21))
+
+    def test_custom_next_bucket(self):
+        """Custom granularities can step unevenly, or default to stepping a
+        day at a time until the bucket changes
+        """
+        def yearly(dt):
+            return dt.replace(month=1, day=1, hour=0, minute=0, second=0,
+                              microsecond=0)
+        eq_(gr.next_bucket(yearly, datetime(2015, 1, 1)),
+            datetime(2016, 1, 1))
+        eq_(list(gr.bucket_range(yearly, datetime(2015, 6, 1),
+                                 datetime(2016, 2, 1))),
+            [datetime(2015, 1, 1), datetime(2016, 1, 1)])
+        yearly.next_bucket = lambda dt: dt.replace(year=dt.year + 1)
+        eq_(gr.next_bucket(yearly, datetime(2015, 1, 1)),
+            datetime(2016, 1, 1))
+
+        def custom_daily(dt):
+            return dt.replace(hour=0, minute=0, second=0, microsecond=0)
+        eq_(gr.next_bucket(custom_daily, datetime(2015, 4, 20)),
+            datetime(2015, 4, 21))
+
+    @raises(ValueError)
+    def test_no_next_bucket(self):
+        """Granularities that never reach a later bucket are rejected
+        """
+        gr.next_bucket(lambda dt: datetime(2015, 1, 1), datetime(2015, 1, 1))
+
+    def test_bucket_range(self):
+        """Bucket ranges include both ends
+        """
+        start = datetime(2015, 4, 20, 4, 22, 17)
+        end = datetime(2015, 4, 20, 4, 37)
+        eq_(list(gr.bucket_range(gr.five_minute, start, end)),
+            [datetime(2015, 4, 20, 4, 20), datetime(2015, 4, 20, 4, 25),
+             datetime(2015, 4, 20, 4, 30), datetime(2015, 4, 20, 4, 35)])
+        eq_(list(gr.bucket_range(gr.hourly, start, end)),
+            [datetime(2015, 4, 20, 4)])
+        eq_(list(gr.bucket_range(gr.daily, end, start - timedelta(days=1))),
+            [])
+
+
+class TestWeekly(object):
+    def test_arbitrary_time(self):
+        """Can truncate a datetime to the start of its week
+        """
+        initial = datetime(2015, 4, 23, 4, 22, 17)
+        eq_(gr.weekly(initial), datetime(2015, 4, 20))
+
+    def test_next_bucket(self):
+        """Weeks step a week at a time
+        """
+        eq_(gr.next_bucket(gr.weekly, datetime(2015, 4, 27)),
+            datetime(2015, 5, 4))
+
+
+class TestMonthly(object):
+    def test_arbitrary_time(self):
+        """Can truncate a datetime to the start of its month
+        """
+        initial = datetime(2015, 4, 23, 4, 22, 17)
+        eq_(gr.monthly(initial), datetime(2015, 4, 1))
+
+    def test_next_bucket(self):
+        """Months step to the first of the next month, across years
+        """
+        eq_(gr.next_bucket(gr.monthly, datetime(2015, 4, 1)),
+            datetime(2015, 5, 1))
+        eq_(gr.next_bucket(gr.monthly, datetime(2015, 12, 1)),
+            datetime(2016, 1, 1))
@@ -0,0 +1,45 @@
+"""Tests for the in process LRU cache
+"""
+from nose.tools import eq_, raises
+
+from redis_gadgets.lru import LRUCache, CacheStats
+
+
+class TestLRUCache(object):
+    def test_get_put(self):
+        """Cached values can be read back
+        """
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('b', 'default'), 'default')
+
+    def test_evicts_least_recently_used(self):
+        """A full cache evicts the entry that was used longest ago
+        """
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        eq_(len(cache), 2)
+        eq_(cache.get('a'), 1)
+        eq_(cache.get('b'), None)
+        eq_(cache.get('c'), 3)
+
+    def test_stats(self):
+        """Hits, misses and evictions are counted
+        """
+        cache = LRUCache(1)
+        cache.put('a', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.put('b', 2)
+        eq_(cache.stats(), CacheStats(hits=1, misses=1, evictions=1, size=1))
+
+    @raises(ValueError)
+    def test_bad_size(self):
+        """Caches must hold at least one entry
+        """
+        LRUCache(0)
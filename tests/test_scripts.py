@@ -0,0 +1,77 @@
+"""Tests for the shared lua script registry
+"""
+import redis
+from nose.tools import eq_, raises, assert_is, assert_is_not
+
+from redis_gadgets import scripts
+
+
+scripts.define('tests.echo', "return ARGV[1]")
+
+
+class TestScriptRegistry(object):
+    """Test script registration and recovery
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+
+    def test_shared_per_connection(self):
+        """Everything on a connection shares one registry
+        """
+        assert_is(scripts.for_connection(self.con),
+                  scripts.for_connection(self.con))
+        assert_is_not(scripts.for_connection(self.con),
+                      scripts.for_connection(redis.Redis(db=15)))
+
+    def test_registered_once(self):
+        """Scripts are only registered the first time they are used
+        """
+        registry = scripts.ScriptRegistry(self.con)
+        assert_is(registry.get('tests.echo'), registry.get('tests.echo'))
+
+    def test_run(self):
+        """Scripts run with their keys and args
+        """
+        registry = scripts.ScriptRegistry(self.con)
+        eq_(registry.run('tests.echo', args=('hi',)), 'hi')
+
+    def test_noscript_recovery(self):
+        """Scripts flushed from redis are reloaded transparently
+        """
+        registry = scripts.ScriptRegistry(self.con)
+        registry.run('tests.echo', args=('hi',))
+        self.con.script_flush()
+        eq_(registry.run('tests.echo', args=('again',)), 'again')
+
+    def test_pipeline(self):
+        """Scripts can run in a pipeline, even after a flush
+        """
+        registry = scripts.ScriptRegistry(self.con)
+        self.con.script_flush()
+        pipe = self.con.pipeline()
+        registry.run('tests.echo', args=('one',), client=pipe)
+        registry.run('tests.echo', args=('two',), client=pipe)
+        eq_(pipe.execute(), ['one', 'two'])
+
+    def test_queue(self):
+        """Scripts can be queued on a pipeline, even after a flush
+        """
+        registry = scripts.ScriptRegistry(self.con)
+        self.con.script_flush()
+        pipe = self.con.pipeline()
+        registry.queue(pipe, 'tests.echo', args=('one',))
+        registry.queue(pipe, 'tests.echo', keys=('key',), args=('two',))
+        eq_(pipe.execute(), ['one', 'two'])
+
+    @raises(ValueError)
+    def test_unknown_script(self):
+        """Running an undefined script is an error
+        """
+        scripts.ScriptRegistry(self.con).run('tests.bogus')
+
+    @raises(ValueError)
+    def test_conflicting_definition(self):
+        """Script names can not be reused for a different script
+        """
+        scripts.define('tests.echo', "return ARGV[2]")
@@ -87,6 +87,64 @@ def test_thread_key_names():
     assert_not_equal(results[0], results[1])
 
 
+def test_short_key_hash_readable():
+    """Short expressions keep their readable cache key names
+    """
+    keys = [WeightedKey('SET_B'), WeightedKey('SET_A', 2.0)]
+    eq_('ZCACHE:(SET_A*2.0 && SET_B*1.0)',
+        set_theory.build_key_hash(keys, 'intersect', False))
+
+
+def test_long_key_hash_compact():
+    """Expressions longer than MAX_KEY_LENGTH get fixed length hashed names
+    """
+    keys = [WeightedKey('index:tag:%s:%s' % (i, 'x' * 40)) for i in range(50)]
+    key_hash = set_theory.build_key_hash(keys, 'intersect', False)
+    eq_(len('ZCACHE:') + 40, len(key_hash))
+    eq_(key_hash, set_theory.build_key_hash(list(reversed(keys)),
+                                            'intersect', False))
+    assert_not_equal(key_hash,
+                     set_theory.build_key_hash(keys, 'union', False))
+    assert_not_equal(key_hash,
+                     set_theory.build_key_hash(keys[1:], 'intersect', False))
+
+
+def test_forced_key_hash():
+    """Hashing can be forced on or off whatever the expression length
+    """
+    keys = [WeightedKey('SET_A'), WeightedKey('SET_B')]
+    eq_(set_theory.hash_expression('ZCACHE:(SET_A*1.0 || SET_B*1.0)'),
+        set_theory.build_key_hash(keys, 'union', False, hashed=True))
+    keys = [WeightedKey('k' * set_theory.MAX_KEY_LENGTH), WeightedKey('SET_B')]
+    assert set_theory.build_key_hash(keys, 'union', False,
+                                     hashed=False).startswith('ZCACHE:(')
+
+
+@with_setup(_setup)
+@run_with_both
+def test_hashed_key_query(db):
+    """Queries on hashed cache keys return the same results
+    """
+    st = set_theory.SetTheory(db, hash_keys=True)
+    eq_(5, st.zset_fetch([('SET_A',), ('SET_B',)],
+        operator="intersect", count=True))
+    eq_(['9'], st.zset_fetch([('SET_A', 1.0), ('SET_B', 2.0)],
+        operator="intersect", start=0, end=0))
+
+
+@with_setup(_setup)
+@run_with_both
+def test_recorded_expression(db):
+    """The readable expression of a hashed cache can be recorded
+    """
+    st = set_theory.SetTheory(db, hash_keys=True, record_expressions=True)
+    key_hash, _ = st.zset_cache([('SET_A',), ('SET_B',)],
+                                operator="intersect")
+    eq_('(SET_A*1.0 && SET_B*1.0)', st.expression_for(key_hash))
+    assert db.ttl(key_hash + set_theory.EXPRESSION_SUFFIX) > 0
+    eq_(None, set_theory.SetTheory(db).expression_for('ZCACHE:missing'))
+
+
 @run_with_both
 @raises(ValueError)
 def test_no_default_start_and_end(db):
@@ -534,3 +592,220 @@ def test_zset_fetch_with_expiry(db):
     st.zset_fetch([('TEST_1',), ('TEST_3',)], operator="union",
                   ttl=10, return_key=True)
     eq_(db.ttl(key_hash), 10)
+
+
+@with_setup(_compound_setup)
+@run_with_both
+def test_scripted_range(db):
+    """Scripted ranges return the same results as the unscripted ones"""
+    st = set_theory.SetTheory(db)
+    scripted = set_theory.SetTheory(db, scripted=True)
+    queries = [dict(start=0, end=-1),
+               dict(start=2, end=4, reverse=False),
+               dict(start=0, end=-1, withscores=True),
+               dict(start=0, end=-1, min_score=59, max_score=78),
+               dict(start=15, end=19, min_score=59, max_score=78),
+               dict(start=0, end=5, min_score=59, max_score=78,
+                    reverse=False, withscores=True)]
+    for operator in ("union", "intersect"):
+        for query in queries:
+            eq_(st.zset_range([('TEST_1',), ('TEST_2', 2.0)],
+                              operator=operator, **query),
+                scripted.zset_range([('TEST_1',), ('TEST_2', 2.0)],
+                                    operator=operator, **query))
+
+
+@with_setup(_compound_setup)
+@run_with_both
+def test_scripted_range_cache(db):
+    """Scripted ranges delete their cache with no ttl, and expire it otherwise
+    """
+    st = set_theory.SetTheory(db, scripted=True, record_expressions=True)
+    bind_elements = [('TEST_1',), ('TEST_3',)]
+    key_hash = set_theory.build_key_hash(
+        [WeightedKey(*el) for el in bind_elements], "union", False)
+    eq_(30, len(st.zset_range(bind_elements, start=0, end=-1)))
+    assert not db.exists(key_hash)
+    st.zset_range(bind_elements, start=0, end=-1, ttl=10)
+    eq_(10, db.ttl(key_hash))
+    eq_('(TEST_1*1.0 || TEST_3*1.0)', st.expression_for(key_hash))
+    # an existing cache is read as it is
+    redis.StrictRedis(db=DB_NUM).zadd(key_hash, 100, 'cached')
+    eq_(['cached'], st.zset_range(bind_elements, start=0, end=0))
+
+
+class ExpiringRedis(redis.StrictRedis):
+
+    """Connection that deletes every ZCACHE key a query creates, as if it
+    expired between being built and being read
+    """
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        pipe = super(ExpiringRedis, self).pipeline(transaction, shard_hint)
+        original = pipe.execute
+
+        def execute(*args, **kwargs):
+            result = original(*args, **kwargs)
+            for key in self.keys('ZCACHE:*'):
+                if '::' not in key:
+                    self.delete(key)
+            return result
+        pipe.execute = execute
+        return pipe
+
+
+@with_setup(_compound_setup)
+def test_range_race_fallback():
+    """An expired shared cache is retried, then computed on a private key"""
+    st = set_theory.SetTheory(ExpiringRedis(db=DB_NUM))
+    results = st.zset_range([('TEST_1',), ('TEST_3',)], start=0, end=-1)
+    eq_(30, len(results))
+    eq_(set_theory.MAX_RETRIES, st.stats['range_retries'])
+    eq_(1, st.stats['range_fallbacks'])
+    eq_(1, st.stats['range_races'])
+    eq_([], redis.StrictRedis(db=DB_NUM).keys('ZCACHE:*'))
+
+
+@with_setup(_compound_setup)
+def test_range_empty_result():
+    """Empty slices of existing caches and empty sets built by the query are
+    returned without retrying"""
+    st = set_theory.SetTheory(redis.StrictRedis(db=DB_NUM))
+    eq_([], st.zset_range([('TEST_1',), ('TEST_3',)], start=50, end=60))
+    eq_([], st.zset_range([('TEST_1',), ('TEST_3',)], operator="intersect",
+                          start=0, end=-1))
+    eq_(0, st.stats['range_retries'])
+    eq_(0, st.stats['range_fallbacks'])
+    eq_(0, st.stats['range_races'])
+
+
+def test_expression_canonical():
+    """Equivalent expressions share their canonical text"""
+    from redis_gadgets.set_theory import Difference, Intersect, Union
+    eq_(Union('A', 'B').canonical(), Union('B', 'A').canonical())
+    eq_(Union(Union('A', 'B'), 'C').canonical(),
+        Union('A', Union('C', 'B')).canonical())
+    eq_(Difference('A', 'B', 'C').canonical(),
+        Difference('A', 'C', 'B').canonical())
+    assert_not_equal(Union('A', 'B').canonical(),
+                     Union('A', 'B', aggregate='sum').canonical())
+    assert_not_equal(Difference('A', 'B').canonical(),
+                     Difference('B', 'A').canonical())
+    assert_not_equal(Intersect('A', 'B').canonical(),
+                     Union('A', 'B').canonical())
+
+
+def test_expression_flattening():
+    """Nested combinations with the same operator are stored in one step"""
+    from redis_gadgets.set_theory import Intersect, Union, Weighted
+    union = Union(Weighted(Union('A', 'B'), 2), 'C')
+    eq_(['A', 'B', 'C'], sorted(node for node, _ in union.terms))
+    eq_(2.0, dict(union.terms)['A'])
+    # weights of other combinations stay on the nested result
+    eq_(2, len(Union(Intersect('A', 'B'), 'C').terms))
+
+
+@raises(ValueError)
+def test_expression_bad_aggregate():
+    """Combinations only support the redis aggregate functions"""
+    set_theory.Union('A', 'B', aggregate='avg')
+
+
+@raises(ValueError)
+def test_expression_short_difference():
+    """Differences need something to subtract"""
+    set_theory.Difference('A')
+
+
+@with_setup(_compound_setup)
+@run_with_both
+def test_expression_range(db):
+    """Nested expressions are queried in one call"""
+    from redis_gadgets.set_theory import (Difference, Intersect, Union,
+                                          Weighted)
+    st = set_theory.SetTheory(db)
+    expression = Union(Intersect('TEST_2', 'TEST_3'), Weighted('TEST_1', 0.5))
+    results = st.expression_range(expression, withscores=True)
+    eq_([str(i) for i in range(19, -1, -1)], [m for m, _ in results])
+    eq_(('9', 29.5), results[10])
+    eq_([str(i) for i in range(10)],
+        st.expression_range(Difference('TEST_2', 'TEST_3'), reverse=False))
+    eq_([('29', 158.0)],
+        st.expression_range(Weighted('TEST_3', 2), start=0, end=0,
+                            withscores=True))
+
+
+@with_setup(_compound_setup)
+@run_with_both
+def test_expression_reuse(db):
+    """Cached subexpressions are reused across queries"""
+    from redis_gadgets.set_theory import Difference, Intersect, Union
+    st = set_theory.SetTheory(db)
+    shared = Intersect('TEST_2', 'TEST_3')
+    key_hash, created = st.expression_cache(Union(shared, 'TEST_1'))
+    assert created
+    eq_(2, st.stats['expression_builds'])
+    eq_(20, db.zcard(key_hash))
+    eq_(set_theory.MAX_CACHE_SECONDS, db.ttl(key_hash))
+    eq_(10, len(st.expression_range(Difference('TEST_3', shared))))
+    eq_(3, st.stats['expression_builds'])
+    eq_(1, st.stats['expression_hits'])
+    # flat unions share the caches of zset_cache
+    eq_(st.zset_cache([('TEST_1',), ('TEST_3',)])[0],
+        st.expression_cache(Union('TEST_3', 'TEST_1'))[0])
+
+
+def _planner_setup():
+    """SET_A and SET_B from _setup, and SET_C with the even ids up to 14"""
+    _setup()
+    db = redis.StrictRedis(db=DB_NUM)
+    for i in range(0, 15, 2):
+        db.zadd('SET_C', i, i)
+
+
+@with_setup(_planner_setup)
+@run_with_both
+def test_cardinalities(db):
+    """Cardinalities are fetched together and cached briefly"""
+    st = set_theory.SetTheory(db)
+    eq_({'SET_A': 10, 'SET_C': 8, 'MISSING': 0},
+        st.cardinalities(['SET_A', 'SET_C', 'MISSING']))
+    redis.StrictRedis(db=DB_NUM).zadd('MISSING', 1, 'new')
+    eq_({'MISSING': 0}, st.cardinalities(['MISSING']))
+
+
+@with_setup(_planner_setup)
+@run_with_both
+def test_planned_empty_intersection(db):
+    """Intersections with an empty key are empty without being run"""
+    st = set_theory.SetTheory(db, plan_intersections=True)
+    bind_elements = [('SET_A',), ('MISSING',), ('SET_B',)]
+    eq_([], st.zset_range(bind_elements, operator="intersect",
+                          start=0, end=-1))
+    eq_(0, st.zset_count(bind_elements, operator="intersect"))
+    eq_(0, st.stats['range_retries'])
+    eq_(2, st.stats['empty_intersections'])
+    eq_([], redis.StrictRedis(db=DB_NUM).keys('ZCACHE:*'))
+
+
+@with_setup(_planner_setup)
+@run_with_both
+def test_planned_intersection(db):
+    """Planned intersections match unplanned ones and reuse partials"""
+    st = set_theory.SetTheory(db)
+    planned = set_theory.SetTheory(db, plan_intersections=True)
+    bind_elements = [('SET_B', 2.0), ('SET_A',), ('SET_C', 0.5)]
+    for aggregate in ("max", "sum"):
+        eq_(st.zset_range(bind_elements, operator="intersect",
+                          aggregate=aggregate, start=0, end=-1,
+                          withscores=True),
+            planned.zset_range(bind_elements, operator="intersect",
+                               aggregate=aggregate, start=0, end=-1,
+                               withscores=True))
+    # SET_C and SET_A are the smallest, so their partial is reused
+    eq_(0, planned.stats['partial_hits'])
+    eq_(['6', '8'], planned.zset_range([('SET_C', 0.5), ('SET_A',),
+                                        ('SET_B', 3.0)],
+                                       operator="intersect", start=0,
+                                       end=-1, reverse=False))
+    eq_(1, planned.stats['partial_hits'])
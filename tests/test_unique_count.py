@@ -1,9 +1,12 @@
 """Tests for the unique tracking tool
 """
 import datetime
+import io
 import redis
-from nose.tools import eq_
+from nose.tools import eq_, raises
+from redis.exceptions import WatchError
 
+from redis_gadgets import granularity
 from redis_gadgets import unique_count
 
 
@@ -182,3 +185,952 @@ class TestUniqueTracking(object):
             tracked_ids = list(self.uc.get_ids_for_event('some_event',
                                namespace=namespace))
             eq_(tracked_ids, ids)
+
+    def test_track_events(self):
+        """Bulk tracked events are counted like individually tracked ones
+        """
+        yesterday = self.today - datetime.timedelta(days=1)
+        events = [('event8', 'id%s' % n) for n in range(ITERATIONS)]
+        events.append(('event8', 'id0', yesterday))
+        events.append(unique_count.TrackedEvent('event8', 'id0',
+                                                namespace='users'))
+        self.uc.track_events(events, batch_size=3)
+        eq_(self.uc.get_count(self.today, self.today, 'event8'), ITERATIONS)
+        eq_(self.uc.get_count(yesterday, yesterday, 'event8'), 1)
+        eq_(self.uc.get_count(self.today, self.today, 'event8',
+                              namespace='users'), 1)
+        for n in range(ITERATIONS):
+            eq_(self.uc.map_offset_to_id(self.uc.map_id_to_offset('id%s' % n)),
+                'id%s' % n)
+
+    def test_track_events_stats(self):
+        """Bulk tracking reports new and existing ids per batch
+        """
+        self.uc.track_event('event9', 'id0')
+        events = [('event9', 'id%s' % (n % 3)) for n in range(ITERATIONS)]
+        stats = self.uc.track_events(events)
+        eq_(stats, [unique_count.BatchStats(ITERATIONS, 2, 1)])
+        stats = self.uc.track_events(events, batch_size=ITERATIONS - 1)
+        eq_(stats, [unique_count.BatchStats(ITERATIONS - 1, 0, 3),
+                    unique_count.BatchStats(1, 0, 1)])
+
+    def test_get_ids_across_chunks(self):
+        """Ids are decoded from every chunk of a bitmap
+        """
+        original_chunk_size = unique_count.BITMAP_CHUNK_SIZE
+        unique_count.BITMAP_CHUNK_SIZE = 2
+        try:
+            ids = ['id_%s' % n for n in range(5 * 8 * 2 + 3)]
+            for native_id in ids:
+                self.uc.track_event('chunked_event', native_id=native_id)
+            eq_(list(self.uc.get_ids_for_event('chunked_event')), ids)
+        finally:
+            unique_count.BITMAP_CHUNK_SIZE = original_chunk_size
+
+    def test_map_offsets_to_ids(self):
+        """Can look up the ids for many offsets at once
+        """
+        offsets = [self.uc.map_id_to_offset('id%s' % n)
+                   for n in range(ITERATIONS)]
+        eq_(self.uc.map_offsets_to_ids(offsets[::-1] + [ITERATIONS]),
+            ['id%s' % n for n in reversed(range(ITERATIONS))] + [None])
+
+    def test_pipelined_ids(self):
+        """Several batches of ids are resolved per round trip
+        """
+        sizes = unique_count.ID_BATCH_SIZE, unique_count.ID_BATCHES_PER_TRIP
+        unique_count.ID_BATCH_SIZE, unique_count.ID_BATCHES_PER_TRIP = 2, 3
+        pipeline = self.con.pipeline
+        pipelines = []
+
+        def counted(*args, **kwargs):
+            pipelines.append(args)
+            return pipeline(*args, **kwargs)
+        try:
+            ids = ['id_%s' % n for n in range(13)]
+            for native_id in ids:
+                self.uc.track_event('pipelined_event', native_id=native_id)
+            self.con.pipeline = counted
+            eq_(list(self.uc.get_ids_for_event('pipelined_event')), ids)
+        finally:
+            del self.con.pipeline
+            (unique_count.ID_BATCH_SIZE,
+             unique_count.ID_BATCHES_PER_TRIP) = sizes
+        eq_(len(pipelines), 4)  # one to scan the bitmap, and 3 for the ids
+
+    def test_hourly_rollup(self):
+        """Multi-bucket counts step by the counter's granularity
+        """
+        uc = unique_count.RedisUniqueCount(self.con,
+                                           bucket_func=granularity.hourly)
+        start = datetime.datetime(2015, 4, 20, 22, 30)
+        for hour in range(4):
+            uc.track_event('event11', 'usr%s' % hour,
+                           event_time=start + datetime.timedelta(hours=hour))
+        end = start + datetime.timedelta(hours=3)
+        eq_(uc.get_count(start, end, 'event11'), 4)
+        eq_(uc.get_count(start + datetime.timedelta(hours=1), end, 'event11'),
+            3)
+
+    def test_custom_granularity(self):
+        """Granularities coarser than a day step without a declared step
+        """
+        def yearly(dt):
+            return dt.replace(month=1, day=1, hour=0, minute=0, second=0,
+                              microsecond=0)
+        uc = unique_count.RedisUniqueCount(self.con, bucket_func=yearly)
+        start = datetime.datetime(2015, 4, 20)
+        end = datetime.datetime(2016, 4, 20)
+        uc.track_event('event15', 'usr1', event_time=start)
+        uc.track_event('event15', 'usr2', event_time=end)
+        eq_(uc.get_count(start, start, 'event15'), 1)
+        eq_(uc.get_count(start, end, 'event15'), 2)
+
+    def test_segment_cache(self):
+        """Sliding ranges reuse cached segments, and count correctly
+        """
+        uc = unique_count.RedisUniqueCount(self.con, segment_cache=True)
+        start = datetime.datetime(2015, 4, 1)
+        for day in range(40):
+            uc.track_event('event12', 'usr%s' % (day % 20),
+                           event_time=start + datetime.timedelta(days=day))
+        end = start + datetime.timedelta(days=29)
+        eq_(uc.get_count(start, end, 'event12'), 20)
+        eq_(uc.stats['segment_hits'], 0)
+        misses = uc.stats['segment_misses']
+        for day in range(1, 5):
+            eq_(uc.get_count(start + datetime.timedelta(days=day),
+                             end + datetime.timedelta(days=day), 'event12'),
+                20)
+        assert uc.stats['segment_hits'] > uc.stats['segment_misses'] - misses
+        eq_(uc.stats['range_misses'], 5)
+        uc.get_count(start, end, 'event12')
+        eq_(uc.stats['range_hits'], 1)
+        eq_(uc.get_count(start + datetime.timedelta(days=35),
+                         end + datetime.timedelta(days=35), 'event12'), 5)
+
+    def test_uncached_count(self):
+        """Range counts with no BITOP caching leave no compound keys behind
+        """
+        uc = unique_count.RedisUniqueCount(self.con, bitop_ttl=0)
+        yesterday = self.today - datetime.timedelta(days=1)
+        uc.track_event('event15', 'usr1', event_time=yesterday)
+        uc.track_event('event15', 'usr2', event_time=self.today)
+        eq_(uc.get_count(yesterday, self.today, 'event15'), 2)
+        eq_(self.con.keys(pattern='*:event15:or:*'), [])
+
+    def test_many_bucket_range(self):
+        """Ranges can OR thousands of buckets
+        """
+        uc = unique_count.RedisUniqueCount(self.con,
+                                           bucket_func=granularity.five_minute)
+        start = datetime.datetime(2015, 4, 20)
+        end = start + datetime.timedelta(days=5)
+        uc.track_event('event16', 'usr1', event_time=start)
+        uc.track_event('event16', 'usr2', event_time=end)
+        eq_(uc.get_count(start, end, 'event16'), 2)
+        eq_(uc.stats['range_misses'], 1)
+        eq_(uc.get_count(start, end, 'event16'), 2)
+        eq_(uc.stats['range_hits'], 1)
+
+    def test_get_counts(self):
+        """Many counts can be fetched at once, matching get_count
+        """
+        yesterday = self.today - datetime.timedelta(days=1)
+        for n in range(ITERATIONS):
+            self.uc.track_event('event13', 'usr%s' % n,
+                                event_time=self.today)
+            self.uc.track_event('event14', 'usr%s' % (n % 3),
+                                event_time=yesterday, namespace='users')
+        queries = [('event13', self.today, self.today),
+                   ('event13', yesterday, self.today),
+                   unique_count.CountQuery('event14', self.today, yesterday,
+                                           namespace='users'),
+                   ('event14', yesterday, yesterday, 'users'),
+                   ('event14', yesterday, yesterday)]
+        expected = [ITERATIONS, ITERATIONS, 3, 3, 0]
+        eq_(self.uc.get_counts(queries), expected)
+        eq_(self.uc.get_counts(queries), expected)  # from cache
+        for query, count in zip(queries, expected):
+            query = unique_count.CountQuery(*query)
+            eq_(self.uc.get_count(query.start_date, query.end_date,
+                                  query.event, namespace=query.namespace),
+                count)
+
+    @raises(ValueError)
+    def test_get_counts_bad_query(self):
+        """Count queries must have an event, start and end
+        """
+        self.uc.get_counts([('event13', self.today)])
+
+    def test_bitop_counts(self):
+        """Event ranges can be combined with bitwise operators
+        """
+        tomorrow = self.today + datetime.timedelta(days=1)
+        for n in range(ITERATIONS):
+            self.uc.track_event('view', 'usr%s' % n, event_time=self.today)
+        for n in range(0, ITERATIONS, 2):
+            self.uc.track_event('buy', 'usr%s' % n, event_time=tomorrow)
+        # a long id list makes the buy bitmap longer than the view bitmap
+        for n in range(ITERATIONS, 3 * ITERATIONS):
+            self.uc.track_event('buy', 'usr%s' % n, event_time=tomorrow)
+        self.uc.track_event('refund', 'usr0', event_time=tomorrow)
+        view = ('view', self.today, self.today)
+        buy = ('buy', self.today, tomorrow)
+        refund = ('refund', tomorrow, tomorrow)
+        eq_(self.uc.get_bitop_count('AND', [view, buy]), ITERATIONS // 2)
+        eq_(self.uc.get_bitop_count('OR', [view, buy]), 3 * ITERATIONS)
+        eq_(self.uc.get_bitop_count('XOR', [view, buy]),
+            3 * ITERATIONS - ITERATIONS // 2)
+        eq_(self.uc.get_bitop_count('AND NOT', [view, buy]), ITERATIONS // 2)
+        eq_(self.uc.get_bitop_count('AND NOT', [buy, view]), 2 * ITERATIONS)
+        eq_(self.uc.get_bitop_count('AND NOT', [view, buy, refund]),
+            ITERATIONS // 2)
+        eq_(self.uc.stats['bitop_hits'], 0)
+
+        buyers = self.uc.bitop_key('AND', [buy, view])
+        eq_(self.uc.stats['bitop_hits'], 1)
+        eq_(self.uc.get_bitop_count('AND NOT', [buyers, refund]),
+            ITERATIONS // 2 - 1)
+
+    @raises(ValueError)
+    def test_bitop_operator(self):
+        """Only bitwise operators can combine event ranges
+        """
+        self.uc.get_bitop_count('NAND', [('view', self.today, self.today)])
+
+    @raises(ValueError)
+    def test_bitop_key_ttl(self):
+        """Bitop keys can not be returned when they will not be kept
+        """
+        uc = unique_count.RedisUniqueCount(self.con, bitop_ttl=0)
+        uc.bitop_key('OR', [('view', self.today, self.today)])
+
+    def test_get_bitmaps(self):
+        """Bucket bitmaps are read in order, however they are stored
+        """
+        yesterday = self.today - datetime.timedelta(days=1)
+        self.uc.track_event('event11', 'id1', event_time=self.today)
+        offset = self.uc.map_id_to_offset('id1')
+        bitmaps = list(self.uc.get_bitmaps('event11', yesterday, self.today))
+        eq_([bucket for bucket, _ in bitmaps],
+            [granularity.daily(yesterday), granularity.daily(self.today)])
+        eq_(bitmaps[0][1], b'')
+        eq_(list(unique_count.iter_set_bits(bitmaps[1][1])), [offset])
+
+    def test_iter_offset_ids(self):
+        """The offset to id mapping streams in order, and resumes
+        """
+        for n in range(ITERATIONS):
+            self.uc.map_id_to_offset('id%s' % n)
+        end = self.uc.get_current_offset()
+        pairs = list(self.uc.iter_offset_ids(batch_size=3))
+        eq_([offset for offset, _ in pairs], list(range(end)))
+        eq_([native_id for _, native_id in pairs],
+            [self.uc.map_offset_to_id(offset) for offset in range(end)])
+        eq_(list(self.uc.iter_offset_ids(cursor=5)), pairs[5:])
+
+    def test_export_ids(self):
+        """Exported ids load back by offset, and exports can be continued
+        """
+        fileobj = io.BytesIO()
+        self.uc.map_id_to_offset('id0')
+        first_cursor = self.uc.export_ids(fileobj)
+        eq_(first_cursor, self.uc.get_current_offset())
+        for n in range(1, ITERATIONS):
+            self.uc.map_id_to_offset('id%s' % n)
+        cursor = self.uc.export_ids(fileobj, cursor=first_cursor,
+                                    batch_size=4)
+        eq_(cursor, self.uc.get_current_offset())
+        fileobj.seek(0)
+        ids = unique_count.load_ids(fileobj)
+        eq_(len(ids), cursor)
+        for n in range(ITERATIONS):
+            offset = self.uc.map_id_to_offset('id%s' % n)
+            if n == 0 or offset >= first_cursor:
+                eq_(ids[offset], ('id%s' % n).encode('utf-8'))
+
+    def test_get_ids_with_lookup(self):
+        """Ids are resolved from a lookup where it has them
+        """
+        for n in range(ITERATIONS):
+            self.uc.track_event('event12', 'id%s' % n)
+        offsets = sorted(self.uc.map_id_to_offset('id%s' % n)
+                         for n in range(ITERATIONS))
+        lookup = ['local%s' % offset for offset in range(offsets[4])]
+        eq_(list(self.uc.get_ids_for_event('event12', id_lookup=lookup)),
+            ['local%s' % offset for offset in offsets[:4]] +
+            [self.uc.map_offset_to_id(offset) for offset in offsets[4:]])
+
+
+class TestIterSetBits(object):
+    def test_set_bits(self):
+        """Set bits are decoded most significant bit first
+        """
+        eq_(list(unique_count.iter_set_bits(b'\x80\x01\xa0')),
+            [0, 15, 16, 18])
+
+    def test_base_offset(self):
+        """Decoded offsets are relative to the base offset
+        """
+        eq_(list(unique_count.iter_set_bits(b'\x40', base_offset=80)), [81])
+
+    def test_zero_runs(self):
+        """Long runs of zero bytes are skipped
+        """
+        data = b'\x01' + b'\x00' * 1000 + b'\x80'
+        eq_(list(unique_count.iter_set_bits(data)), [7, 8008])
+
+
+class TestBitmapScanner(object):
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.key = unique_count.BASE_NAMESPACE + ':scanner_test'
+
+    def setup(self):
+        self.con.delete(self.key)
+        self.offsets = [3, 9, 10, 100, 5000, 5001, 80000]
+        for offset in self.offsets:
+            self.con.setbit(self.key, offset, 1)
+
+    def test_scan(self):
+        """Scanning yields every set offset, in order
+        """
+        for window_size in (1, 3, 1024):
+            scanner = unique_count.BitmapScanner(self.con, self.key,
+                                                 window_size=window_size)
+            eq_(list(scanner), self.offsets)
+
+    def test_prefetch(self):
+        """Prefetching windows does not change the scan
+        """
+        scanner = unique_count.BitmapScanner(self.con, self.key,
+                                             window_size=2, prefetch=True)
+        eq_(list(scanner), self.offsets)
+
+    def test_missing_key(self):
+        """Scanning a missing key yields nothing
+        """
+        self.con.delete(self.key)
+        eq_(list(unique_count.BitmapScanner(self.con, self.key)), [])
+
+    @raises(ValueError)
+    def test_bad_window(self):
+        """Windows must be at least a byte
+        """
+        unique_count.BitmapScanner(self.con, self.key, window_size=0)
+
+
+class TestRollups(object):
+    """Test rollup maintenance and use
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.start = datetime.datetime(2015, 4, 27, 22)  # a Monday
+        cls.end = datetime.datetime(2015, 6, 2, 3)
+        cls.plain = unique_count.RedisUniqueCount(
+            cls.con, bucket_func=granularity.hourly)
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+
+    def _track(self, uc):
+        """Track a different id every 7 hours through the test range
+        """
+        event_time = self.start
+        n = 0
+        while event_time <= self.end:
+            uc.track_event('rolled', 'id%s' % n, event_time=event_time)
+            event_time += datetime.timedelta(hours=7)
+            n += 1
+
+    def _make_counter(self, **kwargs):
+        return unique_count.RedisUniqueCount(
+            self.con, bucket_func=granularity.hourly,
+            rollups=(granularity.daily, granularity.weekly,
+                     granularity.monthly), **kwargs)
+
+    def test_counts_match(self):
+        """Counts from rollups match counts from buckets
+        """
+        uc = self._make_counter()
+        self._track(uc)
+        ranges = [(self.start, self.end),
+                  (datetime.datetime(2015, 5, 1),
+                   datetime.datetime(2015, 6, 1)),
+                  (datetime.datetime(2015, 5, 3, 5),
+                   datetime.datetime(2015, 5, 19, 23))]
+        for start, end in ranges:
+            eq_(uc.get_count(start, end, 'rolled'),
+                self.plain.get_count(start, end, 'rolled'))
+
+    def test_rollups_are_read(self):
+        """Whole rollup buckets are read in place of their buckets
+        """
+        uc = self._make_counter()
+        self._track(uc)
+        day = datetime.datetime(2015, 5, 5)
+        count = uc.get_count(day, day + datetime.timedelta(hours=23),
+                             'rolled')
+        eq_(count, 3, "GUARD")
+        for key in self.con.keys(pattern='*:rolled:2015-05-05T*'):
+            self.con.delete(key)
+        eq_(uc.get_count(day, day + datetime.timedelta(hours=23), 'rolled'),
+            count)
+        eq_(self.plain.get_count(day, day + datetime.timedelta(hours=23),
+                                 'rolled'), 0)
+
+    def test_build_rollups(self):
+        """Rollups can be built after the fact
+        """
+        uc = self._make_counter(rollup_on_write=False)
+        self._track(uc)
+        expected = self.plain.get_count(self.start, self.end, 'rolled')
+        eq_(uc.get_count(self.start, self.end, 'rolled'), expected)
+        uc.build_rollups('rolled', self.start, self.end)
+        eq_(uc.get_count(self.start, self.end, 'rolled'), expected)
+        eq_(len(self.con.keys(pattern='*:rolled:monthly:*')), 3)
+
+    def test_unbuilt_counts(self):
+        """get_counts checks which rollups are built for all its queries in
+        one round trip
+        """
+        uc = self._make_counter(rollup_on_write=False)
+        self._track(uc)
+        uc.build_rollups('rolled', self.start, self.start)
+        queries = [('rolled', self.start, self.end - datetime.timedelta(
+            days=days)) for days in range(5)]
+        pipeline = self.con.pipeline
+        pipelines = []
+
+        def counted(*args, **kwargs):
+            pipelines.append(args)
+            return pipeline(*args, **kwargs)
+        self.con.pipeline = counted
+        try:
+            counts = uc.get_counts(queries)
+        finally:
+            del self.con.pipeline
+        eq_(len(pipelines), 2)
+        eq_(counts, [self.plain.get_count(start, end, event)
+                     for event, start, end in queries])
+
+    @raises(ValueError)
+    def test_rollup_granularity(self):
+        """Rollups can not repeat the bucket granularity
+        """
+        unique_count.RedisUniqueCount(self.con,
+                                      bucket_func=granularity.daily,
+                                      rollups=(granularity.daily,))
+
+
+class TestApproximateCounting(object):
+    """Test HyperLogLog counting of selected namespaces and events
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.today = datetime.datetime.now()
+        cls.uc = unique_count.RedisUniqueCount(
+            cls.con, rollups=(granularity.weekly,),
+            approximate=('vanity', ('global', 'views')))
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+
+    def test_is_approximate(self):
+        """Whole namespaces or single events can be approximate
+        """
+        eq_(self.uc.is_approximate('anything', 'vanity'), True)
+        eq_(self.uc.is_approximate('views'), True)
+        eq_(self.uc.is_approximate('clicks'), False)
+        eq_(self.uc.is_approximate('views', 'users'), False)
+
+    def test_counts(self):
+        """Approximate counts work across ranges without allocating offsets
+        """
+        yesterday = self.today - datetime.timedelta(days=1)
+        for n in range(ITERATIONS):
+            self.uc.track_event('views', 'id%s' % n, event_time=self.today)
+        self.uc.track_event('views', 'id0', event_time=yesterday)
+        self.uc.track_event('views', 'other', event_time=yesterday)
+        eq_(self.uc.get_count(yesterday, yesterday, 'views'), 2)
+        eq_(self.uc.get_count(yesterday, self.today, 'views'), ITERATIONS + 1)
+        eq_(self.uc.get_current_offset(), 0)
+
+    def test_track_events(self):
+        """Batches mix approximate and exact events
+        """
+        stats = self.uc.track_events([('views', 'id1'), ('clicks', 'id1'),
+                                      ('x', 'id2', None, 'vanity')])
+        eq_(stats, [unique_count.BatchStats(3, 1, 0)])
+        eq_(self.uc.get_counts([('views', self.today, self.today),
+                                ('clicks', self.today, self.today),
+                                ('x', self.today, self.today, 'vanity')]),
+            [1, 1, 1])
+        eq_(self.uc.get_current_offset(), 1)
+        eq_(self.uc.get_current_offset('vanity'), 0)
+
+    def test_build_rollups(self):
+        """Approximate rollups are rebuilt by merging their buckets
+        """
+        uc = unique_count.RedisUniqueCount(
+            self.con, rollups=(granularity.weekly,), rollup_on_write=False,
+            approximate=('vanity',))
+        monday = granularity.weekly(self.today)
+        for n in range(7):
+            uc.track_event('x', 'id%s' % n, 'vanity',
+                           monday + datetime.timedelta(days=n))
+        uc.build_rollups('x', monday, monday, 'vanity')
+        eq_(uc.get_count(monday, monday + datetime.timedelta(days=6), 'x',
+                         'vanity'), 7)
+
+    @raises(ValueError)
+    def test_no_ids(self):
+        """Ids of approximate events cannot be listed
+        """
+        list(self.uc.get_ids_for_event('views'))
+
+    @raises(ValueError)
+    def test_no_bitops(self):
+        """Approximate events cannot be combined with bitops
+        """
+        self.uc.get_bitop_count('AND', [('views', self.today, self.today),
+                                        ('clicks', self.today, self.today)])
+
+
+class TestCompaction(object):
+    """Test retiring and renumbering offsets
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.today = granularity.daily(datetime.datetime.now())
+        cls.yesterday = cls.today - datetime.timedelta(days=1)
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+        self.uc = unique_count.RedisUniqueCount(
+            self.con, rollups=(granularity.monthly,), offset_cache_size=100)
+        for n in range(ITERATIONS):
+            self.uc.track_event('old', 'id%s' % n, event_time=self.yesterday)
+        for n in range(0, ITERATIONS, 2):
+            self.uc.track_event('new', 'id%s' % n, event_time=self.today)
+        self.uc.track_event('new', 'late', event_time=self.today)
+
+    def _expire_yesterday(self):
+        """Delete the buckets only the retired ids are in
+        """
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            if isinstance(key, bytes):
+                key = key.decode('utf-8')
+            if ':old:' in key:
+                self.con.delete(key)
+
+    def test_compact(self):
+        """Ids only in deleted buckets are retired, and the rest renumbered
+        """
+        self._expire_yesterday()
+        stats = self.uc.compact()
+        eq_(stats, unique_count.CompactionStats(ITERATIONS // 2 + 1,
+                                                ITERATIONS // 2, 2))
+        eq_(self.uc.get_current_offset(), ITERATIONS // 2 + 1)
+        expected = ['id%s' % n for n in range(0, ITERATIONS, 2)] + ['late']
+        eq_(list(self.uc.get_ids_for_event('new', event_time=self.today)),
+            expected)
+        eq_([self.uc.map_offset_to_id(n) for n in range(len(expected))],
+            expected)
+        eq_(self.uc.map_id_to_offset('late'), len(expected) - 1)
+        eq_(self.uc.get_count(self.today, self.today, 'new'), len(expected))
+        eq_(self.uc.get_count(granularity.monthly(self.today), self.today,
+                              'new'), len(expected))
+        eq_(self.uc.map_id_to_offset('id1'), len(expected))
+
+    def test_nothing_retired(self):
+        """Compacting a dense namespace keeps every id and count
+        """
+        self.uc.get_count(self.yesterday, self.today, 'old')
+        stats = self.uc.compact()
+        eq_(stats.retired_ids, 0)
+        eq_(self.uc.get_count(self.yesterday, self.today, 'old'), ITERATIONS)
+        eq_(self.uc.get_count(self.yesterday, self.today, 'new'),
+            ITERATIONS // 2 + 1)
+        eq_(self.con.keys('*compact*'), [])
+
+    def test_keeps_ttls(self):
+        """Rewritten buckets keep their expiry
+        """
+        key = self.uc.add_namespace(unique_count.DEFAULT_NAMESPACE,
+                                    'new:' + self.today.isoformat())
+        self.con.expire(key, 1000)
+        self._expire_yesterday()
+        self.uc.compact()
+        assert 0 < self.con.ttl(key) <= 1000
+
+    def test_tracked_during_compaction(self):
+        """Events tracked while compacting restart the compaction rather than
+        being lost
+        """
+        other = unique_count.RedisUniqueCount(self.con)
+        hmget = self.con.hmget
+        calls = []
+
+        def track_once(*args, **kwargs):
+            if not calls:
+                other.track_event('new', 'newcomer', event_time=self.today)
+            calls.append(args)
+            return hmget(*args, **kwargs)
+        self._expire_yesterday()
+        self.con.hmget = track_once
+        try:
+            stats = self.uc.compact()
+        finally:
+            del self.con.hmget
+        eq_(stats.ids, ITERATIONS // 2 + 2)
+        eq_(self.uc.get_count(self.today, self.today, 'new'),
+            ITERATIONS // 2 + 2)
+        assert 'newcomer' in list(
+            self.uc.get_ids_for_event('new', event_time=self.today))
+
+    def test_bucket_created_during_compaction(self):
+        """A bucket created while compacting restarts the compaction, even
+        for an id that already had an offset
+        """
+        other = unique_count.RedisUniqueCount(self.con)
+        hmget = self.con.hmget
+        calls = []
+
+        def track_once(*args, **kwargs):
+            if not calls:
+                other.track_event('fresh', 'id8', event_time=self.today)
+            calls.append(args)
+            return hmget(*args, **kwargs)
+        self._expire_yesterday()
+        self.con.hmget = track_once
+        try:
+            stats = self.uc.compact()
+        finally:
+            del self.con.hmget
+        eq_(stats.keys, 3)
+        eq_(list(self.uc.get_ids_for_event('fresh', event_time=self.today)),
+            ['id8'])
+
+    @raises(WatchError)
+    def test_busy_compaction(self):
+        """Compaction gives up on a namespace that is always being tracked
+        """
+        hmget = self.con.hmget
+        calls = []
+
+        def track_always(*args, **kwargs):
+            calls.append(args)
+            unique_count.RedisUniqueCount(self.con).track_event(
+                'new', 'busy%d' % len(calls), event_time=self.today)
+            return hmget(*args, **kwargs)
+        self.con.hmget = track_always
+        try:
+            self.uc.compact()
+        finally:
+            del self.con.hmget
+
+    def test_chunked_compaction(self):
+        """Bitmaps are renumbered correctly across window boundaries
+        """
+        chunk_size = unique_count.BITMAP_CHUNK_SIZE
+        unique_count.BITMAP_CHUNK_SIZE = 3
+        try:
+            for n in range(ITERATIONS, ITERATIONS * 3):
+                self.uc.track_event('old', 'id%s' % n,
+                                    event_time=self.yesterday)
+                if n % 7 == 0:
+                    self.uc.track_event('new', 'id%s' % n,
+                                        event_time=self.today)
+            expected = list(self.uc.get_ids_for_event(
+                'new', event_time=self.today))
+            self._expire_yesterday()
+            stats = self.uc.compact()
+        finally:
+            unique_count.BITMAP_CHUNK_SIZE = chunk_size
+        eq_(stats.ids, len(expected))
+        eq_(list(self.uc.get_ids_for_event('new', event_time=self.today)),
+            expected)
+        eq_(self.uc.get_count(self.today, self.today, 'new'), len(expected))
+
+    def test_sparse(self):
+        """Sparse buckets are renumbered in place
+        """
+        uc = unique_count.RedisUniqueCount(self.con, sparse_density=1)
+        uc.track_event('rare', 'id0', 'sparse', self.yesterday)
+        uc.track_event('rare', 'late', 'sparse', self.today)
+        self.con.delete(uc.add_namespace('sparse', 'rare:' +
+                                         self.yesterday.isoformat()))
+        eq_(uc.compact('sparse').ids, 1)
+        key = uc.add_namespace('sparse', 'rare:' + self.today.isoformat())
+        assert self.con.type(key) in (b'set', 'set')
+        eq_(list(uc.get_ids_for_event('rare', 'sparse', self.today)),
+            ['late'])
+
+    def test_stale_block(self):
+        """Offsets reserved before a compaction are never handed out again
+        """
+        blocked = unique_count.RedisUniqueCount(self.con,
+                                                offset_block_size=10)
+        plain = unique_count.RedisUniqueCount(self.con)
+        blocked.track_event('event', 'a0', 'blocks', self.today)
+        for n in range(3):
+            plain.track_event('event', 'b%d' % n, 'blocks', self.today)
+        self.con.delete(plain.add_namespace(
+            'blocks', 'event:' + self.today.isoformat()))
+        plain.track_event('event', 'b0', 'blocks', self.today)
+        plain.track_event('event', 'b1', 'blocks', self.today)
+        plain.compact('blocks')
+        blocked.track_event('event', 'newcomer', 'blocks', self.today)
+        blocked.track_event('event', 'other', 'blocks', self.today)
+        offsets = [plain.map_id_to_offset(native_id, 'blocks')
+                   for native_id in ('b0', 'b1', 'newcomer', 'other')]
+        eq_(len(set(offsets)), 4)
+        eq_(plain.map_offsets_to_ids(offsets, 'blocks'),
+            ['b0', 'b1', 'newcomer', 'other'])
+        eq_(plain.get_count(self.today, self.today, 'event', 'blocks'), 4)
+
+    def test_stale_cache(self):
+        """Offsets cached by other counters are dropped once the namespace
+        is compacted
+        """
+        check_seconds = unique_count.GENERATION_CHECK_SECONDS
+        unique_count.GENERATION_CHECK_SECONDS = 0
+        try:
+            other = unique_count.RedisUniqueCount(self.con,
+                                                  offset_cache_size=100)
+            eq_(other.map_id_to_offset('late'), ITERATIONS)
+            self._expire_yesterday()
+            self.uc.compact()
+            eq_(other.map_id_to_offset('late'), ITERATIONS // 2)
+            other.track_event('new', 'late', event_time=self.today)
+            other.track_event('new', 'id0', event_time=self.today)
+        finally:
+            unique_count.GENERATION_CHECK_SECONDS = check_seconds
+        eq_(self.uc.get_count(self.today, self.today, 'new'),
+            ITERATIONS // 2 + 1)
+
+
+class TestRetention(object):
+    """Test bucket expiry
+    """
+    @classmethod
+    def setup_class(cls):
+        cls.con = redis.Redis(db=15)  # use high db for testing
+        cls.now = datetime.datetime.utcnow()
+        cls.policy = {granularity.hourly: datetime.timedelta(days=2)}
+
+    def setup(self):
+        for key in self.con.keys(pattern=unique_count.BASE_NAMESPACE + '*'):
+            self.con.delete(key)
+
+    def _make_counter(self, **kwargs):
+        return unique_count.RedisUniqueCount(
+            self.con, bucket_func=granularity.hourly,
+            rollups=(granularity.daily,), **kwargs)
+
+    def _key(self, uc, name):
+        return uc.add_namespace(unique_count.DEFAULT_NAMESPACE, name)
+
+    def test_expiry_on_create(self):
+        """New buckets expire per the policy, and other granularities never
+        """
+        uc = self._make_counter(retention=self.policy)
+        uc.track_event('event', 'id1', event_time=self.now)
+        hour = granularity.hourly(self.now)
+        ttl = self.con.ttl(self._key(uc, 'event:' + hour.isoformat()))
+        expected = (hour + datetime.timedelta(days=2, hours=1) -
+                    self.now).total_seconds()
+        assert expected - 5 <= ttl <= expected + 1, ttl
+        eq_(self.con.ttl(self._key(
+            uc, 'event:daily:' + granularity.daily(self.now).isoformat())),
+            -1)
+
+    def test_expiry_set_once(self):
+        """Tracking into an existing bucket leaves its expiry alone
+        """
+        uc = self._make_counter(retention=self.policy,
+                                offset_cache_size=ITERATIONS)
+        uc.track_events([('event', 'id1', self.now)])
+        hour = granularity.hourly(self.now)
+        key = self._key(uc, 'event:' + hour.isoformat())
+        self.con.expire(key, 100)
+        uc.track_event('event', 'id1', event_time=self.now)
+        uc.track_event('event', 'id2', event_time=self.now)
+        assert self.con.ttl(key) <= 100
+
+    def test_expiry_in_track(self):
+        """Single events expire new buckets in the call setting their bits,
+        for every way of setting them
+        """
+        for options in ({}, {'offset_cache_size': ITERATIONS},
+                        {'sparse_density': 0.5},
+                        {'sparse_density': 0.5,
+                         'offset_cache_size': ITERATIONS},
+                        {'offset_block_size': 10}):
+            self.setup()
+            uc = self._make_counter(retention=self.policy, **options)
+            names = []
+            run = uc._scripts.run
+
+            def counted(name, *args, **kwargs):
+                names.append(name)
+                return run(name, *args, **kwargs)
+            uc._scripts.run = counted
+            try:
+                uc.track_event('event', 'id1', event_time=self.now)
+                uc.track_event('other', 'id1', event_time=self.now)
+            finally:
+                del uc._scripts.run
+            assert 'unique_count.expire_new' not in names, (options, names)
+            eq_(len(names), 2, (options, names))
+            for event in ('event', 'other'):
+                key = self._key(uc, '%s:%s' % (
+                    event, granularity.hourly(self.now).isoformat()))
+                assert self.con.ttl(key) > 0, (options, key)
+            eq_(uc.get_count(self.now, self.now, 'other'), 1)
+
+    def test_apply_retention(self):
+        """Existing buckets are expired, or deleted if already too old
+        """
+        uc = self._make_counter()
+        old = self.now - datetime.timedelta(days=3)
+        uc.track_event('event', 'id1', event_time=old)
+        uc.track_event('event', 'id1', event_time=self.now)
+        uc.get_count(old, self.now, 'event')
+        eq_(uc.apply_retention(), 0)
+        uc = self._make_counter(retention=self.policy)
+        eq_(uc.apply_retention(), 2)
+        eq_(uc.get_count(old, old, 'event'), 0)
+        eq_(uc.get_count(self.now, self.now, 'event'), 1)
+        assert self.con.ttl(self._key(
+            uc, 'event:' + granularity.hourly(self.now).isoformat())) > 0
+        eq_(uc.apply_retention(), 0)
+
+
+class TestCachedUniqueTracking(TestUniqueTracking):
+    """Run the tracking tests with the offset caches enabled
+    """
+    def setup(self):
+        super(TestCachedUniqueTracking, self).setup()
+        # fresh caches, since the keys they mirror were just deleted
+        self.uc = unique_count.RedisUniqueCount(self.con,
+                                                offset_cache_size=ITERATIONS)
+
+    def test_cache_stats(self):
+        """Cached mappings are served without asking redis
+        """
+        offset = self.uc.map_id_to_offset('id1')
+        self.uc.track_event('event10', 'id1')
+        self.uc.map_offset_to_id(offset)
+        self.uc.map_offset_to_id(offset)
+        stats = self.uc.cache_stats()
+        eq_(stats['id_to_offset'].hits, 1)
+        eq_(stats['id_to_offset'].misses, 1)
+        eq_(stats['offset_to_id'].hits, 1)
+        eq_(stats['offset_to_id'].misses, 1)
+
+    def test_no_cache_stats(self):
+        """Counters without caching have no cache stats
+        """
+        eq_(unique_count.RedisUniqueCount(self.con).cache_stats(), None)
+
+
+class TestSparseUniqueTracking(TestUniqueTracking):
+    """Run the tracking tests with buckets stored as offset sets until dense
+    """
+    def setup(self):
+        super(TestSparseUniqueTracking, self).setup()
+        self.uc = unique_count.RedisUniqueCount(self.con, sparse_density=0.5)
+
+    def test_promotion(self):
+        """Buckets start as sets and become bitmaps once dense
+        """
+        for n in range(ITERATIONS):
+            self.uc.map_id_to_offset('id%s' % n)
+        self.uc.track_event('event1', 'id0', event_time=self.today)
+        bucket = granularity.daily(self.today).isoformat()
+        key = self.uc.add_namespace(unique_count.DEFAULT_NAMESPACE,
+                                    'event1:' + bucket)
+        assert self.con.type(key) in (b'set', 'set')
+        for n in range(ITERATIONS):
+            self.uc.track_event('event1', 'id%s' % n, event_time=self.today)
+        assert self.con.type(key) in (b'string', 'string')
+        eq_(self.uc.get_count(self.today, self.today, 'event1'), ITERATIONS)
+
+    def test_mixed_representations(self):
+        """Ranges over both sparse and dense buckets count correctly
+        """
+        yesterday = self.today - datetime.timedelta(days=1)
+        for n in range(ITERATIONS):
+            self.uc.track_event('event1', 'id%s' % n, event_time=self.today)
+        self.uc.track_event('event1', 'id0', event_time=yesterday)
+        self.uc.track_event('event1', 'other', event_time=yesterday)
+        eq_(self.uc.get_count(yesterday, yesterday, 'event1'), 2)
+        eq_(self.uc.get_count(yesterday, self.today, 'event1'),
+            ITERATIONS + 1)
+        eq_(sorted(self.uc.get_ids_for_event('event1', event_time=yesterday)),
+            ['id0', 'other'])
+
+
+class TestBlockAllocation(TestUniqueTracking):
+    """Run the tracking tests with offsets reserved in blocks, and hash tagged
+    keys
+    """
+    def setup(self):
+        super(TestBlockAllocation, self).setup()
+        self.uc = unique_count.RedisUniqueCount(self.con, offset_block_size=4,
+                                                hash_tags=True)
+
+    def test_hash_tags(self):
+        """Namespaces are wrapped in hash tags
+        """
+        eq_(self.uc.add_namespace('users', 'event'),
+            unique_count.BASE_NAMESPACE + ':{users}:event')
+
+    def test_blocks(self):
+        """Offsets are reserved a block at a time, and not shared between
+        counters
+        """
+        other = unique_count.RedisUniqueCount(self.con, offset_block_size=4,
+                                              hash_tags=True)
+        eq_(self.uc.map_id_to_offset('id1'), 0)
+        eq_(other.map_id_to_offset('id2'), 4)
+        eq_(self.uc.map_id_to_offset('id2'), 4)
+        eq_(self.uc.map_id_to_offset('id3'), 1)
+        eq_(self.uc.get_current_offset(), 8)
+
+    def test_get_current_offset(self):
+        """The current offset counts reserved offsets
+        """
+        eq_(self.uc.get_current_offset(), 0)
+        self.uc.track_event('event', 'id1')
+        eq_(self.uc.get_current_offset(), 4)
+
+    def test_batch_duplicates(self):
+        """Ids repeated in a batch claim one offset between them
+        """
+        self.uc.track_events([('event', 'id1'), ('event', 'id1'),
+                              ('event', 'id2')])
+        eq_(self.uc.map_id_to_offset('id1'), 0)
+        eq_(self.uc.map_id_to_offset('id2'), 1)
+        eq_(self.uc.map_id_to_offset('id3'), 2)
+        eq_(self.uc.get_count(self.today, self.today, 'event'), 2)
+
+    def test_batch_duplicates_compact(self):
+        """A batch repeating many new ids keeps their offsets dense
+        """
+        self.uc.track_events([('event', 'id%d' % (i % 30))
+                              for i in range(200)])
+        eq_(self.uc.get_current_offset(), 32)
+        eq_(self.uc.get_count(self.today, self.today, 'event'), 30)
+        [(_, bitmap)] = self.uc.get_bitmaps('event', self.today, self.today)
+        eq_(len(bitmap), 4)